@@ -24,7 +24,10 @@
 import asyncio
 import threading
 import asyncio
+import bisect
+import heapq
 import itertools
+import math
 from collections import defaultdict
 from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple, NamedTuple, Sequence, List
 
@@ -91,7 +94,31 @@ class AddressSynchronizer(Logger):
         # thread local storage for caching stuff
         self.threadlocal_cache = threading.local()
 
-        self._get_addr_balance_cache = {}
+        # Coins received by wallet addresses, with their contribution to the
+        # (confirmed, unconfirmed, unmatured) balance of the address. Updated
+        # as transactions are added or removed and as their heights change,
+        # for the local height in self._coins_local_height.
+        # Access with self.lock and self.transaction_lock.
+        self._coins = {}  # type: Dict[str, Dict[str, Tuple[int, int, int]]]  # addr -> prevout -> (c, u, x)
+        self._utxos = {}  # type: Dict[str, Dict[str, Tuple[int, bool]]]  # addr -> prevout -> (value, is_cb)
+        self._balances = {}  # type: Dict[str, Tuple[int, int, int]]  # addr -> (c, u, x)
+        self._coinbase_coins = set()  # type: Set[Tuple[str, str]]  # (addr, prevout)
+        # (local height at which it matures, prevout, addr), of unmatured coinbase coins
+        self._immature_coins = []  # type: List[Tuple[int, str, str]]
+        self._coins_local_height = None  # type: Optional[int]
+        # History of the default domain (all wallet addresses), in the order
+        # of get_txpos, with the running balance and block timestamp (highest
+        # so far, inf from the first unconfirmed tx) after each tx. These are
+        # recomputed lazily, from position self._history_valid onwards.
+        # Access with self.lock and self.transaction_lock.
+        self._history_keys = []  # type: List[tuple]  # get_txpos(txid) + (txid,)
+        self._history_deltas = []  # type: List[int]
+        self._history_balances = []  # type: List[int]
+        self._history_timestamps = []  # type: List[float]
+        self._history_key_of_tx = {}  # type: Dict[str, tuple]
+        self._history_valid = 0
+        # fees of confirmed txs in the history, which do not change anymore
+        self._history_fees = {}  # type: Dict[str, Optional[int]]
 
         self.load_and_cleanup()
 
@@ -106,6 +133,8 @@ class AddressSynchronizer(Logger):
         self.check_history()
         self.load_unverified_transactions()
         self.remove_local_transactions_we_dont_have()
+        self._rebuild_coin_index()
+        self._rebuild_history_index()
 
     def is_mine(self, address: Optional[str]) -> bool:
         if not address: return False
@@ -164,10 +193,6 @@ class AddressSynchronizer(Logger):
         if self.network is not None:
             self.synchronizer = Synchronizer(self)
             self.verifier = SPV(self.network, self)
-            util.register_callback(self.on_blockchain_updated, ['blockchain_updated'])
-
-    def on_blockchain_updated(self, event, *args):
-        self._get_addr_balance_cache = {}  # invalidate cache
 
     def stop(self):
         if self.network:
@@ -177,7 +202,6 @@ class AddressSynchronizer(Logger):
             if self.verifier:
                 asyncio.run_coroutine_threadsafe(self.verifier.stop(), self.network.asyncio_loop)
                 self.verifier = None
-            util.unregister_callback(self.on_blockchain_updated)
             self.db.put('stored_height', self.get_local_height())
 
     def add_address(self, address):
@@ -280,7 +304,6 @@ class AddressSynchronizer(Logger):
                         if n == prevout_n:
                             if addr and self.is_mine(addr):
                                 self.db.add_txi_addr(tx_hash, addr, ser, v)
-                                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
                             return
             for txi in tx.inputs():
                 if txi.is_coinbase_input():
@@ -291,6 +314,7 @@ class AddressSynchronizer(Logger):
                 self.db.set_spent_outpoint(prevout_hash, prevout_n, tx_hash)
                 add_value_from_prev_output()
             # add outputs
+            next_txs = set()
             for n, txo in enumerate(tx.outputs()):
                 v = txo.value
                 ser = tx_hash + ':%d'%n
@@ -299,17 +323,21 @@ class AddressSynchronizer(Logger):
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
                     self.db.add_txo_addr(tx_hash, addr, n, v, is_coinbase)
-                    self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
                     # give v to txi that spends me
                     next_tx = self.db.get_spent_outpoint(tx_hash, n)
                     if next_tx is not None:
                         self.db.add_txi_addr(next_tx, addr, ser, v)
                         self._add_tx_to_local_history(next_tx)
+                        next_txs.add(next_tx)
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.db.add_transaction(tx_hash, tx)
             self.db.add_num_inputs_to_tx(tx_hash, len(tx.inputs()))
+            self._on_tx_changed(tx_hash)
+            # their deltas changed
+            for next_tx in next_txs:
+                self._on_tx_changed(next_tx)
             return True
 
     def remove_transaction(self, tx_hash: str) -> None:
@@ -335,8 +363,7 @@ class AddressSynchronizer(Logger):
             tx = self.db.remove_transaction(tx_hash)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            for addr in itertools.chain(self.db.get_txi_addresses(tx_hash), self.db.get_txo_addresses(tx_hash)):
-                self._get_addr_balance_cache.pop(addr, None)  # invalidate cache
+            coins = self._get_coins_of_tx(tx_hash)
             self.db.remove_txi(tx_hash)
             self.db.remove_txo(tx_hash)
             self.db.remove_tx_fee(tx_hash)
@@ -347,6 +374,11 @@ class AddressSynchronizer(Logger):
                     scripthash = bitcoin.script_to_scripthash(txo.scriptpubkey.hex())
                     prevout = TxOutpoint(bfh(tx_hash), idx)
                     self.db.remove_prevout_by_scripthash(scripthash, prevout=prevout, value=txo.value)
+            # the index is built once the db is loaded
+            if self._coins_local_height is not None:
+                for addr, prevout_str in coins:
+                    self._update_coin(addr, prevout_str)
+                self._update_history_of_tx(tx_hash)
 
     def get_depending_transactions(self, tx_hash: str) -> Set[str]:
         """Returns all (grand-)children of tx_hash in this wallet."""
@@ -372,6 +404,7 @@ class AddressSynchronizer(Logger):
                     self.db.remove_verified_tx(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
+                    self._on_tx_changed(tx_hash)
             self.db.set_addr_history(addr, hist)
 
         for tx_hash, tx_height in hist:
@@ -419,6 +452,8 @@ class AddressSynchronizer(Logger):
         with self.lock:
             with self.transaction_lock:
                 self.db.clear_history()
+                self._rebuild_coin_index()
+                self._rebuild_history_index()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
@@ -445,10 +480,12 @@ class AddressSynchronizer(Logger):
         return f
 
     @with_local_height_cached
-    def get_history(self, *, domain=None) -> Sequence[HistoryItem]:
-        # get domain
+    def get_history(self, *, domain=None, start: int = None, stop: int = None) -> Sequence[HistoryItem]:
+        """History of the domain, oldest first. start and stop select
+        items by position, as in a slice. The history of the default domain
+        (all wallet addresses) is kept up to date in an index."""
         if domain is None:
-            domain = self.get_addresses()
+            return self._get_history_from_index(start, stop)
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
@@ -489,7 +526,7 @@ class AddressSynchronizer(Logger):
             self.logger.warning("history not synchronized")
             return []
 
-        return h2
+        return h2[start:stop]
 
     def _add_tx_to_local_history(self, txid):
         with self.transaction_lock:
@@ -530,24 +567,30 @@ class AddressSynchronizer(Logger):
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
                     self.db.remove_verified_tx(tx_hash)
+                    self._on_tx_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
+                old_height = self.unverified_tx.get(tx_hash)
                 self.unverified_tx[tx_hash] = tx_height
+                if old_height != tx_height:
+                    self._on_tx_changed(tx_hash)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._on_tx_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
             self.unverified_tx.pop(tx_hash, None)
             self.db.add_verified_tx(tx_hash, info)
+            self._on_tx_changed(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         util.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
@@ -578,6 +621,8 @@ class AddressSynchronizer(Logger):
                         # a status update, that will overwrite it.
                         self.unverified_tx[tx_hash] = tx_height
                         txs.add(tx_hash)
+            for tx_hash in txs:
+                self._on_tx_changed(tx_hash)
         return txs
 
     def get_local_height(self) -> int:
@@ -593,6 +638,7 @@ class AddressSynchronizer(Logger):
             tx_was_added = self.add_transaction(tx)
             if tx_was_added:
                 self.future_tx[tx.txid()] = num_blocks
+                self._on_tx_changed(tx.txid())
             return tx_was_added
 
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
@@ -744,6 +790,216 @@ class AddressSynchronizer(Logger):
         self.db.add_num_inputs_to_tx(txid, len(tx.inputs()))
         return fee
 
+    def _rebuild_coin_index(self) -> None:
+        with self.lock, self.transaction_lock:
+            self._coins = {}
+            self._utxos = {}
+            self._balances = {}
+            self._coinbase_coins = set()
+            self._immature_coins = []
+            self._coins_local_height = self.get_local_height()
+            for txid in self.db.list_txo():
+                for addr in self.db.get_txo_addresses(txid):
+                    for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                        self._update_coin(addr, f'{txid}:{n}')
+
+    def _get_coins_of_tx(self, txid: str) -> List[Tuple[str, str]]:
+        """Returns the (address, prevout) of the coins that txid creates or spends."""
+        with self.transaction_lock:
+            coins = []
+            for addr in self.db.get_txo_addresses(txid):
+                for n, v, is_cb in self.db.get_txo_addr(txid, addr):
+                    coins.append((addr, f'{txid}:{n}'))
+            for addr in self.db.get_txi_addresses(txid):
+                for prevout_str, v in self.db.get_txi_addr(txid, addr):
+                    coins.append((addr, prevout_str))
+            return coins
+
+    def _on_tx_changed(self, txid: str) -> None:
+        """Updates the coin and history indexes, after txid was added or
+        removed, or its height changed."""
+        # the indexes are built once the db is loaded
+        if self._coins_local_height is None:
+            return
+        with self.lock, self.transaction_lock:
+            self._update_coins_local_height()
+            for addr, prevout_str in self._get_coins_of_tx(txid):
+                self._update_coin(addr, prevout_str)
+            self._update_history_of_tx(txid)
+
+    def _update_coins_local_height(self) -> None:
+        local_height = self.get_local_height()
+        if local_height < self._coins_local_height:
+            # the chain got shorter; coinbase outputs might be unmatured again
+            self._coins_local_height = local_height
+            for addr, prevout_str in list(self._coinbase_coins):
+                self._update_coin(addr, prevout_str)
+            return
+        self._coins_local_height = local_height
+        while self._immature_coins and self._immature_coins[0][0] <= local_height:
+            mature_height, prevout_str, addr = heapq.heappop(self._immature_coins)
+            self._update_coin(addr, prevout_str)
+
+    def _update_coin(self, addr: str, prevout_str: str) -> None:
+        """Recomputes the balance contribution of a coin, or removes it
+        from the index if it is not in the wallet anymore.
+        Needs self.lock and self.transaction_lock."""
+        old = self._coins.get(addr, {}).pop(prevout_str, None)
+        if old is not None:
+            self._add_to_balance(addr, old, -1)
+            if not self._coins[addr]:
+                self._coins.pop(addr)
+        if self._utxos.get(addr, {}).pop(prevout_str, None) and not self._utxos[addr]:
+            self._utxos.pop(addr)
+        txid, n = prevout_str.rsplit(':', 1)
+        for n2, value, is_cb in self.db.get_txo_addr(txid, addr):
+            if n2 == int(n):
+                break
+        else:
+            self._coinbase_coins.discard((addr, prevout_str))
+            return
+        c = u = x = 0
+        tx_height = self.get_tx_height(txid).height
+        mempool_height = self._coins_local_height + 1  # height of next block
+        if is_cb and tx_height + constants.net.COINBASE_MATURITY > mempool_height:
+            x += value
+            heapq.heappush(self._immature_coins, (tx_height + constants.net.COINBASE_MATURITY - 1, prevout_str, addr))
+        elif tx_height > 0:
+            c += value
+        else:
+            u += value
+        if is_cb:
+            self._coinbase_coins.add((addr, prevout_str))
+        spending_txid = self.db.get_spent_outpoint(txid, n)
+        if spending_txid is not None and any(ser == prevout_str for ser, v in self.db.get_txi_addr(spending_txid, addr)):
+            if self.get_tx_height(spending_txid).height > 0:
+                c -= value
+            else:
+                u -= value
+        else:
+            self._utxos.setdefault(addr, {})[prevout_str] = (value, is_cb)
+        self._coins.setdefault(addr, {})[prevout_str] = (c, u, x)
+        self._add_to_balance(addr, (c, u, x), 1)
+
+    def _add_to_balance(self, addr: str, delta: Tuple[int, int, int], sign: int) -> None:
+        c, u, x = self._balances.get(addr, (0, 0, 0))
+        c, u, x = c + sign * delta[0], u + sign * delta[1], x + sign * delta[2]
+        if (c, u, x) == (0, 0, 0):
+            self._balances.pop(addr, None)
+        else:
+            self._balances[addr] = (c, u, x)
+
+    def _get_addresses_with_utxos(self) -> List[str]:
+        with self.lock, self.transaction_lock:
+            return [addr for addr in self._utxos if self.is_mine(addr)]
+
+    def _get_addresses_with_balance(self) -> List[str]:
+        with self.lock, self.transaction_lock:
+            self._update_coins_local_height()
+            return [addr for addr in self._balances if self.is_mine(addr)]
+
+    def _rebuild_history_index(self) -> None:
+        with self.lock, self.transaction_lock:
+            self._history_keys = []
+            self._history_deltas = []
+            self._history_key_of_tx = {}
+            self._history_valid = 0
+            self._history_fees = {}
+            deltas = {}
+            for txid in set(itertools.chain(self.db.list_txi(), self.db.list_txo())):
+                delta = self._get_history_delta(txid)
+                if delta is not None:
+                    key = self.get_txpos(txid) + (txid,)
+                    self._history_key_of_tx[txid] = key
+                    deltas[key] = delta
+            self._history_keys = sorted(deltas)
+            self._history_deltas = [deltas[key] for key in self._history_keys]
+            self._history_balances = [0] * len(self._history_keys)
+            self._history_timestamps = [0] * len(self._history_keys)
+
+    def _get_history_delta(self, txid: str) -> Optional[int]:
+        """Effect of txid on the default domain, or None if it is not in its history."""
+        addrs = {addr for addr in itertools.chain(self.db.get_txi_addresses(txid), self.db.get_txo_addresses(txid))
+                 if self.is_mine(addr)}
+        if not addrs:
+            return None
+        return sum(self.get_tx_delta(txid, addr) for addr in addrs)
+
+    def _update_history_of_tx(self, txid: str) -> None:
+        """Moves txid to its place in the history index, with its current
+        delta, or removes it. Needs self.lock and self.transaction_lock."""
+        self._history_fees.pop(txid, None)
+        old_key = self._history_key_of_tx.pop(txid, None)
+        if old_key is not None:
+            i = bisect.bisect_left(self._history_keys, old_key)
+            del self._history_keys[i], self._history_deltas[i]
+            del self._history_balances[i], self._history_timestamps[i]
+            self._history_valid = min(self._history_valid, i)
+        delta = self._get_history_delta(txid)
+        if delta is None:
+            return
+        key = self.get_txpos(txid) + (txid,)
+        i = bisect.bisect_left(self._history_keys, key)
+        self._history_keys.insert(i, key)
+        self._history_deltas.insert(i, delta)
+        self._history_balances.insert(i, 0)
+        self._history_timestamps.insert(i, 0)
+        self._history_key_of_tx[txid] = key
+        self._history_valid = min(self._history_valid, i)
+
+    def _update_history_running_values(self) -> None:
+        i = self._history_valid
+        balance = self._history_balances[i - 1] if i else 0
+        timestamp = self._history_timestamps[i - 1] if i else 0
+        for j in range(i, len(self._history_keys)):
+            balance += self._history_deltas[j]
+            self._history_balances[j] = balance
+            timestamp = max(timestamp, self.get_tx_height(self._history_keys[j][-1]).timestamp or math.inf)
+            self._history_timestamps[j] = timestamp
+        self._history_valid = len(self._history_keys)
+
+    def get_history_len(self) -> int:
+        """Number of txs in the history of the default domain."""
+        return len(self._history_keys)
+
+    def get_history_position_at_timestamp(self, timestamp: float, *, inclusive: bool = True) -> int:
+        """Position in the history of the default domain of the first tx
+        with a block timestamp at or after timestamp (after it, if not
+        inclusive). Unconfirmed txs count as after any timestamp.
+        Timestamps are assumed to be monotonic, as in get_onchain_history.
+        """
+        with self.lock, self.transaction_lock:
+            self._update_history_running_values()
+            if inclusive:
+                return bisect.bisect_left(self._history_timestamps, timestamp)
+            return bisect.bisect_right(self._history_timestamps, timestamp)
+
+    def _get_history_from_index(self, start: Optional[int], stop: Optional[int]) -> Sequence[HistoryItem]:
+        with self.lock, self.transaction_lock:
+            self._update_history_running_values()
+            balance = self._history_balances[-1] if self._history_balances else 0
+            c, u, x = self.get_balance()
+            # fixme: this may happen if history is incomplete
+            if balance != c + u + x:
+                self.logger.warning("history not synchronized")
+                return []
+            history = []
+            for i in range(*slice(start, stop).indices(len(self._history_keys))):
+                txid = self._history_keys[i][-1]
+                tx_mined_status = self.get_tx_height(txid)
+                if txid in self._history_fees:
+                    fee = self._history_fees[txid]
+                else:
+                    fee = self.get_tx_fee(txid)
+                    if tx_mined_status.conf > 0:
+                        self._history_fees[txid] = fee
+                history.append(HistoryItem(txid=txid,
+                                           tx_mined_status=tx_mined_status,
+                                           delta=self._history_deltas[i],
+                                           fee=fee,
+                                           balance=self._history_balances[i]))
+            return history
+
     def get_addr_io(self, address):
         with self.lock, self.transaction_lock:
             h = self.get_address_history(address)
@@ -760,19 +1016,16 @@ class AddressSynchronizer(Logger):
         return received, sent
 
     def get_addr_utxo(self, address: str) -> Dict[TxOutpoint, PartialTxInput]:
-        coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
         out = {}
-        for prevout_str, v in coins.items():
-            tx_height, value, is_cb = v
-            prevout = TxOutpoint.from_str(prevout_str)
-            utxo = PartialTxInput(prevout=prevout,
-                                  is_coinbase_output=is_cb)
-            utxo._trusted_address = address
-            utxo._trusted_value_sats = value
-            utxo.block_height = tx_height
-            out[prevout] = utxo
+        with self.lock, self.transaction_lock:
+            for prevout_str, (value, is_cb) in self._utxos.get(address, {}).items():
+                prevout = TxOutpoint.from_str(prevout_str)
+                utxo = PartialTxInput(prevout=prevout,
+                                      is_coinbase_output=is_cb)
+                utxo._trusted_address = address
+                utxo._trusted_value_sats = value
+                utxo.block_height = self.get_tx_height(prevout.txid.hex()).height
+                out[prevout] = utxo
         return out
 
     # return the total amount ever received by an address
@@ -785,37 +1038,18 @@ class AddressSynchronizer(Logger):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        if not excluded_coins:  # cache is only used if there are no excluded_coins
-            cached_value = self._get_addr_balance_cache.get(address)
-            if cached_value:
-                return cached_value
         if excluded_coins is None:
             excluded_coins = set()
         assert isinstance(excluded_coins, set), f"excluded_coins should be set, not {type(excluded_coins)}"
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
-        mempool_height = self.get_local_height() + 1  # height of next block
-        for txo, (tx_height, v, is_cb) in received.items():
-            if txo in excluded_coins:
-                continue
-            if is_cb and tx_height + constants.net.COINBASE_MATURITY > mempool_height:
-                x += v
-            elif tx_height > 0:
-                c += v
-            else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        result = c, u, x
-        # cache result.
-        if not excluded_coins:
-            # Cache needs to be invalidated if a transaction is added to/
-            # removed from history; or on new blocks (maturity...)
-            self._get_addr_balance_cache[address] = result
-        return result
+        with self.lock, self.transaction_lock:
+            self._update_coins_local_height()
+            c, u, x = self._balances.get(address, (0, 0, 0))
+            if excluded_coins:
+                coins = self._coins.get(address, {})
+                for txo in excluded_coins & coins.keys():
+                    dc, du, dx = coins[txo]
+                    c, u, x = c - dc, u - du, x - dx
+        return c, u, x
 
     @with_local_height_cached
     def get_utxos(self, domain=None, *, excluded_addresses=None,
@@ -823,7 +1057,7 @@ class AddressSynchronizer(Logger):
                   nonlocal_only: bool = False) -> Sequence[PartialTxInput]:
         coins = []
         if domain is None:
-            domain = self.get_addresses()
+            domain = self._get_addresses_with_utxos()
         domain = set(domain)
         if excluded_addresses:
             domain = set(domain) - set(excluded_addresses)
@@ -845,7 +1079,7 @@ class AddressSynchronizer(Logger):
     def get_balance(self, domain=None, *, excluded_addresses: Set[str] = None,
                     excluded_coins: Set[str] = None) -> Tuple[int, int, int]:
         if domain is None:
-            domain = self.get_addresses()
+            domain = self._get_addresses_with_balance()
         if excluded_addresses is None:
             excluded_addresses = set()
         assert isinstance(excluded_addresses, set), f"excluded_addresses should be set, not {type(excluded_addresses)}"
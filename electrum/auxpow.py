@@ -94,6 +94,9 @@ def get_chain_id(base_header):
 def deserialize_auxpow_header(base_header, s, start_position=0) -> (dict, int):
     """Deserialises an AuxPoW instance.
 
+    s may be a memoryview over a whole chunk; only the coinbase and the
+    parent header are copied out of it.
+
     Returns the deserialised AuxPoW dict and the end position in the byte
     array as a pair."""
     auxpow_header = {}
@@ -103,9 +106,7 @@ def deserialize_auxpow_header(base_header, s, start_position=0) -> (dict, int):
 
     # The parent coinbase transaction is first.
     # Deserialize it and save the trailing data.
-    parent_coinbase_tx = Transaction(s, expect_trailing_data=True, copy_input=False, start_position=start_position)
-    parent_coinbase_tx._allow_zero_outputs = True
-    start_position = fast_tx_deserialize(parent_coinbase_tx)
+    parent_coinbase_tx, start_position = deserialize_coinbase_tx(s, start_position=start_position)
     auxpow_header['parent_coinbase_tx'] = parent_coinbase_tx
 
     # Next is the parent block hash.  According to the Bitcoin.it wiki,
@@ -118,7 +119,7 @@ def deserialize_auxpow_header(base_header, s, start_position=0) -> (dict, int):
     auxpow_header['chain_merkle_branch'], auxpow_header['chain_merkle_index'], start_position = deserialize_merkle_branch(s, start_position=start_position)
     
     # Finally there's the parent header.  Deserialize it.
-    parent_header_bytes = s[start_position : start_position + constants.net.HEADER_SIZE]
+    parent_header_bytes = bytes(s[start_position : start_position + constants.net.HEADER_SIZE])
     auxpow_header['parent_header'] = blockchain.deserialize_pure_header(parent_header_bytes, None)
     start_position += constants.net.HEADER_SIZE
     # The parent block header doesn't have any block height,
@@ -127,6 +128,93 @@ def deserialize_auxpow_header(base_header, s, start_position=0) -> (dict, int):
 
     return auxpow_header, start_position
 
+def deserialize_coinbase_tx(s, start_position=0) -> (Transaction, int):
+    """Deserialises the parent coinbase transaction of an AuxPoW.
+
+    Only the inputs are parsed.  The outputs are skipped over and replaced
+    by placeholders, since AuxPoW verification never looks at them (and
+    they need not be valid).
+
+    Returns the transaction and the end position in the byte array as a
+    pair."""
+    vds = BCDataStream()
+    vds.input = s
+    vds.read_cursor = start_position
+
+    version = vds.read_int32()
+    n_vin = vds.read_compact_size()
+    is_segwit = (n_vin == 0)
+    if is_segwit:
+        marker = vds.read_bytes(1)
+        if marker != b'\x01':
+            raise transaction.SerializationError('invalid txn marker byte: {}'.format(marker))
+        n_vin = vds.read_compact_size()
+    if n_vin < 1:
+        raise transaction.SerializationError('tx needs to have at least 1 input')
+    inputs = [transaction.parse_input(vds) for i in range(n_vin)]
+    n_vout = vds.read_compact_size()
+    outputs = []
+    for i in range(n_vout):
+        vds.read_cursor += 8  # value
+        script_len = vds.read_compact_size()
+        vds.read_cursor += script_len  # scriptpubkey
+        outputs.append(TxOutput(value=0, scriptpubkey=b''))
+    if is_segwit:
+        for txin in inputs:
+            transaction.parse_witness(vds, txin)
+    locktime = vds.read_uint32()
+
+    tx = Transaction(bytes(s[start_position:vds.read_cursor]))
+    tx._version = version
+    tx._inputs = inputs
+    tx._outputs = outputs
+    tx._locktime = locktime
+    return tx, vds.read_cursor
+
+def skip_auxpow_header(s, start_position=0) -> int:
+    """Returns the end position of the AuxPoW at start_position in the
+    byte array, without deserialising it."""
+    vds = BCDataStream()
+    vds.input = s
+    vds.read_cursor = start_position
+
+    # The parent coinbase transaction.
+    vds.read_cursor += 4  # version
+    n_vin = vds.read_compact_size()
+    is_segwit = (n_vin == 0)
+    if is_segwit:
+        vds.read_cursor += 1  # marker
+        n_vin = vds.read_compact_size()
+    for i in range(n_vin):
+        vds.read_cursor += 36  # prevout
+        script_len = vds.read_compact_size()
+        vds.read_cursor += script_len + 4  # script_sig, nsequence
+    n_vout = vds.read_compact_size()
+    for i in range(n_vout):
+        vds.read_cursor += 8  # value
+        script_len = vds.read_compact_size()
+        vds.read_cursor += script_len  # scriptpubkey
+    if is_segwit:
+        for i in range(n_vin):
+            for j in range(vds.read_compact_size()):
+                item_len = vds.read_compact_size()
+                vds.read_cursor += item_len
+    vds.read_cursor += 4  # locktime
+
+    # The parent block hash.
+    vds.read_cursor += 32
+
+    # The coinbase and chain merkle branches, with their indices.
+    for i in range(2):
+        n_hashes = vds.read_compact_size()
+        vds.read_cursor += 32 * n_hashes + 4
+
+    # The parent header.
+    end = vds.read_cursor + constants.net.HEADER_SIZE
+    if end > len(s):
+        raise transaction.SerializationError('attempt to read past end of buffer')
+    return end
+
 # Copied from merkle_branch_from_string in https://github.com/electrumalt/electrum-doge/blob/f74312822a14f59aa8d50186baff74cade449ccd/lib/blockchain.py#L622
 # Returns list of hashes, merkle index, and position of trailing data in s
 # TODO: Audit this function carefully.
@@ -356,25 +444,3 @@ def verify_auxpow(header):
 # reserialize it.
 def fast_txid(tx):
     return bh2u(sha256d(tx._cached_network_ser_bytes)[::-1])
-
-# Used by fast_tx_deserialize
-def stub_parse_output(vds):
-    vds.read_int64() # value
-    vds.read_bytes(vds.read_compact_size()) # scriptpubkey
-    return TxOutput(value=0, scriptpubkey=b'')
-
-# This is equivalent to (tx.deserialize(), ), but doesn't parse outputs.
-def fast_tx_deserialize(tx):
-    # Monkeypatch output address parsing with a stub, since we only care about
-    # inputs.
-    real_parse_output, transaction.parse_output = transaction.parse_output, stub_parse_output
-
-    try:
-        result = tx.deserialize()
-    except Exception as exc:
-        print(exc)
-    finally:
-        # Restore the real output address parser.
-        transaction.parse_output = real_parse_output
-
-    return result
\ No newline at end of file
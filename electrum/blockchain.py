@@ -21,21 +21,43 @@
 # CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
 # SOFTWARE.
 import os
+import sys
+import mmap
+import hashlib
+import functools
+import itertools
+import json
+import multiprocessing
+import concurrent.futures
 import threading
 import time
-from typing import Optional, Dict, Mapping, Sequence
+from collections import deque
+from typing import Optional, Dict, Iterable, Iterator, List, Mapping, Sequence, Tuple
 
 from . import auxpow, constants, util
-from .bitcoin import hash_encode, int_to_hex, rev_hex
+from .bitcoin import hash_encode, hash_decode, int_to_hex, rev_hex
 from .crypto import sha256d
 from .exceptions import MissingHeader, InvalidHeader
-from .util import bfh, bh2u
+from .util import bfh, bh2u, LRUCache
 from .simple_config import SimpleConfig
 from .logging import get_logger, Logger
 
 
 _logger = get_logger(__name__)
 
+# number of deserialized headers kept in memory per chain
+HEADER_CACHE_SIZE = 4096
+# chainwork index: one record per retarget period, (blockhash at the
+# last height of the period, chainwork up to and including that block)
+CHAINWORK_RECORD_SIZE = 64
+# part of the name of chainwork index files; bumped when the records
+# written so far are wrong, so that they are recomputed
+CHAINWORK_INDEX_VERSION = 2
+# AuxPoW headers of a chunk are checked by worker processes, this many per task
+AUXPOW_VERIFY_BATCH_SIZE = 256
+# the hashes of headers this close to the highest known header are indexed
+HEADER_HASH_INDEX_DEPTH = 4096
+
 def serialize_header(header_dict: dict) -> str:
     s = int_to_hex(header_dict['version'], 4) \
         + rev_hex(header_dict['prev_block_hash']) \
@@ -69,12 +91,8 @@ def deserialize_full_header(s: bytes, height: int, expect_trailing_data=False, s
 
     original_start = start_position
 
-    pure_header_bytes = s[start_position : start_position + constants.net.HEADER_SIZE]
-    h = deserialize_pure_header(pure_header_bytes, height)
-    start_position += constants.net.HEADER_SIZE
-        
-    if issubclass(constants.net, constants.AuxPowMixin) and constants.net.is_auxpow_active(h) and height > constants.net.max_checkpoint():
-        h['auxpow'], start_position = auxpow.deserialize_auxpow_header(h, s, start_position=start_position)
+    header, start_position = PureHeader.from_stream(s, height, start_position)
+    h = header.to_dict()
 
     if expect_trailing_data:
         return h, start_position
@@ -86,6 +104,8 @@ def deserialize_full_header(s: bytes, height: int, expect_trailing_data=False, s
 def hash_header(header: dict) -> str:
     if header is None:
         return '0' * 64
+    if isinstance(header, PureHeader):
+        return header.hash_hex()
     if header.get('prev_block_hash') is None:
         header['prev_block_hash'] = '00'*32
     return hash_raw_header(serialize_header(header))
@@ -98,6 +118,325 @@ def hash_raw_header(header: str) -> str:
     return hash_encode(sha256d(bfh(header)))
 
 
+class PureHeader:
+    """A block header kept as the 80 bytes it was serialized to.
+
+    The block hash is computed from those bytes directly (and cached), as
+    32 bytes in internal byte order, so that headers can be chained and
+    checked without going through hex. Lookups such as header['bits']
+    still work; the dict of deserialize_pure_header is only built when a
+    hex field is needed, or by to_dict().
+    """
+    __slots__ = ('raw', 'height', 'auxpow', '_hash', '_dict')
+
+    _INT_FIELDS = {'version': 0, 'timestamp': 68, 'bits': 72, 'nonce': 76}
+
+    def __init__(self, raw: bytes, height: Optional[int]):
+        if len(raw) != constants.net.HEADER_SIZE:
+            raise InvalidHeader('Invalid header length: {}'.format(len(raw)))
+        self.raw = bytes(raw)
+        self.height = height
+        self.auxpow = None  # type: Optional[dict]
+        self._hash = None  # type: Optional[bytes]
+        self._dict = None  # type: Optional[dict]
+
+    @classmethod
+    def from_dict(cls, header: dict) -> 'PureHeader':
+        if header.get('prev_block_hash') is None:
+            header = dict(header, prev_block_hash='00'*32)
+        h = cls(bfh(serialize_header(header)), header.get('block_height'))
+        h.auxpow = header.get('auxpow')
+        return h
+
+    @classmethod
+    def from_stream(cls, s: bytes, height: int, start_position: int=0,
+                    parse_auxpow: bool=True) -> Tuple['PureHeader', int]:
+        """Reads a header at start_position of s, along with its AuxPoW
+        if it has one, and returns it with the position right after it.
+        If parse_auxpow is False, the AuxPoW is only skipped over."""
+        end = start_position + constants.net.HEADER_SIZE
+        if start_position >= len(s):
+            raise InvalidHeader('Invalid header: {}'.format(bytes(s[start_position:end])))
+        h = cls(s[start_position:end], height)
+        if issubclass(constants.net, constants.AuxPowMixin) and constants.net.is_auxpow_active(h) and height > constants.net.max_checkpoint():
+            if parse_auxpow:
+                h.auxpow, end = auxpow.deserialize_auxpow_header(h, s, start_position=end)
+            else:
+                end = auxpow.skip_auxpow_header(s, start_position=end)
+        return h, end
+
+    @property
+    def prev_hash(self) -> bytes:
+        return self.raw[4:36]
+
+    @property
+    def bits(self) -> int:
+        return int.from_bytes(self.raw[72:76], byteorder='little')
+
+    def hash(self) -> bytes:
+        if self._hash is None:
+            override = getattr(constants.net, 'hash_raw_header', None)
+            if override:
+                self._hash = hash_decode(override(bh2u(self.raw)))
+            else:
+                self._hash = hashlib.sha256(hashlib.sha256(self.raw).digest()).digest()
+        return self._hash
+
+    def hash_hex(self) -> str:
+        return hash_encode(self.hash())
+
+    def __getitem__(self, key):
+        offset = self._INT_FIELDS.get(key)
+        if offset is not None:
+            return int.from_bytes(self.raw[offset:offset+4], byteorder='little')
+        if key == 'block_height':
+            return self.height
+        if key == 'auxpow' and self.auxpow is not None:
+            return self.auxpow
+        if self._dict is None:
+            self._dict = deserialize_pure_header(self.raw, self.height)
+        return self._dict[key]
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def to_dict(self) -> dict:
+        """Returns a new header dict, that callers are free to mutate."""
+        if self._dict is None:
+            self._dict = deserialize_pure_header(self.raw, self.height)
+        h = dict(self._dict)
+        if self.auxpow is not None:
+            h['auxpow'] = self.auxpow
+        return h
+
+
+def check_proof_of_work(header: PureHeader, target: int) -> None:
+    _hash = header.hash()
+    if issubclass(constants.net, constants.AuxPowMixin) and constants.net.is_auxpow_active(header):
+        _hash = hash_decode(auxpow.hash_parent_header(header))
+
+    block_hash_as_num = int.from_bytes(_hash, byteorder='little')
+    if block_hash_as_num > target:
+        raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
+
+
+def verify_auxpow_batch(net, items: Sequence[Tuple[int, bytes, int]]) -> Optional[Tuple[int, str]]:
+    """Checks the AuxPoW and proof of work of headers whose linkage and
+    difficulty were already verified. Runs in the worker processes of
+    get_auxpow_executor; net is the network to use there.
+    items are (height, header followed by its AuxPoW, target).
+    Returns the height and error of the first header that fails, if any.
+    """
+    constants.net = net
+    for height, data, target in items:
+        try:
+            header, end = PureHeader.from_stream(data, height)
+            if end != len(data):
+                raise Exception('Invalid header length: {}'.format(len(data)))
+            check_proof_of_work(header, target)
+        except Exception as e:
+            return height, repr(e)
+    return None
+
+
+_auxpow_executor = None  # type: Optional[Tuple[int, concurrent.futures.ProcessPoolExecutor]]
+_auxpow_executor_lock = threading.Lock()
+
+
+def get_auxpow_executor(max_workers: int) -> concurrent.futures.ProcessPoolExecutor:
+    global _auxpow_executor
+    with _auxpow_executor_lock:
+        if _auxpow_executor is not None and _auxpow_executor[0] != max_workers:
+            _auxpow_executor[1].shutdown(wait=False)
+            _auxpow_executor = None
+        if _auxpow_executor is None:
+            # workers are started fresh rather than forked from a process with running threads
+            mp_context = multiprocessing.get_context('spawn')
+            executor = concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=mp_context)
+            _auxpow_executor = max_workers, executor
+        return _auxpow_executor[1]
+
+
+def drop_auxpow_executor() -> None:
+    global _auxpow_executor
+    with _auxpow_executor_lock:
+        if _auxpow_executor is not None:
+            _auxpow_executor[1].shutdown(wait=False)
+            _auxpow_executor = None
+
+
+class AuxPowBatchVerifier:
+    """Collects the AuxPoW headers of a chunk while it is being parsed,
+    and hands each full batch to the worker pool right away, so that
+    checking them overlaps with parsing the rest of the chunk.
+    Items hold memoryview slices of the chunk; they are only copied
+    when sent to another process. If nothing was sent to the pool,
+    the headers are checked in-process by finish().
+    """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.batch = []  # type: List[Tuple[int, memoryview, int]]
+        self.in_process = []  # type: List[Sequence[Tuple[int, memoryview, int]]]
+        self.submitted = []  # type: List[Tuple[Sequence[Tuple[int, bytes, int]], concurrent.futures.Future]]
+
+    def add(self, height: int, data: memoryview, target: int) -> None:
+        self.batch.append((height, data, target))
+        if len(self.batch) >= AUXPOW_VERIFY_BATCH_SIZE:
+            self._flush()
+
+    def _flush(self) -> None:
+        batch, self.batch = self.batch, []
+        if not batch:
+            return
+        if self.workers > 1:
+            items = [(height, bytes(data), target) for height, data, target in batch]
+            try:
+                future = get_auxpow_executor(self.workers).submit(verify_auxpow_batch, constants.net, items)
+            except concurrent.futures.process.BrokenProcessPool as e:
+                _logger.warning(f'auxpow worker pool broken, verifying in-process: {repr(e)}')
+                drop_auxpow_executor()
+                self.workers = 1
+            else:
+                self.submitted.append((items, future))
+                return
+        self.in_process.append(batch)
+
+    def finish(self) -> None:
+        """Waits for all batches, and raises for the lowest failing height."""
+        if self.submitted:
+            self._flush()
+        else:
+            # a single partial batch is not worth sending to the pool
+            self.in_process.append(self.batch)
+            self.batch = []
+        results = [verify_auxpow_batch(constants.net, batch) for batch in self.in_process if batch]
+        for items, future in self.submitted:
+            try:
+                results.append(future.result())
+            except concurrent.futures.process.BrokenProcessPool as e:
+                _logger.warning(f'auxpow worker pool broken, verifying in-process: {repr(e)}')
+                drop_auxpow_executor()
+                results.append(verify_auxpow_batch(constants.net, items))
+        failures = [r for r in results if r is not None]
+        if failures:
+            height, error = min(failures)
+            raise Exception(f"auxpow verification failed at height {height}: {error}")
+
+    def cancel(self) -> None:
+        for items, future in self.submitted:
+            future.cancel()
+
+
+class HeaderHashIndex:
+    """Maps the hashes of recent headers to the chain that stores them,
+    and their height, so that check_header and can_connect do not have
+    to ask every chain.
+    Every stored header at a height >= floor is indexed; the floor
+    follows the highest known header, HEADER_HASH_INDEX_DEPTH behind,
+    and never goes down. Entries are kept up to date by Blockchain.write
+    and rebuilt when chains swap.
+    """
+
+    def __init__(self, depth: int):
+        self.depth = depth
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        self.floor = 0
+        self._by_hash = {}  # type: Dict[bytes, Tuple[Blockchain, int]]
+        self._by_height = {}  # type: Dict[int, List[bytes]]
+
+    def get(self, header_hash: bytes) -> Optional[Tuple['Blockchain', int]]:
+        with self.lock:
+            return self._by_hash.get(header_hash)
+
+    def add_headers(self, chain: 'Blockchain', height: int, data: bytes,
+                    hashes: Sequence[bytes] = None) -> None:
+        """Indexes the raw headers in data, the first one being at height.
+        hashes, if given, are the hashes of those headers. Zero-filled
+        headers, i.e. missing ones, are skipped."""
+        size = constants.net.HEADER_SIZE
+        zero_header = bytes(size)
+        with self.lock:
+            first = max(0, self.floor - height)
+            for i in range(first, len(data) // size):
+                raw = data[i * size:(i + 1) * size]
+                if raw == zero_header:
+                    continue
+                header_hash = hashes[i] if hashes is not None else PureHeader(raw, height + i).hash()
+                self._add(chain, height + i, header_hash)
+
+    def add_hash(self, chain: 'Blockchain', height: int, header_hash: bytes) -> None:
+        with self.lock:
+            if height >= self.floor:
+                self._add(chain, height, header_hash)
+
+    def _add(self, chain: 'Blockchain', height: int, header_hash: bytes) -> None:
+        old = self._by_hash.get(header_hash)
+        if old is not None:
+            self._by_height[old[1]].remove(header_hash)
+        self._by_hash[header_hash] = chain, height
+        self._by_height.setdefault(height, []).append(header_hash)
+
+    def discard(self, chain: 'Blockchain', start: int, end: int=None) -> None:
+        """Removes the entries of chain in [start, end)."""
+        with self.lock:
+            if not self._by_height:
+                return
+            start = max(start, self.floor)
+            end = max(self._by_height) + 1 if end is None else end
+            for height in range(start, end):
+                hashes = self._by_height.get(height)
+                if not hashes:
+                    continue
+                for header_hash in [x for x in hashes if self._by_hash[x][0] is chain]:
+                    hashes.remove(header_hash)
+                    del self._by_hash[header_hash]
+
+    def raise_floor(self, tip_height: int) -> None:
+        with self.lock:
+            floor = tip_height - self.depth + 1
+            if floor <= self.floor:
+                return
+            if floor - self.floor < len(self._by_height):
+                heights = range(self.floor, floor)
+            else:
+                heights = [h for h in self._by_height if h < floor]
+            for height in heights:
+                for header_hash in self._by_height.pop(height, ()):
+                    del self._by_hash[header_hash]
+            self.floor = floor
+
+    def rebuild(self, chain: 'Blockchain') -> None:
+        """Re-indexes the headers stored by chain, from disk."""
+        self.discard(chain, 0)
+        for height in range(max(self.floor, chain.forkpoint), chain.height() + 1):
+            try:
+                header_hash = chain._get_hash_bytes(height)
+            except MissingHeader:
+                # e.g. in the zero-filled checkpoint region, not downloaded yet
+                continue
+            self.add_hash(chain, height, header_hash)
+
+
+header_hash_index = HeaderHashIndex(HEADER_HASH_INDEX_DEPTH)
+
+
+def get_chainwork_index_path(config: SimpleConfig, headers_path: str, *,
+                             version: Optional[int] = CHAINWORK_INDEX_VERSION) -> str:
+    """Path of the chainwork index of a headers file. Files written before
+    versions were introduced have version None."""
+    name = os.path.basename(headers_path)
+    if version is not None:
+        name = f'{name}.v{version}'
+    return os.path.join(util.get_headers_dir(config), 'chainwork', name)
+
+
 # key: blockhash hex at forkpoint
 # the chain at some key is the best chain that includes the given hash
 blockchains = {}  # type: Dict[str, Blockchain]
@@ -105,6 +444,7 @@ blockchains_lock = threading.RLock()
 
 
 def read_blockchains(config: 'SimpleConfig'):
+    header_hash_index.clear()
     best_chain = Blockchain(config=config,
                             forkpoint=0,
                             parent=None,
@@ -116,8 +456,10 @@ def read_blockchains(config: 'SimpleConfig'):
         header_after_cp = best_chain.read_header(constants.net.max_checkpoint()+1)
         if not header_after_cp or not best_chain.can_connect(header_after_cp, check_height=False, skip_auxpow=True):
             _logger.info("[blockchain] deleting best chain. cannot connect header after last cp to last cp.")
+            best_chain.close_mmap()
             os.unlink(best_chain.path())
             best_chain.update_size()
+            best_chain.truncate_chainwork_index(0)
     # forks
     fdir = os.path.join(util.get_headers_dir(config), 'forks')
     util.make_dir(fdir)
@@ -128,6 +470,10 @@ def read_blockchains(config: 'SimpleConfig'):
     def delete_chain(filename, reason):
         _logger.info(f"[blockchain] deleting chain {filename}: {reason}")
         os.unlink(os.path.join(fdir, filename))
+        for version in (CHAINWORK_INDEX_VERSION, None):
+            index_path = get_chainwork_index_path(config, filename, version=version)
+            if os.path.exists(index_path):
+                os.unlink(index_path)
 
     def instantiate_chain(filename):
         __, forkpoint, prev_hash, first_hash = filename.split('_')
@@ -153,9 +499,11 @@ def read_blockchains(config: 'SimpleConfig'):
         # consistency checks
         h = b.read_header(b.forkpoint)
         if first_hash != hash_header(h):
+            b.close_mmap()
             delete_chain(filename, "incorrect first hash for chain")
             return
         if not b.parent.can_connect(h, check_height=False):
+            b.close_mmap()
             delete_chain(filename, "cannot connect chain to parent")
             return
         chain_id = b.get_id()
@@ -165,21 +513,21 @@ def read_blockchains(config: 'SimpleConfig'):
     for filename in l:
         instantiate_chain(filename)
 
+    chains = list(blockchains.values())
+    header_hash_index.raise_floor(max(b.height() for b in chains))
+    for b in chains:
+        header_hash_index.rebuild(b)
+
 
 def get_best_chain() -> 'Blockchain':
     return blockchains[constants.net.GENESIS]
 
-# block hash -> chain work; up to and including that block
-_CHAINWORK_CACHE = {
-    "0000000000000000000000000000000000000000000000000000000000000000": 0,  # virtual block at height -1
-}  # type: Dict[str, int]
-
-
 def init_headers_file_for_best_chain():
     b = get_best_chain()
     filename = b.path()
     length = constants.net.HEADER_SIZE * len(constants.net.CHECKPOINTS) * 2016
     if not os.path.exists(filename) or os.path.getsize(filename) < length:
+        b.close_mmap()
         with open(filename, 'wb') as f:
             if length > 0:
                 f.seek(length - 1)
@@ -189,6 +537,155 @@ def init_headers_file_for_best_chain():
         b.update_size()
 
 
+def _iter_bootstrap_chunks(path: str) -> Iterator[Tuple[int, bytes, bool]]:
+    """Yields (index, data, stripped) for each chunk of headers in path,
+    in order. path is either a headers file as stored on disk (stripped
+    of AuxPoW), or a directory of <index>.chunk files as served by
+    servers."""
+    if os.path.isdir(path):
+        suffix = '.chunk'
+        indexes = sorted(int(name[:-len(suffix)]) for name in os.listdir(path)
+                         if name.endswith(suffix) and name[:-len(suffix)].isdigit())
+        for index in indexes:
+            with open(os.path.join(path, f'{index}{suffix}'), 'rb') as f:
+                yield index, f.read(), False
+    else:
+        chunk_size = 2016 * constants.net.HEADER_SIZE
+        with open(path, 'rb') as f:
+            index = 0
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                if len(data) % constants.net.HEADER_SIZE:
+                    raise Exception(f'{path} is truncated: {len(data)} bytes in chunk {index}')
+                yield index, data, True
+                index += 1
+
+
+def _read_ahead(items: Iterable):
+    """Iterates over items, fetching the next one in a thread meanwhile."""
+    items = iter(items)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(next, items, None)
+        while True:
+            item = future.result()
+            if item is None:
+                return
+            future = executor.submit(next, items, None)
+            yield item
+
+
+def _check_stripped_chunk(index: int, data: bytes) -> None:
+    if not issubclass(constants.net, constants.AuxPowMixin):
+        return
+    for i in range(len(data) // constants.net.HEADER_SIZE):
+        height = index * 2016 + i
+        if height <= constants.net.max_checkpoint():
+            continue
+        header = PureHeader(data[i * constants.net.HEADER_SIZE:(i + 1) * constants.net.HEADER_SIZE], height)
+        if constants.net.is_auxpow_active(header):
+            raise Exception(f'AuxPoW data missing for the header at height {height}; '
+                            f'merge-mined headers can only be imported from chunk files')
+
+
+def import_headers(path: str) -> int:
+    """Verifies the headers in path, and saves them to the best chain.
+    See Commands.bootstrap_headers for the formats. The AuxPoW of
+    merge-mined headers is verified by the worker processes of
+    get_auxpow_executor, while the next chunk is being read.
+    Returns the number of headers saved.
+    """
+    init_headers_file_for_best_chain()
+    chain = get_best_chain()
+    count = 0
+    for index, data, stripped in _read_ahead(_iter_bootstrap_chunks(path)):
+        if stripped:
+            if index < len(chain.checkpoints) and not any(data):
+                # part of the checkpointed region that was never downloaded
+                continue
+            _check_stripped_chunk(index, data)
+        try:
+            data, hashes = chain.verify_chunk(index, data)
+        except Exception as e:
+            raise Exception(f'cannot import chunk {index}: {repr(e)}') from e
+        last_height = index * 2016 + len(data) // constants.net.HEADER_SIZE - 1
+        if last_height <= chain.height():
+            existing = chain._read_pure_header(last_height)
+            if existing is not None and existing.raw == data[-constants.net.HEADER_SIZE:]:
+                # already there
+                continue
+        chain.save_chunk(index, data, hashes)
+        count += len(data) // constants.net.HEADER_SIZE
+    return count
+
+
+def export_headers(path: str) -> int:
+    """Writes the headers of the best chain to path, in the format of the
+    headers file. Returns the height of the last header."""
+    chain = get_best_chain()
+    with chain.lock:
+        if chain.size() == 0:
+            raise Exception('there are no headers to export')
+        remaining = chain.size() * constants.net.HEADER_SIZE
+        with open(chain.path(), 'rb') as src, open(path, 'wb') as dst:
+            while remaining > 0:
+                data = src.read(min(remaining, 64 * 2016 * constants.net.HEADER_SIZE))
+                if not data:
+                    break
+                dst.write(data)
+                remaining -= len(data)
+        return chain.height()
+
+
+class DifficultyContext:
+    """(timestamp, bits) of the most recent headers of a chain, kept in
+    memory so that retargeting does not have to re-read the window of
+    previous headers for every new header. Maintained incrementally as
+    headers are verified/saved, and reset whenever the chain is rewritten.
+    """
+
+    def __init__(self):
+        self.height = None  # type: Optional[int]  # height of the newest entry
+        self._entries = deque()  # type: deque  # oldest first
+        self._maxlen = 0
+
+    def reset(self) -> None:
+        self.height = None
+        self._entries.clear()
+
+    def seed(self, height: int, entries: Sequence[Tuple[int, int]]) -> None:
+        self._maxlen = max(self._maxlen, len(entries))
+        self._entries = deque(entries, maxlen=self._maxlen)
+        self.height = height
+
+    def append(self, height: int, header: dict) -> None:
+        if self.height is None:
+            return
+        if height != self.height + 1:
+            # rewriting the tail of the chain
+            drop = self.height - height + 1
+            if not 0 < drop < len(self._entries):
+                self.reset()
+                return
+            for _ in range(drop):
+                self._entries.pop()
+        self._entries.append((header['timestamp'], header['bits']))
+        self.height = height
+
+    def get(self, height: int, n: int) -> Optional[Sequence[Tuple[int, int]]]:
+        """Returns the n entries ending at height, newest first,
+        or None if they are not all in memory."""
+        if self.height is None or n <= 0:
+            return None
+        skip = self.height - height
+        if skip < 0 or skip + n > len(self._entries):
+            return None
+        entries = self._entries
+        last = len(entries) - 1 - skip
+        return [entries[i] for i in range(last, last - n, -1)]
+
+
 class Blockchain(Logger):
     """
     Manages blockchain headers and their verification
@@ -208,6 +705,15 @@ class Blockchain(Logger):
         self._forkpoint_hash = forkpoint_hash  # blockhash at forkpoint. "first hash"
         self._prev_hash = prev_hash  # blockhash immediately before forkpoint
         self.lock = threading.RLock()
+        # read-only view of the headers file. (re)created lazily by _read_raw_header,
+        # and dropped whenever the file is truncated, replaced or deleted.
+        self._mmap = None  # type: Optional[mmap.mmap]
+        self._header_cache = LRUCache(HEADER_CACHE_SIZE)  # height -> PureHeader
+        # headers of the chunk being verified by verify_chunk; height -> header dict
+        self._pending_headers = None  # type: Optional[Dict[int, PureHeader]]
+        self._pending_start = 0
+        self._difficulty = DifficultyContext()
+        self._chainwork_index = self._load_chainwork_index()
         self.update_size()
 
     def with_lock(func):
@@ -275,7 +781,7 @@ class Blockchain(Logger):
         """
         assert isinstance(header_hash, str) and len(header_hash) == 64, header_hash  # hex
         try:
-            return header_hash == self.get_hash(height)
+            return hash_decode(header_hash) == self._get_hash_bytes(height)
         except Exception:
             return False
 
@@ -310,52 +816,110 @@ class Blockchain(Logger):
     def update_size(self) -> None:
         p = self.path()
         self._size = os.path.getsize(p)//constants.net.HEADER_SIZE if os.path.exists(p) else 0
+        if self._mmap is not None and len(self._mmap) > self._size * constants.net.HEADER_SIZE:
+            self.close_mmap()
 
+    @with_lock
+    def close_mmap(self) -> None:
+        """Drops the memory map of the headers file, and everything derived
+        from the headers in it (decoded headers, difficulty context).
+        Must be called before the file is truncated, replaced or deleted."""
+        self._unmap()
+        self._header_cache.clear()
+        self._difficulty.reset()
+
+    def _unmap(self) -> None:
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
 
     def verify_header(self, header: dict, prev_hash: str, expected_header_hash: str=None, skip_auxpow: bool=False) -> None:
-        _hash = hash_header(header)
-        if expected_header_hash and expected_header_hash != _hash:
-            raise Exception("hash mismatches with expected: {} vs {}".format(expected_header_hash, _hash))
-        if prev_hash != header.get('prev_block_hash'):
-            raise Exception("prev hash mismatch: %s vs %s" % (prev_hash, header.get('prev_block_hash')))
+        if not isinstance(header, PureHeader):
+            header = PureHeader.from_dict(header)
+        expected_hash = hash_decode(expected_header_hash) if expected_header_hash else None
+        self._verify_header(header, hash_decode(prev_hash), expected_hash)
+
+    def _verify_header(self, header: PureHeader, prev_hash: bytes, expected_hash: Optional[bytes],
+                       check_pow: bool=True) -> Optional[int]:
+        """Same as verify_header, with hashes as bytes in internal byte order.
+        Returns the target the header has to meet (None for proof of stake).
+        If check_pow is False, checking the proof of work is up to the caller."""
+        _hash = header.hash()
+        if expected_hash is not None and expected_hash != _hash:
+            raise Exception("hash mismatches with expected: {} vs {}".format(hash_encode(expected_hash), hash_encode(_hash)))
+        if prev_hash != header.prev_hash:
+            raise Exception("prev hash mismatch: %s vs %s" % (hash_encode(prev_hash), hash_encode(header.prev_hash)))
 
         if issubclass(constants.net, constants.StakeMixin) and constants.net.is_pos_active(header):
-            return
+            return None
 
-        target = self.get_target(header['block_height'])
+        target = self.get_target(header.height)
         bits = self.target_to_bits(target)
-        if bits != header.get('bits'):
-            raise Exception("bits mismatch: %s vs %s" % (bits, header.get('bits')))
+        if bits != header.bits:
+            raise Exception("bits mismatch: %s vs %s" % (bits, header.bits))
 
-        if issubclass(constants.net, constants.AuxPowMixin) and constants.net.is_auxpow_active(header):
-            _hash = auxpow.hash_parent_header(header)
+        if check_pow:
+            check_proof_of_work(header, target)
+        return target
 
-        block_hash_as_num = int.from_bytes(bfh(_hash), byteorder='big')
-        if block_hash_as_num > target:
-            raise Exception(f"insufficient proof of work: {block_hash_as_num} vs target {target}")
+    def get_auxpow_workers(self) -> int:
+        if sys.version_info < (3, 7):
+            # ProcessPoolExecutor has no mp_context, and would fork the process
+            return 1
+        default = 1 if 'ANDROID_DATA' in os.environ else (os.cpu_count() or 1)
+        return max(1, int(self.config.get('auxpow_verify_workers', default)))
 
-    def verify_chunk(self, index: int, data: bytes) -> bytes:
+    @with_lock
+    def verify_chunk(self, index: int, data: bytes) -> Tuple[bytes, List[bytes]]:
+        """Verifies a chunk of headers. Returns it stripped of AuxPoW data,
+        and the hashes of its headers, to be passed to save_chunk.
+        Nothing is written to disk here. While verifying, the headers of the
+        chunk that are already verified are visible through read_header,
+        as if the chunk had been saved (so that retargeting can use them).
+        """
         stripped = bytearray()
+        hashes = []
         start_position = 0
         start_height = index * 2016
-        prev_hash = self.get_hash(start_height - 1)
-        i = 0
-        while start_position < len(data):
-            height = start_height + i
-            try:
-                expected_header_hash = self.get_hash(height)
-            except MissingHeader:
-                expected_header_hash = None
-
-            # Strip auxpow header for disk
-            stripped.extend(data[start_position:start_position+constants.net.HEADER_SIZE])
-
-            header, start_position = deserialize_full_header(data, index*2016 + i, expect_trailing_data=True, start_position=start_position)
-            self.verify_header(header, prev_hash, expected_header_hash)
-            self.save_header(header)
-            prev_hash = hash_header(header)
-            i = i + 1
-        return bytes(stripped)
+        prev_hash = self._get_hash_bytes(start_height - 1)
+        # headers and their AuxPoW are read in place, without copying the chunk
+        view = memoryview(data)
+        # the AuxPoW of merge-mined headers is checked in batches, possibly
+        # in parallel with parsing the rest of the chunk
+        auxpow_verifier = AuxPowBatchVerifier(self.get_auxpow_workers())
+        self._pending_start = start_height
+        self._pending_headers = {}
+        try:
+            i = 0
+            while start_position < len(view):
+                height = start_height + i
+                try:
+                    expected_header_hash = self._get_hash_bytes(height)
+                except MissingHeader:
+                    expected_header_hash = None
+
+                header_start = start_position
+                header, start_position = PureHeader.from_stream(view, height, start_position, parse_auxpow=False)
+                has_auxpow = start_position - header_start > constants.net.HEADER_SIZE
+                # Strip auxpow header for disk
+                stripped.extend(header.raw)
+                target = self._verify_header(header, prev_hash, expected_header_hash, check_pow=not has_auxpow)
+                if has_auxpow and target is not None:
+                    auxpow_verifier.add(height, view[header_start:start_position], target)
+                self._pending_headers[height] = header
+                self._difficulty.append(height, header)
+                prev_hash = header.hash()
+                hashes.append(prev_hash)
+                i = i + 1
+            auxpow_verifier.finish()
+        except BaseException:
+            auxpow_verifier.cancel()
+            # the context now contains headers that will not be saved
+            self._difficulty.reset()
+            raise
+        finally:
+            self._pending_headers = None
+        return bytes(stripped), hashes
 
     @with_lock
     def path(self):
@@ -371,13 +935,13 @@ class Blockchain(Logger):
         return os.path.join(d, filename)
 
     @with_lock
-    def save_chunk(self, index: int, chunk: bytes):
+    def save_chunk(self, index: int, chunk: bytes, hashes: Sequence[bytes] = None):
         assert index >= 0, index
         chunk_within_checkpoint_region = index < len(self.checkpoints)
         # chunks in checkpoint region are the responsibility of the 'main chain'
         if chunk_within_checkpoint_region and self.parent is not None:
             main_chain = get_best_chain()
-            main_chain.save_chunk(index, chunk)
+            main_chain.save_chunk(index, chunk, hashes)
             return
 
         delta_height = (index * 2016 - self.forkpoint)
@@ -386,9 +950,11 @@ class Blockchain(Logger):
         # (the part before is the responsibility of the parent)
         if delta_bytes < 0:
             chunk = chunk[-delta_bytes:]
+            if hashes is not None:
+                hashes = hashes[-delta_height:]
             delta_bytes = 0
         truncate = not chunk_within_checkpoint_region
-        self.write(chunk, delta_bytes, truncate)
+        self.write(chunk, delta_bytes, truncate, hashes=hashes)
         self.swap_with_parent()
 
     def swap_with_parent(self) -> None:
@@ -441,17 +1007,27 @@ class Blockchain(Logger):
         # swap parameters
         self.parent, parent.parent = parent.parent, self  # type: Optional[Blockchain], Optional[Blockchain]
         self.forkpoint, parent.forkpoint = parent.forkpoint, self.forkpoint
-        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, hash_raw_header(bh2u(parent_data[:constants.net.HEADER_SIZE]))
+        self._forkpoint_hash, parent._forkpoint_hash = parent._forkpoint_hash, PureHeader(parent_data[:constants.net.HEADER_SIZE], None).hash_hex()
         self._prev_hash, parent._prev_hash = parent._prev_hash, self._prev_hash
         # parent's new name
+        self.close_mmap()
+        parent.close_mmap()
         os.replace(child_old_name, parent.path())
         self.update_size()
         parent.update_size()
+        # the chainwork indexes follow the headers files
+        child_old_index = self.chainwork_index_path(child_old_name)
+        if os.path.exists(child_old_index):
+            os.unlink(child_old_index)
+        self._save_chainwork_index()
+        parent._save_chainwork_index()
         # update pointers
         blockchains.pop(child_old_id, None)
         blockchains.pop(parent_old_id, None)
         blockchains[self.get_id()] = self
         blockchains[parent.get_id()] = parent
+        header_hash_index.rebuild(self)
+        header_hash_index.rebuild(parent)
         return True
 
     def get_id(self) -> str:
@@ -466,11 +1042,17 @@ class Blockchain(Logger):
             raise FileNotFoundError('Cannot find headers file but headers_dir is there. Should be at {}'.format(path))
 
     @with_lock
-    def write(self, data: bytes, offset: int, truncate: bool=True) -> None:
+    def write(self, data: bytes, offset: int, truncate: bool=True, *,
+              hashes: Sequence[bytes] = None) -> None:
         filename = self.path()
         self.assert_headers_file_available(filename)
+        is_append = offset == self._size * constants.net.HEADER_SIZE
+        if not is_append:
+            # existing headers are being overwritten (or truncated away)
+            self.close_mmap()
+            self.truncate_chainwork_index(self.forkpoint + offset // constants.net.HEADER_SIZE)
         with open(filename, 'rb+') as f:
-            if truncate and offset != self._size * constants.net.HEADER_SIZE:
+            if truncate and not is_append:
                 f.seek(offset)
                 f.truncate()
             f.seek(offset)
@@ -478,6 +1060,10 @@ class Blockchain(Logger):
             f.flush()
             os.fsync(f.fileno())
         self.update_size()
+        height = self.forkpoint + offset // constants.net.HEADER_SIZE
+        header_hash_index.discard(self, height, None if truncate else height + len(data) // constants.net.HEADER_SIZE)
+        header_hash_index.raise_floor(self.height())
+        header_hash_index.add_headers(self, height, data, hashes)
 
     @with_lock
     def save_header(self, header: dict) -> None:
@@ -488,27 +1074,57 @@ class Blockchain(Logger):
         #assert delta == self.size(), (delta, self.size())
         assert len(data) == constants.net.HEADER_SIZE
         self.write(data, delta*constants.net.HEADER_SIZE)
+        # the header is likely to be needed again soon, e.g. for retargeting
+        self._header_cache[header.get('block_height')] = PureHeader(data, header.get('block_height'))
+        self._difficulty.append(header.get('block_height'), header)
         self.swap_with_parent()
 
+    @with_lock
+    def _read_raw_header(self, delta: int) -> bytes:
+        end = (delta + 1) * constants.net.HEADER_SIZE
+        if self._mmap is None or len(self._mmap) < end:
+            # the file has grown since it was mapped (or was never mapped)
+            self._unmap()
+            name = self.path()
+            self.assert_headers_file_available(name)
+            with open(name, 'rb') as f:
+                if os.fstat(f.fileno()).st_size < end:
+                    raise Exception('Expected to read a full header. File is too short for delta {}'.format(delta))
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return self._mmap[end - constants.net.HEADER_SIZE:end]
+
     @with_lock
     def read_header(self, height: int) -> Optional[dict]:
+        header = self._read_pure_header(height)
+        if header is None:
+            return None
+        # callers are allowed to mutate the returned dict
+        return header.to_dict()
+
+    @with_lock
+    def _read_pure_header(self, height: int) -> Optional[PureHeader]:
         if height < 0:
             return
+        if self._pending_headers is not None and height >= self._pending_start:
+            # verify_chunk in progress: the chunk being verified replaces
+            # everything on disk from its first header onwards
+            header = self._pending_headers.get(height)
+            if header is not None:
+                return header
+            if height > self._pending_start:
+                return None
         if height < self.forkpoint:
-            return self.parent.read_header(height)
+            return self.parent._read_pure_header(height)
         if height > self.height():
             return
-        delta = height - self.forkpoint
-        name = self.path()
-        self.assert_headers_file_available(name)
-        with open(name, 'rb') as f:
-            f.seek(delta * constants.net.HEADER_SIZE)
-            h = f.read(constants.net.HEADER_SIZE)
-            if len(h) < constants.net.HEADER_SIZE:
-                raise Exception('Expected to read a full header. This was only {} bytes'.format(len(h)))
-        if h == bytes([0])*constants.net.HEADER_SIZE:
-            return None
-        return deserialize_pure_header(h, height)
+        header = self._header_cache.get(height)
+        if header is None:
+            h = self._read_raw_header(height - self.forkpoint)
+            if h == bytes([0])*constants.net.HEADER_SIZE:
+                return None
+            header = PureHeader(h, height)
+            self._header_cache[height] = header
+        return header
 
     def header_at_tip(self) -> Optional[dict]:
         """Return latest header."""
@@ -530,28 +1146,48 @@ class Blockchain(Logger):
         return False
 
     def get_hash(self, height: int) -> str:
+        return hash_encode(self._get_hash_bytes(height))
+
+    def _get_hash_bytes(self, height: int) -> bytes:
+        """Same as get_hash, as bytes in internal byte order."""
         def is_height_checkpoint():
             within_cp_range = height <= constants.net.max_checkpoint()
             at_chunk_boundary = (height+1) % 2016 == 0
             return within_cp_range and at_chunk_boundary
 
         if height == -1:
-            return '0000000000000000000000000000000000000000000000000000000000000000'
+            return bytes(32)
         elif height == 0:
-            return constants.net.GENESIS
+            return hash_decode(constants.net.GENESIS)
         elif is_height_checkpoint():
             index = height // 2016
             h, t = self.checkpoints[index]
-            return h
+            return hash_decode(h)
         else:
-            header = self.read_header(height)
+            header = self._read_pure_header(height)
             if header is None:
                 raise MissingHeader(height)
-            return hash_header(header)
+            return header.hash()
 
     def get_target(self, height: int) -> int:
         return constants.net.get_target(height, self)
 
+    @with_lock
+    def get_difficulty_window(self, height: int, n: int) -> Sequence[Tuple[int, int]]:
+        """Returns (timestamp, bits) of the n headers ending at height,
+        newest first. Used by the retargeting code of the networks."""
+        window = self._difficulty.get(height, n)
+        if window is not None:
+            return window
+        entries = []
+        for h in range(height - n + 1, height + 1):
+            header = self.read_header(h)
+            if header is None:
+                raise MissingHeader(h)
+            entries.append((header['timestamp'], header['bits']))
+        self._difficulty.seed(height, entries)
+        return entries[::-1]
+
     @classmethod
     def bits_to_target(cls, bits: int) -> int:
         bitsN = (bits >> 24) & 0xff
@@ -563,6 +1199,7 @@ class Blockchain(Logger):
         return bitsBase << (8 * (bitsN-3))
 
     @classmethod
+    @functools.lru_cache(maxsize=256)
     def target_to_bits(cls, target: int) -> int:
         c = ("%064x" % target)[2:]
         while c[:2] == '00' and len(c) > 6:
@@ -575,8 +1212,7 @@ class Blockchain(Logger):
 
     def chainwork_of_header_at_height(self, height: int) -> int:
         """work done by single header at given height"""
-        chunk_idx = height // 2016 - 1
-        target = self.get_target(chunk_idx)
+        target = self.get_target(height)
         work = ((2 ** 256 - target - 1) // (target + 1)) + 1
         return work
 
@@ -588,25 +1224,85 @@ class Blockchain(Logger):
             # On testnet/regtest, difficulty works somewhat different.
             # It's out of scope to properly implement that.
             return height
-        last_retarget = height // 2016 * 2016 - 1
-        cached_height = last_retarget
-        while _CHAINWORK_CACHE.get(self.get_hash(cached_height)) is None:
-            if cached_height <= -1:
+        num_periods = height // 2016
+        # latest retarget period with a valid record in the index
+        idx = min(num_periods, len(self._chainwork_index) // CHAINWORK_RECORD_SIZE)
+        running_total = 0
+        while idx > 0:
+            work = self._read_chainwork_record(idx - 1)
+            if work is not None:
+                running_total = work
                 break
-            cached_height -= 2016
-        assert cached_height >= -1, cached_height
-        running_total = _CHAINWORK_CACHE[self.get_hash(cached_height)]
-        while cached_height < last_retarget:
-            cached_height += 2016
-            work_in_single_header = self.chainwork_of_header_at_height(cached_height)
+            idx -= 1
+        while idx < num_periods:
+            last_height = (idx + 1) * 2016 - 1
+            work_in_single_header = self.chainwork_of_header_at_height(last_height)
             work_in_chunk = 2016 * work_in_single_header
             running_total += work_in_chunk
-            _CHAINWORK_CACHE[self.get_hash(cached_height)] = running_total
-        cached_height += 2016
-        work_in_single_header = self.chainwork_of_header_at_height(cached_height)
+            self._append_chainwork_record(idx, self.get_hash(last_height), running_total)
+            idx += 1
+        # the last header, as the ones after it may not exist yet
+        work_in_single_header = self.chainwork_of_header_at_height(height)
         work_in_last_partial_chunk = (height % 2016 + 1) * work_in_single_header
         return running_total + work_in_last_partial_chunk
 
+    def chainwork_index_path(self, headers_path: str = None) -> str:
+        """Path of the chainwork index of the headers file at headers_path,
+        by default the one of this chain."""
+        return get_chainwork_index_path(self.config, headers_path or self.path())
+
+    def _load_chainwork_index(self) -> bytearray:
+        path = self.chainwork_index_path()
+        # written by a previous version, with wrong values
+        old_path = get_chainwork_index_path(self.config, self.path(), version=None)
+        if os.path.exists(old_path):
+            os.unlink(old_path)
+        if not os.path.exists(path) or os.path.getsize(path) < CHAINWORK_RECORD_SIZE:
+            return bytearray()
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+            # ignore a partially written last record
+            return bytearray(m[:len(m) // CHAINWORK_RECORD_SIZE * CHAINWORK_RECORD_SIZE])
+
+    def _read_chainwork_record(self, idx: int) -> Optional[int]:
+        """Returns the chainwork up to the end of retarget period idx,
+        or None if the record is stale, in which case the index is
+        truncated there."""
+        offset = idx * CHAINWORK_RECORD_SIZE
+        record = self._chainwork_index[offset:offset + CHAINWORK_RECORD_SIZE]
+        if bh2u(record[:32]) != self.get_hash((idx + 1) * 2016 - 1):
+            self.truncate_chainwork_index((idx + 1) * 2016 - 1)
+            return None
+        return int.from_bytes(record[32:], byteorder='big')
+
+    def _append_chainwork_record(self, idx: int, block_hash: str, chainwork: int) -> None:
+        if len(self._chainwork_index) != idx * CHAINWORK_RECORD_SIZE:
+            return
+        record = bfh(block_hash) + chainwork.to_bytes(32, byteorder='big')
+        self._chainwork_index += record
+        path = self.chainwork_index_path()
+        util.make_dir(os.path.dirname(path))
+        with open(path, 'ab') as f:
+            f.write(record)
+
+    @with_lock
+    def truncate_chainwork_index(self, height: int) -> None:
+        """Drops the records of the retarget periods that end at or
+        after height, e.g. because the headers there are being replaced."""
+        length = height // 2016 * CHAINWORK_RECORD_SIZE
+        if len(self._chainwork_index) <= length:
+            return
+        del self._chainwork_index[length:]
+        path = self.chainwork_index_path()
+        if os.path.exists(path):
+            with open(path, 'rb+') as f:
+                f.truncate(length)
+
+    def _save_chainwork_index(self) -> None:
+        path = self.chainwork_index_path()
+        util.make_dir(os.path.dirname(path))
+        with open(path, 'wb') as f:
+            f.write(self._chainwork_index)
+
     def can_connect(self, header: dict, check_height: bool=True, skip_auxpow: bool=False) -> bool:
         if header is None:
             return False
@@ -616,13 +1312,15 @@ class Blockchain(Logger):
         if height == 0:
             return hash_header(header) == constants.net.GENESIS
         try:
-            prev_hash = self.get_hash(height - 1)
+            prev_hash = self._get_hash_bytes(height - 1)
+            if not isinstance(header, PureHeader):
+                header = PureHeader.from_dict(header)
         except:
             return False
-        if prev_hash != header.get('prev_block_hash'):
+        if prev_hash != header.prev_hash:
             return False
         try:
-            self.verify_header(header, prev_hash, skip_auxpow=skip_auxpow)	
+            self._verify_header(header, prev_hash, None)
         except BaseException as e:
             return False
         return True
@@ -631,28 +1329,78 @@ class Blockchain(Logger):
         assert idx >= 0, idx
         try:
             data = bfh(hexdata)
-            # verify_chunk also strips the AuxPoW headers
-            data = self.verify_chunk(idx, data)
-            self.save_chunk(idx, data)
+            # verify_chunk also strips the AuxPoW headers.
+            # the whole chunk is then written (and fsynced) at once
+            data, hashes = self.verify_chunk(idx, data)
+            self.save_chunk(idx, data, hashes)
             return True
         except BaseException as e:
             self.logger.info(f'verify_chunk idx {idx} failed: {repr(e)}')
+            self._difficulty.reset()
             return False
 
     def get_checkpoints(self):
-        # for each chunk, store the hash of the last block and the target after the chunk
-        cp = []
-        n = self.height() // 2016
-        for index in range(n):
-            h = self.get_hash((index+1) * 2016 -1)
-            target = self.get_target(index)
-            cp.append((h, target))
-        return cp
+        return list(self.iter_checkpoints())
+
+    def iter_checkpoints(self, start_index: int = 0) -> Iterator[Tuple[str, int]]:
+        """Yields a checkpoint for each complete chunk from start_index on:
+        the hash of its last block, and the target after it.
+        Only the headers around the chunk boundaries are read, in one pass."""
+        for index in range(start_index, self.height() // 2016):
+            next_height = (index + 1) * 2016
+            yield self.get_hash(next_height - 1), self.get_target(next_height)
+
+    def write_checkpoints(self, path: str, extend: bool = False) -> int:
+        """Writes the checkpoints of this chain to path, as JSON, one
+        checkpoint at a time. If extend is set, the checkpoints already in
+        path are kept (after checking that they belong to this chain), and
+        only the chunks after them are computed.
+        Returns the number of checkpoints written."""
+        checkpoints = []
+        if extend and os.path.exists(path):
+            with open(path, 'r', encoding='utf-8') as f:
+                checkpoints = json.load(f)
+            if checkpoints:
+                height = len(checkpoints) * 2016 - 1
+                header = self.read_header(height)
+                if header is None or hash_header(header) != checkpoints[-1][0]:
+                    raise Exception(f'{path} does not match this chain at height {height}')
+        tmp_path = path + '.tmp'
+        count = 0
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write('[')
+            for cp in itertools.chain(checkpoints, self.iter_checkpoints(len(checkpoints))):
+                # same layout as json.dumps(checkpoints, indent=4)
+                f.write(',' if count else '')
+                f.write('\n' + '\n'.join('    ' + line for line in json.dumps(list(cp), indent=4).split('\n')))
+                count += 1
+            f.write('\n]' if count else ']')
+        os.replace(tmp_path, path)
+        return count
+
+
+def _lookup_header_hash(header_hash: str, height: int) -> Tuple[Optional[Blockchain], bool]:
+    """Returns the chain that stores the header with the given hash at the
+    given height, and whether the answer is definitive (if not, the
+    header may be on a chain outside of the index)."""
+    found = header_hash_index.get(hash_decode(header_hash))
+    if found is not None:
+        chain, chain_height = found
+        with blockchains_lock:
+            registered = blockchains.get(chain.get_id()) is chain
+        if registered and chain_height == height and chain.check_hash(height, header_hash):
+            return chain, True
+    elif height >= header_hash_index.floor:
+        return None, True
+    return None, False
 
 
 def check_header(header: dict) -> Optional[Blockchain]:
     if type(header) is not dict:
         return None
+    chain, definitive = _lookup_header_hash(hash_header(header), header.get('block_height'))
+    if definitive:
+        return chain
     with blockchains_lock: chains = list(blockchains.values())
     for b in chains:
         if b.check_header(header):
@@ -661,6 +1409,14 @@ def check_header(header: dict) -> Optional[Blockchain]:
 
 
 def can_connect(header: dict) -> Optional[Blockchain]:
+    height = header['block_height']
+    if height > 0:
+        # only the chain storing the previous header can have it as its tip
+        chain, definitive = _lookup_header_hash(header['prev_block_hash'], height - 1)
+        if chain is not None:
+            return chain if chain.can_connect(header) else None
+        if definitive:
+            return None
     with blockchains_lock: chains = list(blockchains.values())
     for b in chains:
         if b.can_connect(header):
@@ -41,7 +41,7 @@ from typing import Optional, TYPE_CHECKING, Dict, List
 from .import constants, util, ecc
 from .util import bfh, bh2u, format_satoshis, json_decode, json_encode, is_hash256_str, is_hex_str, to_bytes, timestamp_to_datetime
 from .util import standardize_path
-from . import bitcoin
+from . import bitcoin, blockchain
 from .bitcoin import is_address,  hash_160
 from .bip32 import BIP32Node
 from .i18n import _
@@ -50,6 +50,7 @@ from .transaction import (Transaction, multisig_script, TxOutput, PartialTransac
 from .invoices import PR_PAID, PR_UNPAID, PR_UNKNOWN, PR_EXPIRED
 from .synchronizer import Notifier
 from .wallet import Abstract_Wallet, create_new_wallet, restore_wallet_from_text, Deterministic_Wallet
+from .wallet_sql_db import is_sql_wallet_file, convert_json_to_sql, convert_sql_to_json
 from .address_synchronizer import TX_HEIGHT_LOCAL
 from .mnemonic import Mnemonic
 from .lnutil import SENT, RECEIVED
@@ -209,8 +210,20 @@ class Commands:
             'default_wallet': self.config.get_wallet_path(),
             'fee_per_kb': self.config.fee_per_kb(),
         }
+        if self.network.tx_cache:
+            response['tx_cache'] = self.network.tx_cache.get_stats()
         return response
 
+    @command('n')
+    async def get_request_stats(self, reset=False):
+        """Count, errors, timeouts, bytes sent and received, and latency
+        histogram of the requests sent to servers, per server and method.
+        """
+        stats = self.network.request_metrics.to_json()
+        if reset:
+            self.network.request_metrics.reset()
+        return stats
+
     @command('n')
     async def stop(self):
         """Stop daemon"""
@@ -273,6 +286,18 @@ class Commands:
             'msg': d['msg'],
         }
 
+    @command('')
+    async def convert_wallet(self, new_path, password=None, wallet_path=None):
+        """Convert a wallet file between the json and sqlite formats.
+        The converted wallet is written to new_path; the original file is kept.
+        Storage encryption is removed, keystore encryption is kept.
+        """
+        if is_sql_wallet_file(wallet_path):
+            convert_sql_to_json(wallet_path, new_path)
+        else:
+            convert_json_to_sql(wallet_path, new_path, password=password)
+        return {'path': standardize_path(new_path)}
+
     @command('wp')
     async def password(self, password=None, new_password=None, wallet: Abstract_Wallet = None):
         """Change wallet password. """
@@ -1101,9 +1126,29 @@ class Commands:
         return await self.network.local_watchtower.sweepstore.get_ctn(channel_point, None)
 
     @command('n')
-    async def get_checkpoints(self, file_path, wallet: Abstract_Wallet = None):
+    async def get_checkpoints(self, file_path, extend=False, wallet: Abstract_Wallet = None):
         """ Dump checkpoints to a file """
-        return self.network.export_checkpoints(file_path)
+        return await asyncio.get_event_loop().run_in_executor(
+            None, partial(self.network.export_checkpoints, file_path, extend=extend))
+
+    @command('')
+    async def bootstrap_headers(self, path, export=False):
+        """Import block headers from a local file or directory, instead of
+        downloading them from servers. path is either a headers file as
+        stored by Electrum (raw headers from the genesis block on, without
+        AuxPoW), or a directory of chunk files named <index>.chunk, each
+        holding a chunk of 2016 raw headers as served by servers (with
+        AuxPoW). The headers are verified before they are saved. With
+        --export, the headers of the local best chain are written to path,
+        as a headers file. """
+        if self.network is None:
+            blockchain.read_blockchains(self.config)
+        if export:
+            return {'height': blockchain.export_headers(path)}
+        if self.network is not None:
+            raise Exception('Headers cannot be imported while the daemon is running. Use --offline.')
+        imported = await asyncio.get_event_loop().run_in_executor(None, blockchain.import_headers, path)
+        return {'imported': imported, 'height': blockchain.get_best_chain().height()}
 
 def eval_bool(x: str) -> bool:
     if x == 'false': return False
@@ -1130,6 +1175,7 @@ param_descriptions = {
     'requested_amount': 'Requested amount (in {code}).'.format(code=constants.net.SHORT_CODE),
     'outputs': 'list of ["address", amount]',
     'redeem_script': 'redeem script (hexadecimal)',
+    'new_path': 'Path of the converted wallet file',
 }
 
 command_options = {
@@ -1179,6 +1225,9 @@ command_options = {
     'iknowwhatimdoing': (None, "Acknowledge that I understand the full implications of what I am about to do"),
     'gossip':      (None, "Apply command to gossip node instead of wallet"),
     'file_path':   (None, "Path to save the network checkpoints"),
+    'export':      (None, "Export the headers of the local best chain instead of importing"),
+    'extend':      (None, "Extend the checkpoints already in file_path instead of recomputing them"),
+    'reset':       (None, "Reset the counters after reading them"),
 
 }
 
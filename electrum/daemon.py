@@ -46,8 +46,9 @@ from .util import (json_decode, to_bytes, to_string, profiler, standardize_path,
 from .invoices import PR_PAID, PR_EXPIRED
 from .util import log_exceptions, ignore_exceptions, randrange
 from .wallet import Wallet, Abstract_Wallet
-from .storage import WalletStorage
+from .storage import WalletStorage, get_journal_path
 from .wallet_db import WalletDB
+from .wallet_sql_db import SqlWalletStorage, SqlWalletDB, is_sql_wallet_file
 from .commands import known_commands, Commands
 from .simple_config import SimpleConfig
 from .exchange_rate import FxThread
@@ -464,15 +465,19 @@ class Daemon(Logger):
         if path in self._wallets:
             wallet = self._wallets[path]
             return wallet
-        storage = WalletStorage(path)
-        if not storage.file_exists():
-            return
-        if storage.is_encrypted():
-            if not password:
+        if is_sql_wallet_file(path):
+            storage = SqlWalletStorage(path)
+            db = SqlWalletDB(storage.read(), manual_upgrades=manual_upgrades)
+        else:
+            storage = WalletStorage(path)
+            if not storage.file_exists():
                 return
-            storage.decrypt(password)
-        # read data, pass it to db
-        db = WalletDB(storage.read(), manual_upgrades=manual_upgrades)
+            if storage.is_encrypted():
+                if not password:
+                    return
+                storage.decrypt(password)
+            # read data, pass it to db
+            db = WalletDB(storage.read(), manual_upgrades=manual_upgrades)
         if db.requires_split():
             return
         if db.requires_upgrade():
@@ -500,6 +505,9 @@ class Daemon(Logger):
         self.stop_wallet(path)
         if os.path.exists(path):
             os.unlink(path)
+            journal_path = get_journal_path(path)
+            if os.path.exists(journal_path):
+                os.unlink(journal_path)
             return True
         return False
 
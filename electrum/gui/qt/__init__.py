@@ -50,6 +50,7 @@ from electrum.util import (UserCancelled, profiler,
                            WalletFileException, BitcoinException, get_new_wallet_name)
 from electrum.wallet import Wallet, Abstract_Wallet
 from electrum.wallet_db import WalletDB
+from electrum.wallet_sql_db import SqlWalletStorage, SqlWalletDB
 from electrum.logging import Logger
 
 from .installwizard import InstallWizard, WalletAlreadyOpenInMemory
@@ -312,6 +313,9 @@ class ElectrumGui(Logger):
                 wizard.path = path  # needed by trustedcoin plugin
                 wizard.run('new')
                 storage, db = wizard.create_storage(path)
+            elif isinstance(storage, SqlWalletStorage):
+                db = SqlWalletDB(storage.read(), manual_upgrades=False)
+                wizard.run_upgrades(storage, db)
             else:
                 db = WalletDB(storage.read(), manual_upgrades=False)
                 wizard.run_upgrades(storage, db)
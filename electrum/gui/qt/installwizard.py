@@ -19,6 +19,7 @@ from PyQt5.QtWidgets import (QWidget, QDialog, QLabel, QHBoxLayout, QMessageBox,
 from electrum import constants
 from electrum.wallet import Wallet, Abstract_Wallet
 from electrum.storage import WalletStorage, StorageReadWriteError
+from electrum.wallet_sql_db import SqlWalletStorage, is_sql_wallet_file
 from electrum.util import UserCancelled, InvalidPassword, WalletFileException, get_new_wallet_name
 from electrum.base_wizard import BaseWizard, HWD_SETUP_DECRYPT_WALLET, GoBack, ReRunDialog
 from electrum.network import Network
@@ -251,6 +252,8 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
             try:
                 if wallet_from_memory:
                     temp_storage = wallet_from_memory.storage  # type: Optional[WalletStorage]
+                elif is_sql_wallet_file(path):
+                    temp_storage = SqlWalletStorage(path)
                 else:
                     temp_storage = WalletStorage(path)
             except (StorageReadWriteError, WalletFileException) as e:
@@ -383,7 +386,7 @@ class InstallWizard(QDialog, MessageBoxMixin, BaseWizard):
                     self.show_warning(_('The file was removed'))
                 return
             self.show()
-            self.data = json.loads(storage.read())
+            self.data = json.loads(db.dump())
             self.run(action)
             for k, v in self.data.items():
                 db.put(k, v)
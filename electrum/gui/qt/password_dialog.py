@@ -174,7 +174,7 @@ class PasswordLayout(object):
 
 class PasswordLayoutForHW(object):
 
-    def __init__(self, msg, wallet=None):
+    def __init__(self, msg, wallet=None, force_disable_encrypt_cb=False):
         self.wallet = wallet
 
         vbox = QVBoxLayout()
@@ -209,6 +209,7 @@ class PasswordLayoutForHW(object):
         vbox.addLayout(grid)
 
         self.encrypt_cb = QCheckBox(_('Encrypt wallet file'))
+        self.encrypt_cb.setEnabled(not force_disable_encrypt_cb)
         grid.addWidget(self.encrypt_cb, 1, 0, 1, 2)
 
         self.vbox = vbox
@@ -244,7 +245,7 @@ class ChangePasswordDialogForSW(ChangePasswordDialogBase):
 
     def __init__(self, parent, wallet):
         ChangePasswordDialogBase.__init__(self, parent, wallet)
-        if not wallet.has_password():
+        if not wallet.has_password() and wallet.can_have_storage_encryption():
             self.playout.encrypt_cb.setChecked(True)
 
     def create_password_layout(self, wallet, is_encrypted, OK_button):
@@ -257,11 +258,14 @@ class ChangePasswordDialogForSW(ChangePasswordDialogBase):
             else:
                 msg = _('Your wallet is password protected and encrypted.')
             msg += ' ' + _('Use this dialog to change your password.')
+        if not wallet.can_have_storage_encryption():
+            msg += '\n' + _('Note: sqlite wallet files cannot be encrypted.')
         self.playout = PasswordLayout(msg=msg,
                                       kind=PW_CHANGE,
                                       OK_button=OK_button,
                                       wallet=wallet,
-                                      force_disable_encrypt_cb=not wallet.can_have_keystore_encryption())
+                                      force_disable_encrypt_cb=(not wallet.can_have_keystore_encryption()
+                                                                or not wallet.can_have_storage_encryption()))
 
     def run(self):
         try:
@@ -284,7 +288,9 @@ class ChangePasswordDialogForHW(ChangePasswordDialogBase):
             msg = _('Your wallet file is encrypted.')
         msg += '\n' + _('Note: If you enable this setting, you will need your hardware device to open your wallet.')
         msg += '\n' + _('Use this dialog to toggle encryption.')
-        self.playout = PasswordLayoutForHW(msg)
+        if not wallet.can_have_storage_encryption():
+            msg += '\n' + _('Note: sqlite wallet files cannot be encrypted.')
+        self.playout = PasswordLayoutForHW(msg, force_disable_encrypt_cb=not wallet.can_have_storage_encryption())
 
     def run(self):
         if not self.exec_():
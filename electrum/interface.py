@@ -29,18 +29,19 @@ import sys
 import traceback
 import asyncio
 import socket
-from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple
+import time
+from typing import Tuple, Union, List, TYPE_CHECKING, Optional, Set, NamedTuple, Dict, Sequence
 from collections import defaultdict
 from ipaddress import IPv4Network, IPv6Network, ip_address, IPv6Address, IPv4Address
 import itertools
 import logging
+import bisect
 import hashlib
 
 import aiorpcx
-from aiorpcx import TaskGroup
 from aiorpcx import RPCSession, Notification, NetAddress, NewlineFramer
 from aiorpcx.curio import timeout_after, TaskTimeout
-from aiorpcx.jsonrpc import JSONRPC, CodeMessageError
+from aiorpcx.jsonrpc import JSONRPC, JSONRPCv2, JSONRPCConnection, CodeMessageError, Request, Batch
 from aiorpcx.rawsocket import RSClient
 import certifi
 
@@ -68,6 +69,10 @@ _KNOWN_NETWORK_PROTOCOLS = {'t', 's'}
 PREFERRED_NETWORK_PROTOCOL = 's'
 assert PREFERRED_NETWORK_PROTOCOL in _KNOWN_NETWORK_PROTOCOLS
 
+# max number of header chunks requested concurrently during catch-up.
+# can be overridden with the 'header_sync_max_inflight_chunks' config key
+HEADER_SYNC_MAX_INFLIGHT_CHUNKS = 4
+
 
 class NetworkTimeout:
     # seconds
@@ -80,6 +85,130 @@ class NetworkTimeout:
         RELAXED = 20
         MOST_RELAXED = 60
 
+# upper bounds, in seconds, of the buckets of request latency histograms;
+# the last bucket is for anything slower
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# requests that every interface sends, and that servers answer without
+# looking anything up: only these count in server scores, so that the
+# scores of the main interface and of the others can be compared
+SERVER_SCORE_METHODS = ('server.version', 'server.ping')
+
+
+class RequestStats:
+    """Counters of the requests of one method, sent to one server."""
+
+    __slots__ = ('count', 'errors', 'timeouts', 'bytes_out', 'bytes_in', 'latency_total', 'histogram')
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.bytes_out = 0
+        self.bytes_in = 0
+        self.latency_total = 0.0
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def to_json(self) -> dict:
+        answered = self.count - self.timeouts
+        buckets = [f"<={bound}s" for bound in LATENCY_BUCKETS] + [f">{LATENCY_BUCKETS[-1]}s"]
+        return {
+            'count': self.count,
+            'errors': self.errors,
+            'timeouts': self.timeouts,
+            'bytes_out': self.bytes_out,
+            'bytes_in': self.bytes_in,
+            'latency_avg': self.latency_total / answered if answered else None,
+            'latency_histogram': dict(zip(buckets, self.histogram)),
+        }
+
+
+class RequestMetrics:
+    """Request counters, per server and per method. Recording is cheap
+    enough to be always on."""
+
+    def __init__(self):
+        self._stats = {}  # type: Dict[Tuple[ServerAddr, str], RequestStats]
+
+    def record(self, server: 'ServerAddr', method: str, latency: Optional[float],
+               bytes_out: int, bytes_in: int, *, count: int = 1, errors: int = 0) -> None:
+        """latency is None for a timeout."""
+        key = (server, method)
+        stats = self._stats.get(key)
+        if stats is None:
+            stats = self._stats[key] = RequestStats()
+        stats.count += count
+        stats.errors += errors
+        stats.bytes_out += bytes_out
+        stats.bytes_in += bytes_in
+        if latency is None:
+            stats.timeouts += count
+        else:
+            stats.latency_total += latency * count
+            stats.histogram[bisect.bisect_left(LATENCY_BUCKETS, latency)] += count
+
+    def reset(self) -> None:
+        self._stats = {}
+
+    def to_json(self) -> Dict[str, Dict[str, dict]]:
+        out = defaultdict(dict)
+        for (server, method), stats in list(self._stats.items()):
+            out[str(server)][method] = stats.to_json()
+        return dict(out)
+
+
+def _check_aiorpcx_private_api() -> None:
+    """Request metering hooks into aiorpcx internals (the future factory of
+    JSONRPCConnection and RPCSession._send_concurrent). aiorpcx is pinned in
+    requirements.txt; fail at import rather than on every request if the
+    installed version does not have them.
+    """
+    missing = []
+    if not callable(getattr(RPCSession, '_send_concurrent', None)):
+        missing.append('RPCSession._send_concurrent')
+    if '_create_future' not in JSONRPCConnection._future.__code__.co_names:
+        missing.append('JSONRPCConnection._create_future')
+    if missing:
+        raise ImportError(f"unsupported aiorpcx version {aiorpcx._version_str}: "
+                          f"missing {', '.join(missing)}")
+
+
+_check_aiorpcx_private_api()
+
+
+class _MeteredFuture(asyncio.Future):
+    """Future of a request, that knows the size of the message its
+    response came in."""
+
+    def __init__(self, connection: '_MeteredConnection', *, loop):
+        super().__init__(loop=loop)
+        self._connection = connection
+        self.response_size = 0
+
+    def set_result(self, result):
+        self.response_size = self._connection.message_size
+        super().set_result(result)
+
+    def set_exception(self, exception):
+        self.response_size = self._connection.message_size
+        super().set_exception(exception)
+
+
+class _MeteredConnection(JSONRPCConnection):
+
+    def __init__(self, protocol):
+        super().__init__(protocol)
+        assert hasattr(self, '_create_future')
+        self.message_size = 0
+        loop = asyncio.get_event_loop()
+        self._create_future = lambda: _MeteredFuture(self, loop=loop)
+
+    def receive_message(self, message):
+        # responses are resolved while the message is processed
+        self.message_size = len(message)
+        return super().receive_message(message)
+
+
 class NotificationSession(RPCSession):
 
     def __init__(self, *args, **kwargs):
@@ -109,26 +238,79 @@ class NotificationSession(RPCSession):
             self.interface.logger.info(f"error handling request {request}. exc: {repr(e)}")
             await self.close()
 
-    async def send_request(self, *args, timeout=None, **kwargs):
+    def default_connection(self):
+        return _MeteredConnection(JSONRPCv2)
+
+    async def send_request(self, method, args=(), *, timeout=None):
         # note: semaphores/timeouts/backpressure etc are handled by
         # aiorpcx. the timeout arg here in most cases should not be set
         msg_id = next(self._msg_counter)
-        self.maybe_log(f"<-- {args} {kwargs} (id: {msg_id})")
+        self.maybe_log(f"<-- {(method, args)} (id: {msg_id})")
+        # as in RPCSession.send_request, keeping hold of the message and future
+        message, future = self.connection.send_request(Request(method, args))
+        start = time.monotonic()
         try:
-            # note: RPCSession.send_request raises TaskTimeout in case of a timeout.
+            # note: RPCSession._send_concurrent raises TaskTimeout in case of a timeout.
             # TaskTimeout is a subclass of CancelledError, which is *suppressed* in TaskGroups
             response = await asyncio.wait_for(
-                super().send_request(*args, **kwargs),
+                self._send_concurrent(message, future, 1),
                 timeout)
         except (TaskTimeout, asyncio.TimeoutError) as e:
-            raise RequestTimedOut(f'request timed out: {args} (id: {msg_id})') from e
+            self._record(method, None, message, future)
+            raise RequestTimedOut(f'request timed out: {(method, args)} (id: {msg_id})') from e
         except CodeMessageError as e:
+            self._record(method, time.monotonic() - start, message, future, errors=1)
             self.maybe_log(f"--> {repr(e)} (id: {msg_id})")
             raise
         else:
+            self._record(method, time.monotonic() - start, message, future)
             self.maybe_log(f"--> {response} (id: {msg_id})")
             return response
 
+    def _record(self, method: str, latency: Optional[float], message: bytes,
+                future: asyncio.Future, *, count: int = 1, errors: int = 0) -> None:
+        """Adds a request to the metrics, and, for SERVER_SCORE_METHODS,
+        to the server score. latency is None for a timeout."""
+        interface = self.interface
+        if not interface:
+            return
+        network = interface.network
+        bytes_in = getattr(future, 'response_size', 0)
+        network.request_metrics.record(interface.server, method, latency, len(message), bytes_in,
+                                       count=count, errors=errors)
+        if method not in SERVER_SCORE_METHODS:
+            return
+        if latency is None:
+            network.record_server_failure(interface.server)
+        else:
+            network.record_server_latency(interface.server, latency)
+
+    async def send_request_batch(self, requests: Sequence[Tuple[str, List]], *, timeout=None) -> List:
+        """Sends (method, params) requests as a single JSON-RPC batch.
+        The results are returned in the same order as the requests; error
+        responses are returned in place of their result, not raised.
+        """
+        msg_id = next(self._msg_counter)
+        self.maybe_log(f"<-- batch of {len(requests)}: {requests} (id: {msg_id})")
+        # as in BatchRequest, keeping hold of the message and future
+        batch = Batch([Request(method, params) for method, params in requests])
+        message, future = self.connection.send_batch(batch)
+        methods = {method for method, params in requests}
+        method = methods.pop() if len(methods) == 1 else 'batch'
+        start = time.monotonic()
+        try:
+            results = await asyncio.wait_for(
+                self._send_concurrent(message, future, len(batch)),
+                timeout)
+        except (TaskTimeout, asyncio.TimeoutError) as e:
+            self._record(method, None, message, future, count=len(batch))
+            raise RequestTimedOut(f'request timed out: batch of {len(requests)} (id: {msg_id})') from e
+        # the latency of the batch is counted for each of its requests
+        errors = sum(isinstance(result, Exception) for result in results)
+        self._record(method, time.monotonic() - start, message, future, count=len(batch), errors=errors)
+        self.maybe_log(f"--> {results} (id: {msg_id})")
+        return list(results)
+
     def set_default_timeout(self, timeout):
         self.sent_request_timeout = timeout
         self.max_send_delay = timeout
@@ -145,6 +327,31 @@ class NotificationSession(RPCSession):
             self.cache[key] = result
         await queue.put(params + [result])
 
+    async def subscribe_batch(self, method: str, params_list: Sequence[List],
+                              queue: asyncio.Queue) -> List[Optional[Exception]]:
+        """Like subscribe, for several subscriptions to the same method.
+        The ones not in the cache yet are sent as a single batch.
+        Returns, for each params, None or the error the server returned
+        (nothing is put in the queue for those).
+        """
+        keys = [self.get_hashable_key_for_rpc_call(method, params) for params in params_list]
+        for key in keys:
+            if queue not in self.subscriptions[key]:
+                self.subscriptions[key].append(queue)
+        errors = [None] * len(keys)  # type: List[Optional[Exception]]
+        missing = [i for i, key in enumerate(keys) if key not in self.cache]
+        if missing:
+            results = await self.send_request_batch([(method, params_list[i]) for i in missing])
+            for i, result in zip(missing, results):
+                if isinstance(result, Exception):
+                    errors[i] = result
+                else:
+                    self.cache[keys[i]] = result
+        for params, key, error in zip(params_list, keys, errors):
+            if error is None:
+                await queue.put(params + [self.cache[key]])
+        return errors
+
     def unsubscribe(self, queue):
         """Unsubscribe a callback to free object references to enable GC."""
         # note: we can't unsubscribe from the server, so we keep receiving
@@ -168,6 +375,118 @@ class NotificationSession(RPCSession):
         return NewlineFramer(max_size=constants.net.MAX_INCOMING_MSG_SIZE)
 
 
+# when the main interface changes, scripthash subscriptions
+# are sent again to the new server in batches of this size
+RESUBSCRIBE_BATCH_SIZE = 100
+
+
+class ScripthashSubscriptions:
+    """Scripthash subscriptions shared by all the synchronizers of a
+    network (wallets, watchers, notifiers). Each scripthash is subscribed
+    to once on the main interface, however many consumers watch it, and
+    its statuses are fanned out to the queues of all of them.
+    When the main interface changes, everything is resubscribed in bulk.
+    """
+
+    METHOD = 'blockchain.scripthash.subscribe'
+
+    def __init__(self):
+        self._queues = defaultdict(list)  # type: Dict[str, List[asyncio.Queue]]
+        self._session = None  # type: Optional[NotificationSession]
+        self._session_statuses = None  # type: Optional[_SessionStatuses]
+        self._statuses = {}  # type: Dict[str, Optional[str]]  # for the current session
+        self._pending = {}  # type: Dict[str, asyncio.Future]  # scripthash -> future of its batch
+
+    async def switch_interface(self, interface: 'Interface') -> None:
+        self._session = session = interface.session
+        self._session_statuses = _SessionStatuses(self, session)
+        self._statuses = {}
+        self._pending = {}
+        hashes = list(self._queues)
+        for i in range(0, len(hashes), RESUBSCRIBE_BATCH_SIZE):
+            batch = hashes[i:i + RESUBSCRIBE_BATCH_SIZE]
+            fut = self._set_pending(batch)
+            await interface.taskgroup.spawn(self._request(session, batch, fut))
+
+    async def subscribe(self, hashes: Sequence[str], queue: asyncio.Queue) -> List[Optional[Exception]]:
+        """Puts [scripthash, status] in queue for each of hashes, now and
+        on every status change. Returns, for each scripthash, None or the
+        error the server returned.
+        """
+        session = self._session
+        assert session is not None, 'no main interface'
+        for h in hashes:
+            if queue not in self._queues[h]:
+                self._queues[h].append(queue)
+        known = [h for h in hashes if h in self._statuses]
+        waiting = {h: self._pending[h] for h in hashes if h in self._pending}
+        to_send = [h for h in hashes if h not in self._statuses and h not in waiting]
+        if to_send:
+            fut = self._set_pending(to_send)
+            waiting.update((h, fut) for h in to_send)
+            await self._request(session, to_send, fut)
+        for h in known:
+            await queue.put([h, self._statuses[h]])
+        # statuses of the others were put in queue as they arrived
+        errors = []
+        for h in hashes:
+            error = (await waiting[h])[h] if h in waiting else None
+            if error is not None and not isinstance(error, CodeMessageError):
+                raise error
+            errors.append(error)
+        return errors
+
+    def unsubscribe(self, queue: asyncio.Queue) -> None:
+        # note: we can't unsubscribe from the server
+        for h, queues in list(self._queues.items()):
+            if queue in queues:
+                queues.remove(queue)
+                if not queues:
+                    self._queues.pop(h)
+                    self._statuses.pop(h, None)
+
+    def _set_pending(self, hashes: Sequence[str]) -> asyncio.Future:
+        fut = asyncio.get_event_loop().create_future()
+        for h in hashes:
+            self._pending[h] = fut
+        return fut
+
+    async def _request(self, session: NotificationSession, hashes: Sequence[str], fut: asyncio.Future) -> None:
+        # the result of fut maps each scripthash to None or its error
+        statuses = self._session_statuses
+        try:
+            errors = await session.subscribe_batch(self.METHOD, [[h] for h in hashes], statuses)
+        except BaseException as e:
+            fut.set_result({h: e for h in hashes})
+            raise
+        else:
+            fut.set_result(dict(zip(hashes, errors)))
+        finally:
+            for h in hashes:
+                if self._pending.get(h) is fut:
+                    self._pending.pop(h)
+
+    async def _on_status(self, session: NotificationSession, h: str, status: Optional[str]) -> None:
+        if session is not self._session or h not in self._queues:
+            return
+        self._statuses[h] = status
+        for queue in list(self._queues[h]):
+            await queue.put([h, status])
+
+
+class _SessionStatuses:
+    """Stands in for a subscription queue in the session; passes the
+    statuses it receives to the ScripthashSubscriptions."""
+
+    def __init__(self, subscriptions: ScripthashSubscriptions, session: NotificationSession):
+        self.subscriptions = subscriptions
+        self.session = session
+
+    async def put(self, args):
+        h, status = args
+        await self.subscriptions._on_status(self.session, h, status)
+
+
 class NetworkException(Exception): pass
 
 
@@ -531,6 +850,13 @@ class Interface(Logger):
         if can_return_early and index in self._requested_chunks:
             return
         self.logger.info(f"requesting chunk from height {height}")
+        res = await self._fetch_chunk(index, tip)
+        conn = self.blockchain.connect_chunk(index, res['hex'])
+        if not conn:
+            return conn, 0
+        return conn, res['count']
+
+    async def _fetch_chunk(self, index: int, tip=None) -> dict:
         size = 2016
         if tip is not None:
             size = min(size, tip - index * 2016 + 1)
@@ -540,13 +866,87 @@ class Interface(Logger):
             if index * 2016 + size - 1 > cp_height:
                 cp_height = 0
             self._requested_chunks.add(index)
-            res = await self.session.send_request('blockchain.block.headers', [index * 2016, size, cp_height])
+            return await self.session.send_request('blockchain.block.headers', [index * 2016, size, cp_height])
         finally:
             self._requested_chunks.discard(index)
-        conn = self.blockchain.connect_chunk(index, res['hex'])
-        if not conn:
-            return conn, 0
-        return conn, res['count']
+
+    def _get_interfaces_for_header_sync(self) -> List['Interface']:
+        """Returns the interfaces chunks can be downloaded from; self first."""
+        with self.network.interfaces_lock:
+            interfaces = list(self.network.interfaces.values())
+        others = [iface for iface in interfaces
+                  if iface is not self
+                  and iface.ready.done() and not iface.ready.cancelled()
+                  and iface.session and not iface.session.is_closing()]
+        return [self] + others
+
+    async def request_chunks_pipelined(self, height: int, tip: int) -> Tuple[bool, int]:
+        """Downloads and connects the chunks covering height..tip.
+
+        Several chunk requests are kept in flight, spread over all connected
+        interfaces, but chunks are connected strictly in order. A chunk from
+        another server that does not connect is requested again from this
+        interface before giving up.
+        Returns whether at least one chunk connected, and the height of the
+        first header that was not connected.
+        """
+        first_index, last_index = height // 2016, tip // 2016
+        max_inflight = max(1, self.network.config.get('header_sync_max_inflight_chunks',
+                                                      HEADER_SYNC_MAX_INFLIGHT_CHUNKS))
+        interfaces = self._get_interfaces_for_header_sync()
+        fetched = {}  # type: Dict[int, Tuple[Interface, asyncio.Future]]  # reordering buffer
+
+        def fetch_next(index: int) -> None:
+            # only full chunks are requested from other servers
+            candidates = [iface for iface in interfaces
+                          if iface is self or (index < last_index and iface.tip >= (index + 1) * 2016 - 1)]
+            iface = candidates[(index - first_index) % len(candidates)]
+            fetched[index] = iface, asyncio.ensure_future(iface._fetch_chunk(index, tip))
+
+        next_to_fetch = first_index
+        connected_any = False
+        try:
+            for index in range(first_index, last_index + 1):
+                while next_to_fetch <= last_index and len(fetched) < max_inflight:
+                    fetch_next(next_to_fetch)
+                    next_to_fetch += 1
+                iface, fut = fetched.pop(index)
+                res = None
+                if iface is self:
+                    res = await fut
+                else:
+                    # the request is cancelled if the session of iface closes.
+                    # wait() does not raise then, only if we are cancelled.
+                    try:
+                        await asyncio.wait([fut])
+                    except asyncio.CancelledError:
+                        fut.cancel()
+                        raise
+                    if fut.cancelled():
+                        self.logger.info(f"chunk {index} request to {iface} was cancelled")
+                    elif fut.exception() is not None:
+                        self.logger.info(f"failed to get chunk {index} from {iface}: {repr(fut.exception())}")
+                    else:
+                        res = fut.result()
+                if res is not None and self.blockchain.connect_chunk(index, res['hex']):
+                    num_headers = res['count']
+                elif iface is not self:
+                    self.logger.info(f"chunk {index} from {iface} did not connect. retrying from this server")
+                    could_connect, num_headers = await self.request_chunk(index * 2016, tip)
+                    if not could_connect:
+                        return connected_any, index * 2016
+                else:
+                    return connected_any, index * 2016
+                connected_any = True
+                util.trigger_callback('network_updated')
+                if num_headers < 2016:
+                    return connected_any, index * 2016 + num_headers
+            return connected_any, (last_index + 1) * 2016
+        finally:
+            for iface, fut in fetched.values():
+                if fut.done() and not fut.cancelled():
+                    fut.exception()  # retrieve it, so that it does not get logged
+                fut.cancel()
 
     def is_main_server(self) -> bool:
         return self.network.default_server == self.server
@@ -572,7 +972,6 @@ class Interface(Logger):
             try:
                 async with self.taskgroup as group:
                     await group.spawn(self.ping)
-                    await group.spawn(self.request_fee_estimates)
                     await group.spawn(self.run_fetch_blocks)
                     await group.spawn(self.monitor_connection)
             except aiorpcx.jsonrpc.RPCError as e:
@@ -593,20 +992,6 @@ class Interface(Logger):
             await asyncio.sleep(300)
             await self.session.send_request('server.ping')
 
-    async def request_fee_estimates(self):
-        from .simple_config import FEE_ETA_TARGETS
-        while True:
-            async with TaskGroup() as group:
-                fee_tasks = []
-                for i in FEE_ETA_TARGETS:
-                    fee_tasks.append((i, await group.spawn(self.session.send_request('blockchain.estimatefee', [i]))))
-            for nblock_target, task in fee_tasks:
-                fee = int(task.result() * constants.net.COIN)
-                if fee < 0: continue
-                self.fee_estimates_eta[nblock_target] = fee
-            self.network.update_fee_estimates()
-            await asyncio.sleep(60)
-
     async def close(self):
         if self.session:
             await self.session.close()
@@ -625,10 +1010,13 @@ class Interface(Logger):
             if self.tip < constants.net.max_checkpoint():
                 raise GracefulDisconnect('server tip below max checkpoint')
             self._mark_ready()
+            if self.is_main_server():
+                self.network.fee_estimator.on_new_block(height)
             await self._process_header_at_tip()
             util.trigger_callback('network_updated')
             await self.network.switch_unwanted_fork_interface()
             await self.network.switch_lagging_interface()
+            await self.network.switch_slow_interface()
 
     async def _process_header_at_tip(self):
         height, header = self.tip, self.tip_header
@@ -650,14 +1038,19 @@ class Interface(Logger):
         while last is None or height <= next_height:
             prev_last, prev_height = last, height
             if next_height > height + 10:
-                could_connect, num_headers = await self.request_chunk(height, next_height)
+                if next_height // 2016 > height // 2016:
+                    # more than one chunk to go
+                    could_connect, new_height = await self.request_chunks_pipelined(height, next_height)
+                else:
+                    could_connect, num_headers = await self.request_chunk(height, next_height)
+                    new_height = (height // 2016 * 2016) + num_headers
                 if not could_connect:
                     if height <= constants.net.max_checkpoint():
                         raise GracefulDisconnect('server chain conflicts with checkpoints or genesis')
                     last, height = await self.step(height)
                     continue
                 util.trigger_callback('network_updated')
-                height = (height // 2016 * 2016) + num_headers
+                height = new_height
                 assert height <= next_height+1, (height, self.tip)
                 last = 'catchup'
             else:
@@ -25,6 +25,7 @@
 import threading
 import copy
 import json
+from typing import Optional, Sequence, List
 
 from . import util
 from .logging import Logger
@@ -48,18 +49,21 @@ def locked(func):
 class StoredObject:
 
     db = None
+    path = None
 
     def __setattr__(self, key, value):
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path)
         object.__setattr__(self, key, value)
 
-    def set_db(self, db):
+    def set_db(self, db, path=None):
         self.db = db
+        object.__setattr__(self, 'path', path)
 
     def to_json(self):
         d = dict(vars(self))
         d.pop('db', None)
+        d.pop('path', None)
         return d
 
 
@@ -107,18 +111,24 @@ class StoredDict(dict):
                 v = self.db._convert_value(self.path, key, v)
         # set parent of StoredObject
         if isinstance(v, StoredObject):
-            v.set_db(self.db)
+            v.set_db(self.db, self.path + [key])
         # set item
         dict.__setitem__(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path + [key])
 
     @locked
     def __delitem__(self, key):
         key = self.convert_key(key)
         dict.__delitem__(self, key)
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path + [key])
+
+    @locked
+    def clear(self):
+        dict.clear(self)
+        if self.db:
+            self.db.set_path_modified(self.path)
 
     @locked
     def __getitem__(self, key):
@@ -138,7 +148,7 @@ class StoredDict(dict):
         else:
             r = dict.pop(self, key, v)
         if self.db:
-            self.db.set_modified(True)
+            self.db.set_path_modified(self.path + [key])
         return r
 
     @locked
@@ -147,6 +157,27 @@ class StoredDict(dict):
         return dict.get(self, key, default)
 
 
+# last key of the path of a journal entry that appends to a list
+JOURNAL_APPEND = '-'
+
+
+def apply_journal_entries(data: dict, entries: Sequence[dict]) -> None:
+    """Applies journal entries, as returned by JsonDB.get_journal_entries,
+    to data loaded from json. Entries whose parent is missing are skipped:
+    the parent itself was written later in the journal.
+    """
+    for entry in entries:
+        *parent_path, key = entry['path']
+        d = data
+        for k in parent_path:
+            d = d.get(k) if isinstance(d, dict) else None
+        if isinstance(d, list) and key == JOURNAL_APPEND and entry['op'] == 'add':
+            d.append(entry['value'])
+        elif isinstance(d, dict):
+            if entry['op'] == 'add':
+                d[key] = entry['value']
+            elif entry['op'] == 'remove':
+                d.pop(key, None)
 
 
 class JsonDB(Logger):
@@ -156,11 +187,85 @@ class JsonDB(Logger):
         self.lock = threading.RLock()
         self.data = data
         self._modified = False
+        # paths modified since the last write, and values appended to lists.
+        # the values of modified paths are read when writing.
+        self._journal_ops = []
+        self._journal_paths = set()
+        # set when the changes are not all known, and the whole db must be written
+        self._journal_full = True
 
     def set_modified(self, b):
         with self.lock:
             self._modified = b
 
+    def set_path_modified(self, path: Optional[Sequence[str]]):
+        """Called when the item at path is set or removed.
+        path is None if the location of the change is not known."""
+        with self.lock:
+            self._modified = True
+            if not path:
+                self._journal_full = True
+            # changes made while self.data is converted to StoredDict are not recorded
+            if self._journal_full or not isinstance(self.data, StoredDict):
+                return
+            self._add_journal_op(('set', tuple(path)))
+
+    def set_path_appended(self, path: Sequence[str], value):
+        """Called when value is appended to the list at path."""
+        with self.lock:
+            self._modified = True
+            if self._journal_full or not isinstance(self.data, StoredDict):
+                return
+            self._add_journal_op(('append', tuple(path), value))
+
+    def _add_journal_op(self, op):
+        path = op[1]
+        # skip if the path or one of its parents will be written with its current value
+        for i in range(1, len(path) + 1):
+            if path[:i] in self._journal_paths:
+                return
+        if op[0] == 'set':
+            self._journal_paths.add(path)
+        self._journal_ops.append(op)
+
+    def _get_path(self, path):
+        v = self.data
+        for key in path:
+            if not isinstance(v, dict) or key not in v:
+                return _RaiseKeyError
+            v = v[key]
+        return v
+
+    @locked
+    def get_journal_entries(self) -> Optional[List[dict]]:
+        """Returns the changes since the last write, as json patch operations
+        with the path as a list of keys, or None if the whole db must be written."""
+        if self._journal_full:
+            return None
+        entries = []
+        for op in self._journal_ops:
+            path = op[1]
+            # already covered by one of its parents
+            n = len(path) + 1 if op[0] == 'append' else len(path)
+            if any(path[:i] in self._journal_paths for i in range(1, n)):
+                continue
+            if op[0] == 'append':
+                entries.append({'op': 'add', 'path': list(op[1]) + [JOURNAL_APPEND], 'value': op[2]})
+                continue
+            v = self._get_path(op[1])
+            if v is _RaiseKeyError:
+                entries.append({'op': 'remove', 'path': list(op[1])})
+            else:
+                entries.append({'op': 'add', 'path': list(op[1]), 'value': v})
+        return entries
+
+    @locked
+    def clear_journal(self):
+        """Called once the changes have been written."""
+        self._journal_ops = []
+        self._journal_paths = set()
+        self._journal_full = False
+
     def modified(self):
         return self._modified
 
@@ -52,9 +52,11 @@ from . import bitcoin
 from . import dns_hacks
 from .transaction import Transaction
 from .blockchain import Blockchain
+from .tx_cache import TxCache
 from .interface import (Interface, PREFERRED_NETWORK_PROTOCOL,
                         RequestTimedOut, NetworkTimeout, BUCKET_NAME_OF_ONION_SERVERS,
-                        NetworkException, RequestCorrupted, ServerAddr)
+                        NetworkException, RequestCorrupted, ServerAddr, ScripthashSubscriptions,
+                        RequestMetrics)
 from .version import PROTOCOL_VERSION
 from .simple_config import SimpleConfig
 from .i18n import _
@@ -73,6 +75,23 @@ _logger = get_logger(__name__)
 NUM_TARGET_CONNECTED_SERVERS = 10
 NUM_STICKY_SERVERS = 4
 NUM_RECENT_SERVERS = 20
+# weight of a new sample in the moving averages of a ServerScore
+SERVER_SCORE_ALPHA = 0.2
+# a server that always fails scores as if it were this many times slower
+SERVER_FAILURE_PENALTY = 10
+# the main interface is only switched for a server this many times better,
+# and not before it has been the main interface for this many seconds
+SERVER_SWITCH_FACTOR = 2
+SERVER_SWITCH_MIN_DWELL = 30 * 60
+# modified server scores are saved with the recent servers at this interval
+SERVER_SCORES_SAVE_INTERVAL = 300
+# fee estimates are polled at this interval, stretched up to the maximum while they are stable
+FEE_POLL_INTERVAL = 60
+FEE_POLL_MAX_INTERVAL = 600
+# estimates are stable if no target changed by more than this fraction
+FEE_STABLE_CHANGE = 0.05
+# servers asked for fee estimates with auto_connect, main interface included; the median is used
+FEE_SAMPLE_SIZE = 3
 
 
 def parse_servers(result: Sequence[Tuple[str, str, List[str]]]) -> Dict[str, dict]:
@@ -141,6 +160,127 @@ def pick_random_server(hostmap=None, *, allowed_protocols: Iterable[str],
     return random.choice(eligible) if eligible else None
 
 
+class ServerScore:
+    """Exponentially weighted round trip time (in seconds) of the requests
+    every interface sends (see interface.SERVER_SCORE_METHODS), and failure
+    rate (timeouts of those requests, failed connections, corrupted
+    responses) of a server. Lower scores are better.
+    """
+
+    def __init__(self, latency: float = None, failure_rate: float = 0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+
+    def add_latency(self, seconds: float) -> None:
+        if self.latency is None:
+            self.latency = seconds
+        else:
+            self.latency += SERVER_SCORE_ALPHA * (seconds - self.latency)
+        self.failure_rate *= 1 - SERVER_SCORE_ALPHA
+
+    def add_failure(self) -> None:
+        self.failure_rate += SERVER_SCORE_ALPHA * (1 - self.failure_rate)
+
+    def score(self) -> Optional[float]:
+        if self.latency is None:
+            return None
+        return self.latency * (1 + SERVER_FAILURE_PENALTY * self.failure_rate)
+
+    def to_json(self) -> dict:
+        return {'latency': self.latency, 'failure_rate': self.failure_rate}
+
+    @classmethod
+    def from_json(cls, d: dict) -> 'ServerScore':
+        latency = d.get('latency')
+        return ServerScore(latency=float(latency) if latency is not None else None,
+                           failure_rate=float(d.get('failure_rate', 0)))
+
+
+class FeeEstimator:
+    """Polls fee estimates for FEE_ETA_TARGETS, with one batch request per
+    server: the main interface, and with auto_connect a few other servers.
+    The poll interval doubles while estimates are stable. A new block, or a
+    new main interface, triggers a refresh right away.
+    """
+
+    def __init__(self, network: 'Network'):
+        self.network = network
+        self.estimates = {}  # type: Dict[int, int]
+        self.interval = FEE_POLL_INTERVAL
+        self._refresh_event = asyncio.Event()
+        self._last_height = 0
+
+    def refresh_now(self) -> None:
+        self._refresh_event.set()
+
+    def on_new_block(self, height: int) -> None:
+        if height > self._last_height:
+            if self._last_height:
+                self.refresh_now()
+            self._last_height = height
+
+    async def run(self):
+        while True:
+            self._refresh_event.clear()
+            if self.network.is_connected():
+                await self.refresh()
+            try:
+                await asyncio.wait_for(self._refresh_event.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+
+    def _sample_interfaces(self) -> List[Interface]:
+        main = self.network.interface
+        interfaces = [main] if main else []
+        if self.network.auto_connect:
+            with self.network.interfaces_lock:
+                others = [i for i in self.network.interfaces.values() if i != main]
+            interfaces += random.sample(others, min(len(others), FEE_SAMPLE_SIZE - len(interfaces)))
+        return interfaces
+
+    async def _request(self, interface: Interface) -> Dict[int, int]:
+        from .simple_config import FEE_ETA_TARGETS
+        results = await interface.session.send_request_batch(
+            [('blockchain.estimatefee', [n]) for n in FEE_ETA_TARGETS])
+        estimates = {}
+        for nblock_target, result in zip(FEE_ETA_TARGETS, results):
+            if not isinstance(result, (int, float)):
+                continue  # an error, or no estimate
+            fee = int(result * constants.net.COIN)
+            if fee < 0: continue
+            estimates[nblock_target] = fee
+        interface.fee_estimates_eta = estimates
+        return estimates
+
+    async def refresh(self) -> None:
+        from statistics import median
+        from .simple_config import FEE_ETA_TARGETS
+        interfaces = self._sample_interfaces()
+        results = await asyncio.gather(*[self._request(i) for i in interfaces], return_exceptions=True)
+        estimates = {}
+        for interface, result in zip(interfaces, results):
+            if isinstance(result, Exception):
+                _logger.info(f"fee estimates from {interface.server} failed: {repr(result)}")
+        for n in FEE_ETA_TARGETS:
+            fees = [r[n] for r in results if isinstance(r, dict) and n in r]
+            if fees:
+                estimates[n] = int(median(fees))
+        if not estimates:
+            return
+        if self._is_stable(estimates):
+            self.interval = min(2 * self.interval, FEE_POLL_MAX_INTERVAL)
+        else:
+            self.interval = FEE_POLL_INTERVAL
+        self.estimates = estimates
+        self.network.update_fee_estimates()
+
+    def _is_stable(self, estimates: Dict[int, int]) -> bool:
+        if set(estimates) != set(self.estimates):
+            return False
+        return all(abs(fee - self.estimates[n]) <= FEE_STABLE_CHANGE * self.estimates[n]
+                   for n, fee in estimates.items())
+
+
 class NetworkParameters(NamedTuple):
     server: ServerAddr
     proxy: Optional[dict]
@@ -302,7 +442,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interfaces_lock = threading.Lock()            # for mutating/iterating self.interfaces
 
         self.server_peers = {}  # returned by interface (servers that the main interface knows about)
-        self._recent_servers = self._read_recent_servers()  # note: needs self.recent_servers_lock
+        # note: both need self.recent_servers_lock
+        self._recent_servers, self._server_scores = self._read_recent_servers()
+        self._server_scores_modified = False
 
         self.banner = ''
         self.donation_address = ''
@@ -313,7 +455,13 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         # the main server we are currently communicating with
         self.interface = None
+        self._interface_since = 0  # time.monotonic() when self.interface was set
         self.default_server_changed_event = asyncio.Event()
+        # requests sent to servers, per server and method
+        self.request_metrics = RequestMetrics()
+        # scripthash subscriptions of all synchronizers, on the main interface
+        self.scripthash_subscriptions = ScripthashSubscriptions()
+        self.fee_estimator = FeeEstimator(self)
         # set of servers we have an ongoing connection with
         self.interfaces = {}
         self.auto_connect = self.config.get('auto_connect', True)
@@ -326,6 +474,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         self._set_status('disconnected')
 
+        # raw transactions, shared by all wallets; created in _start
+        self.tx_cache = None  # type: Optional[TxCache]
+
         # lightning network
         self.channel_db = None  # type: Optional[ChannelDB]
         self.lngossip = None  # type: Optional[LNGossip]
@@ -364,24 +515,31 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 return func(self, *args, **kwargs)
         return func_wrapper
 
-    def _read_recent_servers(self) -> List[ServerAddr]:
+    def _read_recent_servers(self) -> Tuple[List[ServerAddr], Dict[ServerAddr, ServerScore]]:
         if not self.config.path:
-            return []
+            return [], {}
         path = os.path.join(self.config.path, "recent_servers")
         try:
             with open(path, "r", encoding='utf-8') as f:
                 data = f.read()
-                servers_list = json.loads(data)
-            return [ServerAddr.from_str(s) for s in servers_list]
+                data = json.loads(data)
+            if isinstance(data, list):  # no scores yet
+                data = {'servers': data, 'scores': {}}
+            servers = [ServerAddr.from_str(s) for s in data['servers']]
+            scores = {ServerAddr.from_str(s): ServerScore.from_json(d) for s, d in data['scores'].items()}
+            return servers, scores
         except:
-            return []
+            return [], {}
 
     @with_recent_servers_lock
     def _save_recent_servers(self):
         if not self.config.path:
             return
         path = os.path.join(self.config.path, "recent_servers")
-        s = json.dumps(self._recent_servers, indent=4, sort_keys=True, cls=MyEncoder)
+        scores = {str(server): self._server_scores[server].to_json()
+                  for server in self._recent_servers if server in self._server_scores}
+        s = json.dumps({'servers': self._recent_servers, 'scores': scores}, indent=4, sort_keys=True, cls=MyEncoder)
+        self._server_scores_modified = False
         try:
             with open(path, "w", encoding='utf-8') as f:
                 f.write(s)
@@ -392,6 +550,40 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         interface = self.interface
         return interface.tip if interface else 0
 
+    @with_recent_servers_lock
+    def record_server_latency(self, server: ServerAddr, seconds: float) -> None:
+        self._server_scores.setdefault(server, ServerScore()).add_latency(seconds)
+        self._server_scores_modified = True
+
+    @with_recent_servers_lock
+    def record_server_failure(self, server: ServerAddr) -> None:
+        self._server_scores.setdefault(server, ServerScore()).add_failure()
+        self._server_scores_modified = True
+
+    @with_recent_servers_lock
+    def save_server_scores(self) -> None:
+        """Saves the recent servers, if server scores changed since they were last saved."""
+        if self._server_scores_modified:
+            self._save_recent_servers()
+
+    async def _save_server_scores_periodically(self):
+        while True:
+            await asyncio.sleep(SERVER_SCORES_SAVE_INTERVAL)
+            self.save_server_scores()
+
+    @with_recent_servers_lock
+    def get_server_score(self, server: ServerAddr) -> Optional[float]:
+        score = self._server_scores.get(server)
+        return score.score() if score else None
+
+    def _sort_servers_by_score(self, servers: Iterable[ServerAddr]) -> List[ServerAddr]:
+        """Best servers first; servers without a score yet go last,
+        in their original order."""
+        def key(server):
+            score = self.get_server_score(server)
+            return (score is None, score or 0)
+        return sorted(servers, key=key)
+
     async def _server_is_lagging(self):
         sh = self.get_server_height()
         if not sh:
@@ -496,21 +688,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             return list(self.interfaces)
 
     def get_fee_estimates(self):
-        from statistics import median
-        from .simple_config import FEE_ETA_TARGETS
-        if self.auto_connect:
-            with self.interfaces_lock:
-                out = {}
-                for n in FEE_ETA_TARGETS:
-                    try:
-                        out[n] = int(median(filter(None, [i.fee_estimates_eta.get(n) for i in self.interfaces.values()])))
-                    except:
-                        continue
-                return out
-        else:
-            if not self.interface:
-                return {}
-            return self.interface.fee_estimates_eta
+        return dict(self.fee_estimator.estimates)
 
     def update_fee_estimates(self):
         e = self.get_fee_estimates()
@@ -556,6 +734,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         with self.recent_servers_lock:
             recent_servers = list(self._recent_servers)
         recent_servers = [s for s in recent_servers if s.protocol in self._allowed_protocols]
+        recent_servers = self._sort_servers_by_score(recent_servers)
         if len(connected_servers & set(recent_servers)) < NUM_STICKY_SERVERS:
             for server in recent_servers:
                 if server in connected_servers:
@@ -619,12 +798,14 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.num_server = NUM_TARGET_CONNECTED_SERVERS if not oneserver else 0
 
     async def _switch_to_random_interface(self):
-        '''Switch to a random connected server other than the current one'''
+        '''Switch to a connected server other than the current one,
+        preferring the ones with the best scores'''
         servers = self.get_interfaces()    # Those in connected state
         if self.default_server in servers:
             servers.remove(self.default_server)
         if servers:
-            await self.switch_to_interface(random.choice(servers))
+            random.shuffle(servers)
+            await self.switch_to_interface(self._sort_servers_by_score(servers)[0])
 
     async def switch_lagging_interface(self):
         '''If auto_connect and lagging, switch interface'''
@@ -634,8 +815,30 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             with self.interfaces_lock: interfaces = list(self.interfaces.values())
             filtered = list(filter(lambda iface: iface.tip_header == best_header, interfaces))
             if filtered:
-                chosen_iface = random.choice(filtered)
-                await self.switch_to_interface(chosen_iface.server)
+                random.shuffle(filtered)
+                servers = self._sort_servers_by_score([iface.server for iface in filtered])
+                await self.switch_to_interface(servers[0])
+
+    async def switch_slow_interface(self):
+        '''If auto_connect, switch to a connected server on the same tip
+        that scores much better than the current one, which has been the
+        main interface for a while'''
+        if not self.auto_connect or not self.interface:
+            return
+        if time.monotonic() - self._interface_since < SERVER_SWITCH_MIN_DWELL:
+            return
+        current = self.get_server_score(self.interface.server)
+        if current is None:
+            return
+        tip_header = self.interface.tip_header
+        with self.interfaces_lock: interfaces = list(self.interfaces.values())
+        servers = [iface.server for iface in interfaces
+                   if iface.tip_header == tip_header and iface.server != self.interface.server]
+        for server in self._sort_servers_by_score(servers)[:1]:
+            score = self.get_server_score(server)
+            if score is not None and score * SERVER_SWITCH_FACTOR < current:
+                self.logger.info(f"switching to {server}, score {score:.3f} vs {current:.3f}")
+                await self.switch_to_interface(server)
 
     async def switch_unwanted_fork_interface(self):
         """If auto_connect and main interface is not on preferred fork,
@@ -701,7 +904,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             assert i.ready.done(), "interface we are switching to is not ready yet"
             blockchain_updated = i.blockchain != self.blockchain()
             self.interface = i
+            self._interface_since = time.monotonic()
+            await self.scripthash_subscriptions.switch_interface(i)
             await i.taskgroup.spawn(self._request_server_info(i))
+            self.fee_estimator.refresh_now()
             util.trigger_callback('default_server_changed')
             self.default_server_changed_event.set()
             self.default_server_changed_event.clear()
@@ -764,6 +970,8 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             await asyncio.wait_for(interface.ready, timeout)
         except BaseException as e:
             self.logger.info(f"couldn't launch iface {server} -- {repr(e)}")
+            if not isinstance(e, asyncio.CancelledError):
+                self.record_server_failure(server)
             await interface.close()
             return
         else:
@@ -825,7 +1033,9 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                     if success_fut.exception():
                         try:
                             raise success_fut.exception()
-                        except (RequestTimedOut, RequestCorrupted):
+                        except (RequestTimedOut, RequestCorrupted) as e:
+                            if isinstance(e, RequestCorrupted):  # timeouts are counted by the session
+                                self.record_server_failure(iface.server)
                             await iface.close()
                             await iface.got_disconnected
                             continue  # try again
@@ -851,6 +1061,24 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             raise Exception(f"{repr(tx_height)} is not a block height")
         return await self.interface.session.send_request('blockchain.transaction.get_merkle', [tx_hash, tx_height])
 
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def get_merkle_for_transactions(self, txs: Sequence[Tuple[str, int]]) -> List:
+        """Like get_merkle_for_transaction, for several (tx_hash, tx_height)
+        in one batch. Errors returned by the server for a single tx are put
+        in the list as UntrustedServerReturnedError, in place of its result.
+        """
+        for tx_hash, tx_height in txs:
+            if not is_hash256_str(tx_hash):
+                raise Exception(f"{repr(tx_hash)} is not a txid")
+            if not is_non_negative_integer(tx_height):
+                raise Exception(f"{repr(tx_height)} is not a block height")
+        results = await self.interface.session.send_request_batch(
+            [('blockchain.transaction.get_merkle', [tx_hash, tx_height]) for tx_hash, tx_height in txs])
+        return [UntrustedServerReturnedError(original_exception=r)
+                if isinstance(r, aiorpcx.jsonrpc.CodeMessageError) else r
+                for r in results]
+
     @best_effort_reliable
     async def broadcast_transaction(self, tx: 'Transaction', *, timeout=None) -> None:
         if timeout is None:
@@ -1025,11 +1253,28 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
             raise Exception(f"{repr(height)} is not a block height")
         return await self.interface.request_chunk(height, tip=tip, can_return_early=can_return_early)
 
-    @best_effort_reliable
-    @catch_server_exceptions
     async def get_transaction(self, tx_hash: str, *, timeout=None) -> str:
         if not is_hash256_str(tx_hash):
             raise Exception(f"{repr(tx_hash)} is not a txid")
+        if self.tx_cache:
+            raw = await self.tx_cache.get_tx(tx_hash)
+            if raw is not None:
+                return raw
+        raw = await self._get_transaction_from_server(tx_hash, timeout=timeout)
+        if self.tx_cache:
+            # raw was checked against tx_hash by _get_transaction_from_server.
+            # not awaited: the tx is returned without waiting for the write
+            fut = self.tx_cache.add_tx(tx_hash, raw)
+            fut.add_done_callback(self._on_tx_cached)
+        return raw
+
+    def _on_tx_cached(self, fut: asyncio.Future) -> None:
+        if not fut.cancelled() and fut.exception() is not None:
+            self.logger.warning(f"cannot add tx to cache: {repr(fut.exception())}")
+
+    @best_effort_reliable
+    @catch_server_exceptions
+    async def _get_transaction_from_server(self, tx_hash: str, *, timeout=None) -> str:
         iface = self.interface
         raw = await iface.session.send_request('blockchain.transaction.get', [tx_hash], timeout=timeout)
         # validate response
@@ -1124,13 +1369,11 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
     def get_local_height(self):
         return self.blockchain().height()
 
-    def export_checkpoints(self, path):
+    def export_checkpoints(self, path, *, extend=False):
         """Run manually to generate blockchain checkpoints.
         Kept for console use only.
         """
-        cp = self.blockchain().get_checkpoints()
-        with open(path, 'w', encoding='utf-8') as f:
-            f.write(json.dumps(cp, indent=4))
+        return self.blockchain().write_checkpoints(path, extend=extend)
 
     async def _start(self):
         assert not self.taskgroup
@@ -1138,6 +1381,8 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         assert not self.interface and not self.interfaces
         assert not self._connecting
         self.logger.info('starting network')
+        if self.tx_cache is None and self.config.get('tx_cache', True):
+            self.tx_cache = TxCache(self)
         self._clear_addr_retry_times()
         self._set_proxy(deserialize_proxy(self.config.get('proxy')))
         self._maybe_set_oneserver()
@@ -1150,6 +1395,10 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
                 # will NOT raise, and the group will keep the other tasks running
                 async with taskgroup as group:
                     await group.spawn(self._maintain_sessions())
+                    await group.spawn(self.fee_estimator.run())
+                    await group.spawn(self._save_server_scores_periodically())
+                    if self.config.get('request_stats_file'):
+                        await group.spawn(self._dump_request_stats())
                     [await group.spawn(job) for job in self._jobs]
             except asyncio.CancelledError:
                 raise
@@ -1161,6 +1410,17 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
 
         util.trigger_callback('network_updated')
 
+    async def _dump_request_stats(self):
+        path = self.config.get('request_stats_file')
+        interval = self.config.get('request_stats_interval', 60)
+        while True:
+            await asyncio.sleep(interval)
+            s = json.dumps(self.request_metrics.to_json(), indent=4, sort_keys=True)
+            tmp_path = path + '.tmp'
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                f.write(s)
+            os.replace(tmp_path, path)
+
     def start(self, jobs: Iterable = None):
         """Schedule starting the network, along with the given job co-routines.
 
@@ -1181,6 +1441,7 @@ class Network(Logger, NetworkRetryManager[ServerAddr]):
         self.interface = None
         self.interfaces = {}
         self._connecting.clear()
+        self.save_server_scores()
         if not full_shutdown:
             util.trigger_callback('network_updated')
 
@@ -89,11 +89,9 @@ class CrowncoinMainnet(AbstractNet, AuxPowMixin, StakeMixin):
     @classmethod
     def get_target_btc(cls, height: int, blockchain) -> int:
         if not height % cls.INTERVAL == 0:
-            # Get the first block of this retarget period
-            last = blockchain.read_header(height - 1)
-            if not last:
-                raise MissingHeader()
-            return blockchain.bits_to_target(last['bits'])
+            # same target as the previous block
+            last_timestamp, last_bits = blockchain.get_difficulty_window(height - 1, 1)[0]
+            return blockchain.bits_to_target(last_bits)
 
         # new target
         first = blockchain.read_header(height - cls.INTERVAL)
@@ -112,34 +110,21 @@ class CrowncoinMainnet(AbstractNet, AuxPowMixin, StakeMixin):
         return new_target
 
     @classmethod
-    def get_target_dgw(cls, height: int, blockchain) -> int:       
-        # get last solved header
-        current = blockchain.read_header(height - 1)
-        nActualTimespan = 0
-        lastBlockTime = 0
-        pastBlocksMin = 24
+    def get_target_dgw(cls, height: int, blockchain) -> int:
         pastBlocksMax = 24
-        countBlocks = 0
-
-        for i in range(pastBlocksMax):
-            countBlocks += 1
-            if not current:
-                raise BaseException('header at height: %d is not stored in db' % (height - i - 1))
-
-            bits = current.get('bits')
-            if countBlocks <= pastBlocksMin:
-                if countBlocks == 1:
-                    past_difficulty_avg = blockchain.bits_to_target(bits)
-                else:
-                    past_difficulty_avg = (past_difficulty_avg_prev * countBlocks + blockchain.bits_to_target(bits)) // (countBlocks + 1)
-                past_difficulty_avg_prev = past_difficulty_avg
-
-            if lastBlockTime > 0:
-                nActualTimespan += lastBlockTime - current.get('timestamp')
-            lastBlockTime = current.get('timestamp')
-
-            # get previous block
-            current = blockchain.read_header(height - i - 2)
+        # (timestamp, bits) of the last solved headers, newest first
+        window = blockchain.get_difficulty_window(height - 1, pastBlocksMax)
+        countBlocks = len(window)
+
+        for i, (timestamp, bits) in enumerate(window):
+            if i == 0:
+                past_difficulty_avg = blockchain.bits_to_target(bits)
+            else:
+                past_difficulty_avg = (past_difficulty_avg_prev * (i + 1) + blockchain.bits_to_target(bits)) // (i + 2)
+            past_difficulty_avg_prev = past_difficulty_avg
+
+        # the sum of the time differences between consecutive blocks
+        nActualTimespan = window[0][0] - window[-1][0]
 
         target_timespan = countBlocks * cls.TARGET_SPACING
         nActualTimespan = max(nActualTimespan, target_timespan // 3)
@@ -90,11 +90,9 @@ class NamecoinMainnet(AbstractNet, AuxPowMixin):
             return t
 
         if not height % cls.INTERVAL == 0:
-            # Get the first block of this retarget period
-            last = blockchain.read_header(height - 1)
-            if not last:
-                raise MissingHeader()
-            return blockchain.bits_to_target(last['bits'])
+            # same target as the previous block
+            last_timestamp, last_bits = blockchain.get_difficulty_window(height - 1, 1)[0]
+            return blockchain.bits_to_target(last_bits)
 
         # new target
         if (index * 2016 + 2015 > 19200) and (index * 2016 + 2015 + 1 > 2016):
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+# Offline benchmark of the header sync path, for each bundled network.
+# A chunk of linked headers is generated (merge-mined networks get a
+# minimal valid AuxPoW per header), and the stages of connect_chunk are
+# timed separately: deserialize, hash, retarget, auxpow verification and
+# disk commit. Every network runs in a fresh process, so that its peak RSS
+# can be reported.
+#
+# usage: bench_headers.py [--networks NAME ...] [--repeat N]
+#                         [--save FILE] [--baseline FILE] [--tolerance F]
+#
+# With --baseline, the exit status is 1 if any stage is slower than in the
+# saved results by more than the tolerance (a fraction, default 0.2).
+
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import multiprocessing
+from typing import Callable, Dict, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from electrum import auxpow, constants
+from electrum.blockchain import Blockchain, PureHeader, verify_auxpow_batch
+from electrum.crypto import sha256d
+from electrum.simple_config import SimpleConfig
+
+
+NETWORKS = ['Bitcoin-Mainnet', 'Abosom-Mainnet', 'Crowncoin-Mainnet', 'Donu-Mainnet', 'Namecoin-Mainnet']
+STAGES = ['deserialize', 'hash', 'retarget', 'auxpow', 'commit']
+CHUNK_SIZE = 2016
+EASY_TARGET = 2**256 - 1
+
+
+def bench_chunk_index(net) -> int:
+    # above the checkpoints, and after AuxPoW started, so that
+    # nothing is short-circuited; two chunks are needed before it
+    index = max(2, len(net.CHECKPOINTS) + 1)
+    if issubclass(net, constants.AuxPowMixin):
+        index = max(index, net.AUXPOW_START_HEIGHT // CHUNK_SIZE + 1)
+    return index
+
+
+def make_auxpow(header_hash: str, rnd: random.Random) -> bytes:
+    # the parent coinbase commits to the header directly (empty chain
+    # merkle branch), and is the only transaction of the parent block
+    script_sig = (auxpow.COINBASE_MERGED_MINING_HEADER + bytes.fromhex(header_hash)
+                  + (1).to_bytes(4, 'little') + rnd.getrandbits(32).to_bytes(4, 'little'))
+    coinbase = ((1).to_bytes(4, 'little')
+                + b'\x01' + bytes(32) + b'\xff' * 4 + bytes([len(script_sig)]) + script_sig + b'\xff' * 4
+                + b'\x01' + bytes(8) + b'\x01\x51'
+                + bytes(4))
+    parent_header = ((0x20000000).to_bytes(4, 'little') + bytes(32) + sha256d(coinbase)
+                     + rnd.getrandbits(32).to_bytes(4, 'little') + bytes(8))
+    merkle_branches = (b'\x00' + bytes(4)) * 2
+    return coinbase + bytes(32) + merkle_branches + parent_header
+
+
+def make_chunk(net, index: int, rnd: random.Random) -> Tuple[bytes, bytes]:
+    """Returns a chunk of linked headers as served by a server (with their
+    AuxPoW on merge-mined networks), and the same headers as stored on disk."""
+    is_auxpow = issubclass(net, constants.AuxPowMixin)
+    version = 4
+    if is_auxpow:
+        version |= net.BLOCK_VERSION_AUXPOW_BIT | (net.AUXPOW_CHAIN_ID << 16)
+    bits = Blockchain.target_to_bits(net.MAX_TARGET)
+    timestamp = 1500000000 + index * CHUNK_SIZE * net.TARGET_SPACING
+    prev_hash = rnd.getrandbits(256).to_bytes(32, 'little')
+    chunk = bytearray()
+    stripped = bytearray()
+    for i in range(CHUNK_SIZE):
+        timestamp += rnd.randint(1, 2 * net.TARGET_SPACING)
+        raw = (version.to_bytes(4, 'little') + prev_hash + rnd.getrandbits(256).to_bytes(32, 'little')
+               + timestamp.to_bytes(4, 'little') + bits.to_bytes(4, 'little')
+               + rnd.getrandbits(32).to_bytes(4, 'little'))
+        chunk += raw
+        stripped += raw
+        if is_auxpow:
+            chunk += make_auxpow(PureHeader(raw, None).hash_hex(), rnd)
+        # only used for linkage, so X11 networks do not need algomodule here
+        prev_hash = sha256d(raw)
+    return bytes(chunk), bytes(stripped)
+
+
+def best_rate(func: Callable[[], None], repeat: int) -> float:
+    best = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        func()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return CHUNK_SIZE / best
+
+
+def peak_rss_mib() -> Optional[float]:
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run_network(name: str, repeat: int) -> Dict[str, object]:
+    constants.select_network(name)
+    net = constants.net
+    rnd = random.Random(0)
+    index = bench_chunk_index(net)
+    start_height = index * CHUNK_SIZE
+    # retargeting reads up to one period back (Namecoin: one header more)
+    prev_stripped = b''.join(make_chunk(net, i, rnd)[1] for i in (index - 2, index - 1))
+    chunk, stripped = make_chunk(net, index, rnd)
+    raw_headers = [stripped[i * net.HEADER_SIZE:(i + 1) * net.HEADER_SIZE] for i in range(CHUNK_SIZE)]
+    # as returned by verify_chunk
+    try:
+        hashes = [PureHeader(raw, start_height + i).hash() for i, raw in enumerate(raw_headers)]
+    except ImportError:
+        hashes = None  # the stages that hash are skipped
+    view = memoryview(chunk)
+    # (height, header with its AuxPoW, target)
+    auxpow_items = []
+    position = 0
+    for height in range(start_height, start_height + CHUNK_SIZE):
+        header, end = PureHeader.from_stream(view, height, position, parse_auxpow=False)
+        if end - position > net.HEADER_SIZE:
+            auxpow_items.append((height, view[position:end], EASY_TARGET))
+        position = end
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config = SimpleConfig({'electrum_path': tmpdir})
+        chain = Blockchain(config=config, forkpoint=0, parent=None,
+                           forkpoint_hash=net.GENESIS, prev_hash=None)
+        # a sparse headers file, with only the previous chunks in place
+        with open(chain.path(), 'wb') as f:
+            f.seek((index - 2) * CHUNK_SIZE * net.HEADER_SIZE)
+            f.write(prev_stripped)
+        chain.update_size()
+
+        def deserialize():
+            position = 0
+            for height in range(start_height, start_height + CHUNK_SIZE):
+                header, position = PureHeader.from_stream(view, height, position, parse_auxpow=False)
+
+        def hash_headers():
+            for i, raw in enumerate(raw_headers):
+                PureHeader(raw, start_height + i).hash()
+
+        def retarget():
+            # as in verify_chunk: headers of the chunk are visible
+            # to the retargeting code before they are saved
+            chain._difficulty.reset()
+            chain._pending_start = start_height
+            chain._pending_headers = {}
+            try:
+                for i, raw in enumerate(raw_headers):
+                    height = start_height + i
+                    chain.get_target(height)
+                    header = PureHeader(raw, height)
+                    chain._pending_headers[height] = header
+                    chain._difficulty.append(height, header)
+            finally:
+                chain._pending_headers = None
+
+        def verify_auxpow():
+            result = verify_auxpow_batch(net, auxpow_items)
+            if result is not None:
+                raise Exception(f'auxpow verification failed: {result}')
+
+        def commit():
+            chain.save_chunk(index, stripped, hashes)
+
+        stages = {
+            'deserialize': deserialize,
+            'hash': hash_headers,
+            'retarget': retarget,
+            'auxpow': verify_auxpow if auxpow_items else None,
+            'commit': commit,
+        }
+        rates = {}
+        for stage in STAGES:
+            func = stages[stage]
+            if func is None:
+                continue
+            try:
+                rates[stage] = best_rate(func, repeat)
+            except ImportError as e:
+                # e.g. X11 hashing needs algomodule
+                rates[stage] = f'skipped: {e}'
+        chain.close_mmap()
+    finally:
+        shutil.rmtree(tmpdir)
+    return {'rates': rates, 'peak_rss_mib': peak_rss_mib()}
+
+
+def check_regressions(results: dict, baseline: dict, tolerance: float) -> bool:
+    ok = True
+    for name, result in results.items():
+        for stage, rate in result['rates'].items():
+            old = baseline.get(name, {}).get('rates', {}).get(stage)
+            if not isinstance(rate, float) or not isinstance(old, float):
+                continue
+            if rate < old * (1 - tolerance):
+                print(f"REGRESSION {name} {stage}: {rate:,.0f} headers/sec, was {old:,.0f}")
+                ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the header sync path of the bundled networks.')
+    parser.add_argument('--networks', nargs='+', default=NETWORKS, choices=sorted(constants.networks))
+    parser.add_argument('--repeat', type=int, default=5, help='runs per stage; the best one is reported')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='compare with results saved earlier')
+    parser.add_argument('--tolerance', type=float, default=0.2, help='allowed slowdown, as a fraction')
+    args = parser.parse_args()
+
+    results = {}
+    mp_context = multiprocessing.get_context('spawn')
+    for name in args.networks:
+        # a fresh process per network, for the peak RSS
+        with mp_context.Pool(1) as pool:
+            result = pool.apply(run_network, (name, args.repeat))
+        results[name] = result
+        for stage, rate in result['rates'].items():
+            rate = f"{rate:>12,.0f} headers/sec" if isinstance(rate, float) else rate
+            print(f"{name:<20} {stage:<12} {rate}")
+        if result['peak_rss_mib'] is not None:
+            print(f"{name:<20} {'peak RSS':<12} {result['peak_rss_mib']:>12,.1f} MiB")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=4, sort_keys=True)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if not check_regressions(results, baseline, args.tolerance):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+
+# Micro-benchmark for Blockchain.read_header on a synthetic headers file.
+# Compares the old open/seek/read path against the memory-mapped store,
+# for sequential reads and for a DGW-like access pattern (24 headers back).
+#
+# usage: bench_read_header.py [num_headers]
+
+import os
+import sys
+import time
+import random
+import shutil
+import tempfile
+
+from electrum import constants
+from electrum.blockchain import Blockchain, deserialize_pure_header
+from electrum.simple_config import SimpleConfig
+
+
+NUM_HEADERS = int(sys.argv[1]) if len(sys.argv) > 1 else 500_000
+DGW_WINDOW = 24
+
+
+def read_header_legacy(path: str, height: int) -> dict:
+    with open(path, 'rb') as f:
+        f.seek(height * constants.net.HEADER_SIZE)
+        h = f.read(constants.net.HEADER_SIZE)
+    return deserialize_pure_header(h, height)
+
+
+def bench(name, func, heights):
+    t0 = time.perf_counter()
+    for height in heights:
+        func(height)
+    dt = time.perf_counter() - t0
+    print(f"{name:<28} {len(heights) / dt:>12,.0f} headers/sec")
+
+
+def main():
+    constants.select_network('Bitcoin-Regtest')
+    tmpdir = tempfile.mkdtemp()
+    try:
+        config = SimpleConfig({'electrum_path': tmpdir})
+        chain = Blockchain(config=config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        rnd = random.Random(0)
+        with open(chain.path(), 'wb') as f:
+            for _ in range(NUM_HEADERS):
+                f.write(rnd.getrandbits(8 * constants.net.HEADER_SIZE).to_bytes(constants.net.HEADER_SIZE, 'little'))
+        chain.update_size()
+        path = chain.path()
+        print(f"{NUM_HEADERS} headers in {path}")
+
+        n = min(NUM_HEADERS, 100_000)
+        sequential = list(range(n))
+        start = NUM_HEADERS - n // DGW_WINDOW
+        dgw = [h - i for h in range(max(start, DGW_WINDOW), NUM_HEADERS) for i in range(1, DGW_WINDOW + 1)]
+
+        bench("sequential, legacy", lambda h: read_header_legacy(path, h), sequential)
+        bench("sequential, mmap+lru", chain.read_header, sequential)
+        bench("dgw window, legacy", lambda h: read_header_legacy(path, h), dgw)
+        chain.close_mmap()
+        bench("dgw window, mmap+lru", chain.read_header, dgw)
+        chain.close_mmap()
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python3
+
+# Benchmark of wallet synchronization against a stand-in Electrum server.
+# The server runs in this process (in its own thread and event loop), and
+# serves a deterministic fixture chain: headers, the history of a wallet of
+# watch-only addresses, its transactions and their merkle proofs. The
+# client side is the real thing: Network, Interface (header sync),
+# Synchronizer and SPV. Reported: time until headers are synced, time until
+# the wallet is synced and verified, requests served per method, client CPU
+# time (the server thread is not counted) and peak RSS of the process.
+#
+# usage: bench_sync.py [--addresses N] [--txs-per-address N] [--blocks N]
+#                      [--latency MS] [--bandwidth KBYTES_PER_SEC]
+#                      [--seed N] [--timeout SEC] [--save FILE]
+#
+# Headers use a network defined here ("Bitcoin-Bench"), whose target is
+# so easy that any header meets it, so that they can be generated.
+
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import threading
+from collections import Counter
+from functools import partial
+from typing import Dict, List, Optional, Tuple
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+from aiorpcx import RPCSession, handler_invocation, serve_rs
+
+from electrum import constants
+from electrum.bitcoin import address_to_script, address_to_scripthash, hash160_to_p2pkh, hash_encode
+from electrum.blockchain import Blockchain
+from electrum.crypto import sha256d
+from electrum.network import Network
+from electrum.networks.bitcoin_simnet import BitcoinSimnet
+from electrum.simple_config import SimpleConfig
+from electrum.synchronizer import history_status
+from electrum.util import create_and_start_event_loop
+from electrum.version import PROTOCOL_VERSION
+from electrum.wallet import restore_wallet_from_text
+
+
+EASY_TARGET = 2**256 - 1
+CHUNK_SIZE = 2016
+
+
+class BenchNet(BitcoinSimnet):
+    NAME = 'Bitcoin Bench'
+    NAME_LOWER = 'bench bitcoin'
+    DATA_DIR = 'bench'
+    CHECKPOINTS = []
+    DEFAULT_SERVERS = {}
+    GENESIS = None  # that of the fixture chain
+
+    @classmethod
+    def get_target(cls, height: int, blockchain) -> int:
+        return EASY_TARGET
+
+
+def merkle_branch(leaves: List[bytes], pos: int) -> List[bytes]:
+    branch = []
+    level = leaves
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + level[-1:]
+        branch.append(level[pos ^ 1])
+        level = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+        pos >>= 1
+    return branch
+
+
+def merkle_root(leaves: List[bytes]) -> bytes:
+    level = leaves
+    while len(level) > 1:
+        if len(level) % 2:
+            level = level + level[-1:]
+        level = [sha256d(level[i] + level[i + 1]) for i in range(0, len(level), 2)]
+    return level[0]
+
+
+class FixtureChain:
+    """A deterministic chain, with the history of a wallet of watch-only
+    addresses spread over its blocks. Hashes are kept in internal byte
+    order, and converted to hex only when served."""
+
+    def __init__(self, *, num_addresses: int, txs_per_address: int, num_blocks: int, seed: int):
+        rnd = random.Random(seed)
+        self.addresses = [hash160_to_p2pkh(rnd.getrandbits(160).to_bytes(20, 'big'))
+                          for _ in range(num_addresses)]
+        self.txs = {}  # type: Dict[str, bytes]  # txid -> raw tx
+        self.histories = {}  # type: Dict[str, List[Tuple[str, int]]]  # scripthash -> [(txid, height)]
+        block_txs = [[] for _ in range(num_blocks)]  # type: List[List[bytes]]
+        for addr in self.addresses:
+            script = address_to_script(addr)
+            history = []
+            for _ in range(txs_per_address):
+                raw = self._make_tx(rnd, bytes.fromhex(script))
+                tx_hash = sha256d(raw)
+                txid = hash_encode(tx_hash)
+                height = rnd.randrange(1, num_blocks)
+                self.txs[txid] = raw
+                block_txs[height].append(tx_hash)
+                history.append((txid, height))
+            history.sort(key=lambda item: item[1])
+            self.histories[address_to_scripthash(addr)] = history
+        # (height, branch, pos) of each wallet tx
+        self.proofs = {}  # type: Dict[str, Tuple[int, List[str], int]]
+        self.headers = []  # type: List[bytes]
+        bits = Blockchain.target_to_bits(EASY_TARGET)
+        prev_hash = bytes(32)
+        timestamp = 1500000000
+        for height, wallet_txs in enumerate(block_txs):
+            # a coinbase and other txs, so that the proofs are not trivial
+            leaves = ([rnd.getrandbits(256).to_bytes(32, 'little')] + wallet_txs
+                      + [rnd.getrandbits(256).to_bytes(32, 'little') for _ in range(rnd.randrange(0, 64))])
+            for pos, tx_hash in enumerate(wallet_txs, start=1):
+                branch = [hash_encode(h) for h in merkle_branch(leaves, pos)]
+                self.proofs[hash_encode(tx_hash)] = (height, branch, pos)
+            timestamp += rnd.randint(1, 1200)
+            header = ((1).to_bytes(4, 'little') + prev_hash + merkle_root(leaves)
+                      + timestamp.to_bytes(4, 'little') + bits.to_bytes(4, 'little')
+                      + rnd.getrandbits(32).to_bytes(4, 'little'))
+            self.headers.append(header)
+            prev_hash = sha256d(header)
+        self.genesis = hash_encode(sha256d(self.headers[0]))
+
+    @classmethod
+    def _make_tx(cls, rnd: random.Random, script: bytes) -> bytes:
+        # one input spending a coin from outside the wallet, with an empty
+        # scriptSig, and one output to the wallet
+        return ((2).to_bytes(4, 'little')
+                + b'\x01' + rnd.getrandbits(256).to_bytes(32, 'little') + bytes(4) + b'\x00' + b'\xff' * 4
+                + b'\x01' + rnd.randrange(1000, 10**8).to_bytes(8, 'little') + bytes([len(script)]) + script
+                + bytes(4))
+
+    @property
+    def height(self) -> int:
+        return len(self.headers) - 1
+
+
+class StandInSession(RPCSession):
+    """Server side of a connection, answering the requests the client
+    makes while syncing. Every response is delayed by the latency, and by
+    its transfer time through a link shared by the connection."""
+
+    initial_concurrent = 1000
+    processing_timeout = 300
+
+    def __init__(self, transport, *, chain: FixtureChain, latency: float,
+                 bandwidth: Optional[float], requests: Counter):
+        super().__init__(transport)
+        self.cost_hard_limit = 0
+        self.chain = chain
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.requests = requests
+        self._link_free_at = 0.0
+        self.handlers = {
+            'server.version': self.server_version,
+            'server.ping': self.no_result,
+            'server.banner': self.empty_string,
+            'server.donation_address': self.empty_string,
+            'server.peers.subscribe': self.empty_list,
+            'blockchain.relayfee': self.relayfee,
+            'blockchain.estimatefee': self.estimatefee,
+            'mempool.get_fee_histogram': self.empty_list,
+            'blockchain.headers.subscribe': self.headers_subscribe,
+            'blockchain.block.header': self.block_header,
+            'blockchain.block.headers': self.block_headers,
+            'blockchain.scripthash.subscribe': self.scripthash_subscribe,
+            'blockchain.scripthash.get_history': self.scripthash_get_history,
+            'blockchain.transaction.get': self.transaction_get,
+            'blockchain.transaction.get_merkle': self.transaction_get_merkle,
+        }
+
+    async def handle_request(self, request):
+        self.requests[request.method] += 1
+        result = await handler_invocation(self.handlers.get(request.method), request)()
+        await self._delay(len(json.dumps(result)))
+        return result
+
+    async def _delay(self, size: int) -> None:
+        if not self.latency and not self.bandwidth:
+            return
+        now = time.monotonic()
+        done = now
+        if self.bandwidth:
+            done = self._link_free_at = max(now, self._link_free_at) + size / self.bandwidth
+        await asyncio.sleep(done - now + self.latency)
+
+    async def server_version(self, client_name=None, protocol_version=None):
+        return ['ElectrumX stand-in', PROTOCOL_VERSION]
+
+    async def no_result(self):
+        return None
+
+    async def empty_string(self):
+        return ''
+
+    async def empty_list(self):
+        return []
+
+    async def relayfee(self):
+        return 0.00001
+
+    async def estimatefee(self, number):
+        return 0.0001
+
+    async def headers_subscribe(self):
+        height = self.chain.height
+        return {'hex': self.chain.headers[height].hex(), 'height': height}
+
+    async def block_header(self, height, cp_height=0):
+        return self.chain.headers[height].hex()
+
+    async def block_headers(self, start_height, count, cp_height=0):
+        headers = self.chain.headers[start_height:start_height + min(count, CHUNK_SIZE)]
+        return {'hex': b''.join(headers).hex(), 'count': len(headers), 'max': CHUNK_SIZE}
+
+    async def scripthash_subscribe(self, scripthash):
+        return history_status(self.chain.histories.get(scripthash, []))
+
+    async def scripthash_get_history(self, scripthash):
+        return [{'tx_hash': txid, 'height': height}
+                for txid, height in self.chain.histories.get(scripthash, [])]
+
+    async def transaction_get(self, txid, verbose=False):
+        return self.chain.txs[txid].hex()
+
+    async def transaction_get_merkle(self, txid, height):
+        block_height, branch, pos = self.chain.proofs[txid]
+        return {'block_height': block_height, 'merkle': branch, 'pos': pos}
+
+
+def cpu_time() -> float:
+    return time.process_time()
+
+
+def peak_rss_mib() -> Optional[float]:
+    if resource is None:
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+
+def run(args) -> dict:
+    # before the fixture, for the address format
+    constants.networks['Bitcoin-Bench'] = BenchNet
+    constants.select_network('Bitcoin-Bench')
+    t0 = time.perf_counter()
+    chain = FixtureChain(num_addresses=args.addresses, txs_per_address=args.txs_per_address,
+                         num_blocks=args.blocks, seed=args.seed)
+    print(f"fixture: {chain.height + 1} blocks, {len(chain.addresses)} addresses, "
+          f"{len(chain.txs)} txs ({time.perf_counter() - t0:.1f}s)")
+    BenchNet.GENESIS = chain.genesis
+
+    # the server, in its own thread and event loop
+    requests = Counter()
+    server_loop = asyncio.new_event_loop()
+    server_thread = threading.Thread(target=server_loop.run_forever, name='stand-in server', daemon=True)
+    server_thread.start()
+    session_factory = partial(StandInSession, chain=chain, latency=args.latency / 1000,
+                              bandwidth=args.bandwidth * 1024 if args.bandwidth else None,
+                              requests=requests)
+    server = asyncio.run_coroutine_threadsafe(
+        serve_rs(session_factory, '127.0.0.1', 0, loop=server_loop), server_loop).result()
+    port = server.sockets[0].getsockname()[1]
+
+    async def server_cpu_time():
+        return time.thread_time()
+
+    tmpdir = tempfile.mkdtemp()
+    network = None
+    loop, stopping_fut, loop_thread = create_and_start_event_loop()
+    try:
+        config = SimpleConfig({'electrum_path': tmpdir, 'server': f'127.0.0.1:{port}:t',
+                               'oneserver': True, 'auto_connect': False})
+        wallet = restore_wallet_from_text(' '.join(chain.addresses), path=os.path.join(tmpdir, 'wallet'),
+                                          config=config, encrypt_file=False)['wallet']
+        server_cpu_start = asyncio.run_coroutine_threadsafe(server_cpu_time(), server_loop).result()
+        cpu_start = cpu_time()
+        start = time.perf_counter()
+        network = Network(config)
+        network.start()
+        wallet.start_network(network)
+
+        headers_synced = None
+        synced = None
+        while time.perf_counter() - start < args.timeout:
+            time.sleep(0.01)
+            if headers_synced is None and network.get_local_height() == chain.height:
+                headers_synced = time.perf_counter() - start
+            if (headers_synced is not None
+                    and wallet.is_up_to_date()
+                    and wallet.verifier.is_up_to_date()
+                    and not wallet.get_unverified_txs()
+                    and len(wallet.db.list_transactions()) == len(chain.txs)):
+                synced = time.perf_counter() - start
+                break
+        cpu = cpu_time() - cpu_start
+        server_cpu = asyncio.run_coroutine_threadsafe(server_cpu_time(), server_loop).result() - server_cpu_start
+        if synced is None:
+            print(f"not synced after {args.timeout}s", file=sys.stderr)
+        wallet.stop()
+        network.stop()
+    finally:
+        loop.call_soon_threadsafe(stopping_fut.set_result, 1)
+        loop_thread.join(timeout=5)
+        if network and network.tx_cache:
+            # it stops with the event loop, and must not outlive tmpdir
+            network.tx_cache.sql_thread.join(timeout=5)
+        server_loop.call_soon_threadsafe(server_loop.stop)
+        server_thread.join(timeout=5)
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    return {
+        'addresses': args.addresses,
+        'txs': len(chain.txs),
+        'blocks': chain.height + 1,
+        'latency_ms': args.latency,
+        'bandwidth_kbps': args.bandwidth,
+        'headers_synced_sec': headers_synced,
+        'synced_sec': synced,
+        'requests': sum(requests.values()),
+        'requests_per_method': dict(requests),
+        'client_cpu_sec': cpu - server_cpu,
+        'peak_rss_mib': peak_rss_mib(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark wallet sync against a local stand-in server.')
+    parser.add_argument('--addresses', type=int, default=1000, help='addresses in the wallet')
+    parser.add_argument('--txs-per-address', type=int, default=2)
+    parser.add_argument('--blocks', type=int, default=5000, help='length of the chain')
+    parser.add_argument('--latency', type=float, default=0, help='added to every response, in ms')
+    parser.add_argument('--bandwidth', type=float, default=0, help='of the link, in kB/s (0: unlimited)')
+    parser.add_argument('--seed', type=int, default=0, help='of the fixture chain')
+    parser.add_argument('--timeout', type=float, default=600, help='give up after this many seconds')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as JSON')
+    args = parser.parse_args()
+
+    result = run(args)
+    for key, value in result.items():
+        if key != 'requests_per_method':
+            print(f"{key:<20} {value}")
+    for method, count in sorted(result['requests_per_method'].items()):
+        print(f"  {method:<40} {count}")
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=4, sort_keys=True)
+    if result['synced_sec'] is None:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,11 +12,22 @@ def sql(func):
     """wrapper for sql methods"""
     def wrapper(self, *args, **kwargs):
         assert threading.currentThread() != self.sql_thread
-        f = asyncio.Future()
+        f = self.asyncio_loop.create_future()
         self.db_requests.put((f, func, args, kwargs))
         return f
     return wrapper
 
+
+def _set_result(future, result):
+    if not future.cancelled():
+        future.set_result(result)
+
+
+def _set_exception(future, e):
+    if not future.cancelled():
+        future.set_exception(e)
+
+
 class SqlDB(Logger):
     
     def __init__(self, asyncio_loop, path, commit_interval=None):
@@ -28,6 +39,13 @@ class SqlDB(Logger):
         self.sql_thread = threading.Thread(target=self.run_sql)
         self.sql_thread.start()
 
+    def _resolve(self, setter, future, value):
+        # in the event loop thread, which also wakes up the loop if it is waiting
+        try:
+            self.asyncio_loop.call_soon_threadsafe(setter, future, value)
+        except RuntimeError:
+            pass  # the loop is closed, nobody is waiting anymore
+
     def filesize(self):
         return os.stat(self.path).st_size
 
@@ -45,10 +63,9 @@ class SqlDB(Logger):
             try:
                 result = func(self, *args, **kwargs)
             except BaseException as e:
-                future.set_exception(e)
+                self._resolve(_set_exception, future, e)
                 continue
-            if not future.cancelled():
-                future.set_result(result)
+            self._resolve(_set_result, future, result)
             # note: in sweepstore session.commit() is called inside
             # the sql-decorated methods, so commiting to disk is awaited
             if self.commit_interval:
@@ -27,16 +27,31 @@ import threading
 import stat
 import hashlib
 import base64
+import json
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 from enum import IntEnum
+from typing import List, Sequence, Iterator, Iterable, Callable
 
 from . import ecc
+from .crypto import chacha20_poly1305_encrypt, chacha20_poly1305_decrypt
 from .util import profiler, InvalidPassword, WalletFileException, bfh, standardize_path
 
 from .wallet_db import WalletDB
+from .json_db import JsonDBJsonEncoder, apply_journal_entries
 from .logging import Logger
 
 
+# the journal is compacted into the wallet file when it gets larger than
+# this ratio of the wallet file, and at least JOURNAL_MIN_SIZE
+JOURNAL_MAX_RATIO = 0.5
+JOURNAL_MIN_SIZE = 256 * 1024
+
+
+def get_journal_path(path: str) -> str:
+    return path + '.journal'
+
+
 def get_derivation_used_for_hw_device_encryption():
     return ("m"
             "/4541509'"      # ascii 'ELE'  as decimal ("BIP43 purpose")
@@ -52,6 +67,99 @@ class StorageEncryptionVersion(IntEnum):
 class StorageReadWriteError(Exception): pass
 
 
+# Encrypted wallet files are written in chunks: a header line, then one
+# line per CHUNK_SIZE characters of plaintext. Each line is base64. The
+# header is the magic, the ephemeral pubkey and the number of chunks. Each
+# chunk is compressed, then encrypted with chacha20-poly1305, with its index
+# as nonce and the header as associated data. The key is derived from ECDH,
+# as in ECIES. Files with the BIE magic are a single ECIES message, and are
+# still read.
+CHUNK_SIZE = 1024 * 1024
+CHUNKED_ENCRYPTION_MAGIC = {
+    StorageEncryptionVersion.USER_PASSWORD: b'BIC1',
+    StorageEncryptionVersion.XPUB_PASSWORD: b'BIC2',
+}
+
+
+def _get_chunk_key(ecdh_key: bytes, magic: bytes) -> bytes:
+    return hashlib.sha256(magic + ecdh_key).digest()
+
+
+def _get_num_workers() -> int:
+    return os.cpu_count() or 1
+
+
+def _map_in_order(executor: ThreadPoolExecutor, func: Callable, items: Iterable) -> Iterator:
+    # only a few chunks per worker are in memory at a time
+    batch_size = 2 * _get_num_workers()
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield from executor.map(func, batch)
+            batch = []
+    yield from executor.map(func, batch)
+
+
+def encrypt_chunked(plaintext: str, pubkey: ecc.ECPubkey, magic: bytes) -> Iterator[str]:
+    """Yields the lines of the encrypted file. Chunks are encoded,
+    compressed and encrypted in parallel."""
+    ephemeral = ecc.ECPrivkey.generate_random_key()
+    ecdh_key = (pubkey * ephemeral.secret_scalar).get_public_key_bytes(compressed=True)
+    key = _get_chunk_key(ecdh_key, magic)
+    num_chunks = max(1, (len(plaintext) + CHUNK_SIZE - 1) // CHUNK_SIZE)
+    header = magic + ephemeral.get_public_key_bytes(compressed=True) + num_chunks.to_bytes(4, 'big')
+    yield base64.b64encode(header).decode('ascii') + '\n'
+
+    def encrypt_chunk(i):
+        chunk = zlib.compress(plaintext[i * CHUNK_SIZE:(i + 1) * CHUNK_SIZE].encode('utf8'))
+        c = chacha20_poly1305_encrypt(key=key, nonce=i.to_bytes(12, 'big'), associated_data=header, data=chunk)
+        return base64.b64encode(c).decode('ascii') + '\n'
+
+    with ThreadPoolExecutor(max_workers=_get_num_workers()) as executor:
+        yield from _map_in_order(executor, encrypt_chunk, range(num_chunks))
+
+
+def _iter_lines(s: str) -> Iterator[str]:
+    start = 0
+    while start < len(s):
+        end = s.find('\n', start)
+        if end == -1:
+            end = len(s)
+        if end > start:
+            yield s[start:end]
+        start = end + 1
+
+
+def decrypt_chunked(raw: str, privkey: ecc.ECPrivkey, magic: bytes) -> str:
+    """Decrypts a file written by encrypt_chunked. Chunks are decrypted
+    and decompressed in parallel. Raises InvalidPassword if a chunk is not
+    authentic."""
+    lines = _iter_lines(raw)
+    header = base64.b64decode(next(lines))
+    if len(header) != 41 or header[0:4] != magic:
+        raise WalletFileException('invalid chunked encryption header')
+    ephemeral_pubkey = ecc.ECPubkey(header[4:37])
+    num_chunks = int.from_bytes(header[37:41], 'big')
+    ecdh_key = (ephemeral_pubkey * privkey.secret_scalar).get_public_key_bytes(compressed=True)
+    key = _get_chunk_key(ecdh_key, magic)
+
+    def decrypt_chunk(item):
+        i, line = item
+        try:
+            chunk = chacha20_poly1305_decrypt(key=key, nonce=i.to_bytes(12, 'big'), associated_data=header,
+                                              data=base64.b64decode(line))
+        except ValueError:
+            raise InvalidPassword()
+        return zlib.decompress(chunk).decode('utf8')
+
+    with ThreadPoolExecutor(max_workers=_get_num_workers()) as executor:
+        chunks = list(_map_in_order(executor, decrypt_chunk, enumerate(lines)))
+    if len(chunks) != num_chunks:
+        raise WalletFileException(f'truncated wallet file: {len(chunks)} chunks out of {num_chunks}')
+    return ''.join(chunks)
+
+
 # TODO: Rename to Storage
 class WalletStorage(Logger):
 
@@ -62,17 +170,93 @@ class WalletStorage(Logger):
         self.logger.info(f"wallet path {self.path}")
         self.pubkey = None
         self.decrypted = ''
+        self.journal_path = get_journal_path(self.path)
+        self._journal = []  # type: List[str]  # json, decrypted
+        self._journal_size = 0
+        self._journal_valid = True
+        self._base_hash = None
         self._test_read_write_permissions(self.path)
         if self.file_exists():
             with open(self.path, "r", encoding='utf-8') as f:
                 self.raw = f.read()
             self._encryption_version = self._init_encryption_version()
+            self._base_size = len(self.raw)
+            self._journal_lines = self._read_journal()
+            if not self.is_encrypted():
+                self._journal = self._journal_lines
         else:
             self.raw = ''
             self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+            self._base_size = 0
+            self._journal_lines = []
 
     def read(self):
-        return self.decrypted if self.is_encrypted() else self.raw
+        s = self.decrypted if self.is_encrypted() else self.raw
+        if not self._journal:
+            return s
+        data = json.loads(s)
+        for i, line in enumerate(self._journal):
+            try:
+                entries = json.loads(line)
+            except ValueError:
+                # interrupted write. Later entries would not be read either.
+                self.logger.warning(f"journal: cannot read entry {i}, skipping the rest")
+                self._journal_valid = False
+                break
+            apply_journal_entries(data, entries)
+        self.logger.info(f"journal: replayed {len(self._journal)} entries")
+        return json.dumps(data)
+
+    def _get_base_hash(self) -> str:
+        if self._base_hash is None:
+            self._base_hash = hashlib.sha256(self.raw.encode('utf-8')).hexdigest()
+        return self._base_hash
+
+    def _read_journal(self) -> List[str]:
+        """Returns the lines of the journal of the wallet file, if any."""
+        if not os.path.exists(self.journal_path):
+            return []
+        with open(self.journal_path, "r", encoding='utf-8') as f:
+            s = f.read()
+        lines = s.split('\n')
+        try:
+            header = json.loads(lines[0])
+        except ValueError:
+            header = None
+        if not isinstance(header, dict) or header.get('base') != self._get_base_hash():
+            # the wallet file was written after the journal
+            self.logger.info("journal: ignoring stale journal")
+            self._journal_valid = False
+            return []
+        self._journal_size = len(s)
+        if lines[-1]:
+            # interrupted write
+            self._journal_valid = False
+        return [line for line in lines[1:] if line]
+
+    def has_journal(self) -> bool:
+        return self._journal_size > 0 or not self._journal_valid
+
+    def append_journal(self, entries: Sequence[dict]) -> bool:
+        """Appends entries to the journal, and returns whether it did.
+        If not, the wallet file needs to be rewritten."""
+        if not self.file_exists() or not self._journal_valid:
+            return False
+        if not entries:
+            return True
+        line = self.encrypt_before_writing(json.dumps(entries, cls=JsonDBJsonEncoder)) + '\n'
+        if self._journal_size == 0:
+            line = json.dumps({'base': self._get_base_hash()}) + '\n' + line
+        if self._journal_size + len(line) > max(self._base_size * JOURNAL_MAX_RATIO, JOURNAL_MIN_SIZE):
+            return False
+        with open(self.journal_path, "a" if self._journal_size else "w", encoding='utf-8') as f:
+            if self._journal_size == 0:
+                os.chmod(self.journal_path, os.stat(self.path).st_mode)
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+        self._journal_size += len(line)
+        return True
 
     @classmethod
     def _test_read_write_permissions(cls, path):
@@ -98,10 +282,14 @@ class WalletStorage(Logger):
 
     @profiler
     def write(self, data):
-        s = self.encrypt_before_writing(data)
+        base_hash = hashlib.sha256()
+        base_size = 0
         temp_path = "%s.tmp.%s" % (self.path, os.getpid())
         with open(temp_path, "w", encoding='utf-8') as f:
-            f.write(s)
+            for s in self._encrypt_file(data):
+                f.write(s)
+                base_hash.update(s.encode('utf-8'))
+                base_size += len(s)
             f.flush()
             os.fsync(f.fileno())
 
@@ -113,6 +301,13 @@ class WalletStorage(Logger):
         os.chmod(self.path, mode)
         self._file_exists = True
         self.logger.info(f"saved {self.path}")
+        # the journal was compacted into the new file
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+        self._journal_size = 0
+        self._journal_valid = True
+        self._base_hash = base_hash.hexdigest()
+        self._base_size = base_size
 
     def file_exists(self) -> bool:
         return self._file_exists
@@ -150,12 +345,15 @@ class WalletStorage(Logger):
         """
         return self._encryption_version
 
+    def _get_raw_magic(self) -> bytes:
+        return base64.b64decode(self.raw[0:8])[0:4]
+
     def _init_encryption_version(self):
         try:
-            magic = base64.b64decode(self.raw)[0:4]
-            if magic == b'BIE1':
+            magic = self._get_raw_magic()
+            if magic in (b'BIE1', b'BIC1'):
                 return StorageEncryptionVersion.USER_PASSWORD
-            elif magic == b'BIE2':
+            elif magic in (b'BIE2', b'BIC2'):
                 return StorageEncryptionVersion.XPUB_PASSWORD
             else:
                 return StorageEncryptionVersion.PLAINTEXT
@@ -183,12 +381,31 @@ class WalletStorage(Logger):
         ec_key = self.get_eckey_from_password(password)
         if self.raw:
             enc_magic = self._get_encryption_magic()
-            s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
-            s = s.decode('utf8')
+            chunked_magic = CHUNKED_ENCRYPTION_MAGIC[self._encryption_version]
+            if self._get_raw_magic() == chunked_magic:
+                s = decrypt_chunked(self.raw, ec_key, chunked_magic)
+            else:
+                s = zlib.decompress(ec_key.decrypt_message(self.raw, enc_magic))
+                s = s.decode('utf8')
         else:
             s = ''
         self.pubkey = ec_key.get_public_key_hex()
         self.decrypted = s
+        self._journal = []
+        for i, line in enumerate(self._journal_lines):
+            try:
+                self._journal.append(zlib.decompress(ec_key.decrypt_message(line, enc_magic)).decode('utf8'))
+            except Exception:
+                self.logger.warning(f"journal: cannot decrypt entry {i}, skipping the rest")
+                self._journal_valid = False
+                break
+
+    def _encrypt_file(self, plaintext: str) -> Iterator[str]:
+        if not self.pubkey:
+            yield plaintext
+            return
+        magic = CHUNKED_ENCRYPTION_MAGIC[self._encryption_version]
+        yield from encrypt_chunked(plaintext, ecc.ECPubkey(bfh(self.pubkey)), magic)
 
     def encrypt_before_writing(self, plaintext: str) -> str:
         s = plaintext
@@ -212,6 +429,8 @@ class WalletStorage(Logger):
 
     def set_password(self, password, enc_version=None):
         """Set a password to be used for encrypting this storage."""
+        # the journal is encrypted with the previous key
+        self._journal_valid = False
         if enc_version is None:
             enc_version = self._encryption_version
         if password and enc_version != StorageEncryptionVersion.PLAINTEXT:
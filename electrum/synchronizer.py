@@ -24,6 +24,7 @@
 # SOFTWARE.
 import asyncio
 import hashlib
+import time
 from typing import Dict, List, TYPE_CHECKING, Tuple
 from collections import defaultdict
 import logging
@@ -43,6 +44,13 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+# addresses are subscribed to in JSON-RPC batches of (at most) this size,
+# unless set otherwise in the config; no batch is sent while this many
+# subscriptions are waiting for an answer
+SUBSCRIPTION_BATCH_SIZE = 100
+MAX_OUTSTANDING_SUBSCRIPTIONS = 1000
+
+
 class SynchronizerFailure(Exception): pass
 
 
@@ -73,6 +81,9 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         # Queues
         self.add_queue = asyncio.Queue()
         self.status_queue = asyncio.Queue()
+        # backpressure on subscriptions sent but not answered yet
+        self._outstanding_subscriptions = 0
+        self._outstanding_cond = asyncio.Condition()
 
     async def _start_tasks(self):
         try:
@@ -82,7 +93,7 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
                 await group.spawn(self.main())
         finally:
             # we are being cancelled now
-            self.session.unsubscribe(self.status_queue)
+            self.network.scripthash_subscriptions.unsubscribe(self.status_queue)
 
     def _reset_request_counters(self):
         self._requests_sent = 0
@@ -102,22 +113,38 @@ class SynchronizerBase(NetworkJobOnDefaultServer):
         raise NotImplementedError()  # implemented by subclasses
 
     async def send_subscriptions(self):
-        async def subscribe_to_address(addr):
-            h = address_to_scripthash(addr)
-            self.scripthash_to_address[h] = addr
-            self._requests_sent += 1
-            try:
-                await self.session.subscribe('blockchain.scripthash.subscribe', [h], self.status_queue)
-            except RPCError as e:
-                if e.message == 'history too large':  # no unique error code
-                    raise GracefulDisconnect(e, log_level=logging.ERROR) from e
-                raise
-            self._requests_answered += 1
-            self.requested_addrs.remove(addr)
-
+        batch_size = max(1, int(self.network.config.get('subscription_batch_size', SUBSCRIPTION_BATCH_SIZE)))
         while True:
-            addr = await self.add_queue.get()
-            await self.taskgroup.spawn(subscribe_to_address, addr)
+            addrs = [await self.add_queue.get()]
+            # wait for the server to catch up; meanwhile, more
+            # addresses are queued, and go in the same batch
+            async with self._outstanding_cond:
+                await self._outstanding_cond.wait_for(
+                    lambda: self._outstanding_subscriptions < MAX_OUTSTANDING_SUBSCRIPTIONS)
+                while len(addrs) < batch_size and not self.add_queue.empty():
+                    addrs.append(self.add_queue.get_nowait())
+                self._outstanding_subscriptions += len(addrs)
+            await self.taskgroup.spawn(self._subscribe_to_addresses, addrs)
+
+    async def _subscribe_to_addresses(self, addrs: List[str]):
+        hashes = [address_to_scripthash(addr) for addr in addrs]
+        for h, addr in zip(hashes, addrs):
+            self.scripthash_to_address[h] = addr
+        self._requests_sent += len(addrs)
+        start = time.monotonic()
+        errors = await self.network.scripthash_subscriptions.subscribe(hashes, self.status_queue)
+        for e in errors:
+            if e is None:
+                continue
+            if isinstance(e, RPCError) and e.message == 'history too large':  # no unique error code
+                raise GracefulDisconnect(e, log_level=logging.ERROR) from e
+            raise e
+        self.logger.info(f"subscribed to {len(addrs)} addresses in {(time.monotonic() - start) * 1000:.0f} ms")
+        self._requests_answered += len(addrs)
+        self.requested_addrs.difference_update(addrs)
+        async with self._outstanding_cond:
+            self._outstanding_subscriptions -= len(addrs)
+            self._outstanding_cond.notify_all()
 
     async def handle_status(self):
         while True:
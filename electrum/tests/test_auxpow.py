@@ -1,6 +1,10 @@
-from electrum import auxpow, blockchain, constants
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from electrum import auxpow, blockchain, constants, transaction
 from electrum.util import bfh, bh2u
 
+from . import ElectrumTestCase
 from . import SequentialTestCase
 from . import TestCaseForTestnet
 from . import FAST_TESTS
@@ -46,8 +50,8 @@ class Test_auxpow(SequentialTestCase):
 
         Set the outputs of the auxpow coinbase to an empty list.  This is
         necessary when the coinbase has been modified and needs to be
-        re-serialised, since present outputs are invalid due to the
-        fast_tx_deserialize optimisation."""
+        re-serialised, since the outputs are only placeholders: the AuxPoW
+        parser skips over them."""
 
         auxpow_header['parent_coinbase_tx']._outputs = []
 
@@ -251,6 +255,97 @@ class Test_auxpow(SequentialTestCase):
             blockchain.Blockchain.verify_header(header, namecoin_prev_hash_19414, namecoin_target_19414)
 
 
+class Test_auxpow_batches(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.select_network('Namecoin')
+        # Namecoin headers signal AuxPoW with this version bit
+        cls.auxpow_bit = mock.patch.object(constants.net, 'BLOCK_VERSION_AUXPOW_BIT', 0x100)
+        cls.auxpow_bit.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        cls.auxpow_bit.stop()
+        constants.select_network('Bitcoin-Mainnet')
+
+    def setUp(self):
+        super().setUp()
+        self.items = [
+            (37174, bfh(namecoin_header_37174), namecoin_target_37174),
+            (19414, bfh(namecoin_header_19414), namecoin_target_19414),
+            (233281, bfh(header_zero_output_auxpow), target_zero_output_auxpow),
+        ]
+
+    def test_skip_auxpow_header(self):
+        for height, data, target in self.items:
+            self.assertEqual(len(data), auxpow.skip_auxpow_header(data, constants.net.HEADER_SIZE))
+        with self.assertRaises(Exception):
+            auxpow.skip_auxpow_header(bfh(namecoin_header_37174)[:-1], constants.net.HEADER_SIZE)
+
+    def test_verify_auxpow_batch(self):
+        self.assertIsNone(blockchain.verify_auxpow_batch(constants.net, self.items))
+        height, data, target = self.items[0]
+        bad = self.items + [(height + 1, data, target // 2**64), (height + 2, data[:-1], target)]
+        failed_height, error = blockchain.verify_auxpow_batch(constants.net, bad)
+        self.assertEqual(height + 1, failed_height)
+        self.assertIn('insufficient proof of work', error)
+
+    def test_verify_auxpow_batches_in_pool(self):
+        def verify(items, workers=3):
+            verifier = blockchain.AuxPowBatchVerifier(workers)
+            for height, data, target in items:
+                verifier.add(height, memoryview(data), target)
+            verifier.finish()
+        items = self.items * 200
+        executors = []
+        def get_executor(max_workers):
+            if not executors:
+                executors.append(ThreadPoolExecutor(max_workers))
+            return executors[-1]
+        with mock.patch.object(blockchain, 'get_auxpow_executor', get_executor):
+            verify(items)
+            self.assertEqual(1, len(executors))
+            height, data, target = self.items[0]
+            items[500] = (500, data, target // 2**64)
+            items[300] = (300, data, target // 2**64)
+            with self.assertRaises(Exception) as ctx:
+                verify(items)
+            self.assertIn('at height 300', str(ctx.exception))
+        for executor in executors:
+            executor.shutdown()
+        # a single batch is not worth sending to the pool
+        with mock.patch.object(blockchain, 'get_auxpow_executor', side_effect=AssertionError('no pool')):
+            verify(self.items)
+            verify(self.items * 200, workers=1)
+
+    def test_deserialize_from_memoryview(self):
+        real_parse_output = transaction.parse_output
+        for height, data, target in self.items:
+            chunk = bytes(7) + data + bytes(5)
+            header, end = blockchain.PureHeader.from_stream(memoryview(chunk), height, 7)
+            self.assertEqual(7 + len(data), end)
+            expected = blockchain.deserialize_full_header(data, height)
+            self.assertEqual(expected['auxpow']['coinbase_merkle_branch'], header.auxpow['coinbase_merkle_branch'])
+            self.assertEqual(expected['auxpow']['parent_header'], header.auxpow['parent_header'])
+            coinbase = header.auxpow['parent_coinbase_tx']
+            self.assertIsInstance(coinbase._cached_network_ser_bytes, bytes)
+            self.assertEqual(auxpow.fast_txid(expected['auxpow']['parent_coinbase_tx']), auxpow.fast_txid(coinbase))
+            self.assertEqual(expected['auxpow']['parent_coinbase_tx'].inputs()[0].script_sig, coinbase.inputs()[0].script_sig)
+        self.assertEqual('8a3164be45a621f85318647d425fe9f45837b8e42ec4fdd902d7f64daf61ff4a',
+                         auxpow.fast_txid(blockchain.deserialize_full_header(self.items[0][1], 37174)['auxpow']['parent_coinbase_tx']))
+        # outputs are skipped without patching the transaction module
+        self.assertIs(real_parse_output, transaction.parse_output)
+
+    def test_deserialize_coinbase_truncated(self):
+        data = bfh(namecoin_header_37174)
+        tx, end = auxpow.deserialize_coinbase_tx(data, constants.net.HEADER_SIZE)
+        with self.assertRaises(transaction.SerializationError):
+            auxpow.deserialize_coinbase_tx(memoryview(data)[:end - 1], constants.net.HEADER_SIZE)
+
+
 def update_merkle_root_to_match_coinbase(auxpow_header):
     """Updates the parent block merkle root
 
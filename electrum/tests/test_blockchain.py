@@ -1,11 +1,15 @@
 import shutil
 import tempfile
 import os
+import json
+from unittest import mock
 
 from electrum import constants, blockchain
 from electrum.simple_config import SimpleConfig
-from electrum.blockchain import Blockchain, deserialize_pure_header, hash_header
-from electrum.util import bh2u, bfh, make_dir
+from electrum.blockchain import Blockchain, PureHeader, deserialize_pure_header, hash_header
+from electrum.exceptions import MissingHeader
+from electrum.bitcoin import hash_decode
+from electrum.util import bh2u, bfh, make_dir, get_headers_dir
 
 from . import ElectrumTestCase
 
@@ -336,6 +340,281 @@ class TestBlockchain(ElectrumTestCase):
         for b in (chain_u, chain_l, chain_z):
             self.assertTrue(all([b.can_connect(b.read_header(i), False) for i in range(b.height())]))
 
+    def test_read_header_sees_appends_and_overwrites(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        for name in 'ABCDEF':
+            chain.save_header(self.HEADERS[name])
+            # file grows while mapped
+            self.assertEqual(self.HEADERS[name], chain.read_header(chain.height()))
+        chain.close_mmap()  # drop cached headers, so reads go to the memory map
+        self.assertEqual(self.HEADERS['C'], chain.read_header(2))
+        # returned dicts are copies
+        chain.read_header(2)['nonce'] = 42
+        self.assertEqual(self.HEADERS['C'], chain.read_header(2))
+        # overwrite and truncate while mapped
+        chain.write(bfh(blockchain.serialize_header(self.HEADERS['G'])), 5 * constants.net.HEADER_SIZE)
+        self.assertEqual(5, chain.height())
+        self.assertEqual(self.HEADERS['G']['merkle_root'], chain.read_header(5)['merkle_root'])
+        chain.write(b'', 3 * constants.net.HEADER_SIZE)
+        self.assertEqual(2, chain.height())
+        self.assertIsNone(chain.read_header(3))
+        self.assertEqual(self.HEADERS['C'], chain.read_header(2))
+
+    def test_verify_chunk_sees_pending_headers_without_writing(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        chain.save_header(self.HEADERS['A'])
+        names = 'ABCDEFOPQRSTU'
+        data = b''.join(bfh(blockchain.serialize_header(self.HEADERS[name])) for name in names)
+
+        def verify_header(header, prev_hash, expected_hash, check_pow=True):
+            height = header.height
+            self.assertEqual(self.HEADERS[names[height]], header.to_dict())
+            # previous headers of the chunk are visible, the rest of the file is not
+            self.assertEqual(bh2u(prev_hash[::-1]), hash_header(chain.read_header(height - 1)))
+            if height > 0:
+                self.assertIsNone(chain.read_header(height))
+                self.assertIsNone(expected_hash)
+            # and nothing has been written yet
+            self.assertEqual(constants.net.HEADER_SIZE, os.path.getsize(chain.path()))
+        chain._verify_header = verify_header
+
+        stripped, hashes = chain.verify_chunk(0, data)
+        self.assertEqual(data, stripped)
+        self.assertEqual([hash_decode(hash_header(self.HEADERS[name])) for name in names], hashes)
+        self.assertEqual(0, chain.height())
+        self.assertIsNone(chain.read_header(1))
+        # the header hash index uses the hashes computed while verifying
+        with mock.patch.object(PureHeader, 'hash', side_effect=AssertionError('hashed again')):
+            chain.save_chunk(0, stripped, hashes)
+        self.assertEqual(12, chain.height())
+        self.assertEqual(self.HEADERS['U'], chain.read_header(12))
+
+    def test_difficulty_window_is_maintained_incrementally(self):
+        blockchain.blockchains[constants.net.GENESIS] = chain = Blockchain(
+            config=self.config, forkpoint=0, parent=None,
+            forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        open(chain.path(), 'w+').close()
+        for name in 'ABCDEF':
+            chain.save_header(self.HEADERS[name])
+        window = lambda names: [(self.HEADERS[n]['timestamp'], self.HEADERS[n]['bits']) for n in names]
+        self.assertEqual(window('FED'), chain.get_difficulty_window(5, 3))
+        for name in 'OPQ':
+            chain.save_header(self.HEADERS[name])
+        with mock.patch.object(chain, 'read_header', side_effect=AssertionError('should not read')):
+            self.assertEqual(window('QPO'), chain.get_difficulty_window(8, 3))
+            self.assertEqual(window('PO'), chain.get_difficulty_window(7, 2))
+        # rewriting the chain invalidates the window
+        chain.write(bfh(blockchain.serialize_header(self.HEADERS['G'])), 6 * constants.net.HEADER_SIZE)
+        self.assertEqual(window('GFE'), chain.get_difficulty_window(6, 3))
+        with self.assertRaises(MissingHeader):
+            chain.get_difficulty_window(7, 3)
+
+    def test_pure_header_matches_header_dict(self):
+        for name, header in self.HEADERS.items():
+            raw = bfh(blockchain.serialize_header(header))
+            pure = PureHeader(raw, header['block_height'])
+            self.assertEqual(hash_header(header), pure.hash_hex())
+            self.assertEqual(hash_header(header), hash_header(pure))
+            self.assertEqual(bfh(header['prev_block_hash'])[::-1], pure.prev_hash)
+            self.assertEqual(header, pure.to_dict())
+            for key in header:
+                self.assertEqual(header[key], pure[key])
+            self.assertIsNone(pure.get('auxpow'))
+            self.assertEqual(raw, PureHeader.from_dict(header).raw)
+        # to_dict gives out copies
+        pure.to_dict()['bits'] = 0
+        self.assertEqual(self.HEADERS['Z']['bits'], pure.to_dict()['bits'])
+
+    @mock.patch.object(Blockchain, '_verify_header', return_value=None)
+    def test_header_hash_index_follows_forks_and_swaps(self, mock_verify_header):
+        blockchain.header_hash_index.clear()
+        make_dir(os.path.join(get_headers_dir(self.config), 'forks'))
+        with mock.patch.object(constants.net, 'CHECKPOINTS', []):
+            blockchain.blockchains[constants.net.GENESIS] = chain_u = Blockchain(
+                config=self.config, forkpoint=0, parent=None,
+                forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+            open(chain_u.path(), 'w+').close()
+            for name in 'ABCDEFOPQ':
+                self._append_header(chain_u, self.HEADERS[name])
+            chain_l = chain_u.fork(self.HEADERS['G'])
+            for name in 'HIJKL':
+                self._append_header(chain_l, self.HEADERS[name])
+        # chain_l became stronger, and took over the headers up to F
+        self.assertIsNone(chain_l.parent)
+
+        with mock.patch.object(Blockchain, 'check_header', side_effect=AssertionError('scanned chains')):
+            for name in 'ABCDEFGHIJKL':
+                self.assertIs(chain_l, blockchain.check_header(self.HEADERS[name]))
+            for name in 'OPQ':
+                self.assertIs(chain_u, blockchain.check_header(self.HEADERS[name]))
+            self.assertIsNone(blockchain.check_header(self.HEADERS['R']))
+            self.assertIs(chain_u, blockchain.can_connect(self.HEADERS['R']))
+            self.assertIsNone(blockchain.can_connect(self.HEADERS['M']))
+            self.assertIsNone(blockchain.can_connect(self.HEADERS['Z']))
+
+        # overwritten headers are dropped from the index
+        chain_u.write(bfh(blockchain.serialize_header(self.HEADERS['G'])), 0)
+        self.assertIsNone(blockchain.header_hash_index.get(hash_decode(hash_header(self.HEADERS['P']))))
+        self.assertIsNone(blockchain.check_header(self.HEADERS['P']))
+
+        # only recent headers are indexed; older ones are found by asking every chain
+        blockchain.header_hash_index.raise_floor(blockchain.HEADER_HASH_INDEX_DEPTH + 2)
+        self.assertIsNone(blockchain.header_hash_index.get(hash_decode(hash_header(self.HEADERS['A']))))
+        self.assertIs(chain_l, blockchain.check_header(self.HEADERS['A']))
+        blockchain.header_hash_index.clear()
+
+    def test_restart_with_preallocated_checkpoint_region(self):
+        checkpoints = [[f"{i + 1:064x}", 2 ** 224] for i in range(3)]
+        with mock.patch.object(constants.net, 'CHECKPOINTS', checkpoints):
+            blockchain.read_blockchains(self.config)
+            blockchain.init_headers_file_for_best_chain()
+            # the headers file is zero-filled up to the last checkpoint
+            blockchain.blockchains = {}
+            blockchain.read_blockchains(self.config)
+            self.assertEqual(3 * 2016 - 1, blockchain.get_best_chain().height())
+            # only the checkpoints above the floor of the index are indexed in that region
+            self.assertEqual((blockchain.get_best_chain(), 2 * 2016 - 1),
+                             blockchain.header_hash_index.get(hash_decode(checkpoints[1][0])))
+            self.assertEqual(3, sum(len(hashes) for hashes in blockchain.header_hash_index._by_height.values()))
+            # nor when zeros are written
+            chain = blockchain.get_best_chain()
+            chain.write(bytes(constants.net.HEADER_SIZE), (3 * 2016 - 2) * constants.net.HEADER_SIZE, truncate=False)
+            self.assertEqual(3, sum(len(hashes) for hashes in blockchain.header_hash_index._by_height.values()))
+        blockchain.header_hash_index.clear()
+
+    def test_import_and_export_headers(self):
+        raw = {name: bfh(blockchain.serialize_header(self.HEADERS[name])) for name in 'ABCDEFOPQ'}
+        headers_file = os.path.join(self.data_dir, 'bootstrap_headers')
+        with open(headers_file, 'wb') as f:
+            f.write(b''.join(raw[name] for name in 'ABCDEF'))
+        chunks_dir = os.path.join(self.data_dir, 'bootstrap_chunks')
+        make_dir(chunks_dir)
+        with open(os.path.join(chunks_dir, '0.chunk'), 'wb') as f:
+            f.write(b''.join(raw[name] for name in 'ABCDEFOPQ'))
+        # regtest difficulty, which bits_to_target does not accept
+        bits = self.HEADERS['A']['bits']
+        target = (bits & 0xffffff) << (8 * ((bits >> 24) - 3))
+        with mock.patch.object(constants.net, 'CHECKPOINTS', []), \
+                mock.patch.object(Blockchain, 'get_target', return_value=target), \
+                mock.patch.object(Blockchain, 'target_to_bits', return_value=bits):
+            blockchain.read_blockchains(self.config)
+            chain = blockchain.get_best_chain()
+            self.assertEqual(6, blockchain.import_headers(headers_file))
+            self.assertEqual(5, chain.height())
+            self.assertEqual(hash_header(self.HEADERS['F']), chain.get_hash(5))
+            # nothing new
+            self.assertEqual(0, blockchain.import_headers(headers_file))
+            self.assertEqual(9, blockchain.import_headers(chunks_dir))
+            self.assertEqual(8, chain.height())
+
+            exported = os.path.join(self.data_dir, 'exported_headers')
+            self.assertEqual(8, blockchain.export_headers(exported))
+            with open(exported, 'rb') as f:
+                self.assertEqual(b''.join(raw[name] for name in 'ABCDEFOPQ'), f.read())
+
+            # headers that do not connect are rejected
+            with open(headers_file, 'wb') as f:
+                f.write(b''.join(raw[name] for name in 'ABCEF'))
+            with self.assertRaises(Exception) as ctx:
+                blockchain.import_headers(headers_file)
+            self.assertIn('cannot import chunk 0', str(ctx.exception))
+            self.assertEqual(8, chain.height())
+
+    def test_write_and_extend_checkpoints(self):
+        get_hash = lambda self, height: f"{height:064x}"
+        get_target = lambda self, height: height * 1000
+        read_header = lambda self, height: {'hash': f"{height:064x}"}
+        path = os.path.join(self.data_dir, 'checkpoints.json')
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        with mock.patch.object(Blockchain, 'get_hash', get_hash), \
+                mock.patch.object(Blockchain, 'read_header', read_header), \
+                mock.patch.object(blockchain, 'hash_header', lambda header: header['hash']):
+            with mock.patch.object(Blockchain, 'height', return_value=3 * 2016 + 5), \
+                    mock.patch.object(Blockchain, 'get_target', autospec=True, side_effect=get_target) as target:
+                self.assertEqual(3, chain.write_checkpoints(path))
+                # the target after each chunk, not the target of the chunk index
+                self.assertEqual([2016, 2 * 2016, 3 * 2016], [c[0][1] for c in target.call_args_list])
+            expected = [[f"{h - 1:064x}", h * 1000] for h in (2016, 2 * 2016, 3 * 2016)]
+            with open(path) as f:
+                self.assertEqual(json.dumps(expected, indent=4), f.read())
+            # only the new chunks are computed
+            with mock.patch.object(Blockchain, 'height', return_value=5 * 2016), \
+                    mock.patch.object(Blockchain, 'get_target', autospec=True, side_effect=get_target) as target:
+                self.assertEqual(5, chain.write_checkpoints(path, extend=True))
+                self.assertEqual([4 * 2016, 5 * 2016], [c[0][1] for c in target.call_args_list])
+                expected += [[f"{h - 1:064x}", h * 1000] for h in (4 * 2016, 5 * 2016)]
+                self.assertEqual([tuple(cp) for cp in expected], chain.get_checkpoints())
+            with open(path) as f:
+                self.assertEqual(json.dumps(expected, indent=4), f.read())
+            # checkpoints of another chain are not extended
+            with open(path, 'w') as f:
+                json.dump([["00" * 32, 1]], f)
+            with mock.patch.object(Blockchain, 'height', return_value=5 * 2016):
+                with self.assertRaises(Exception):
+                    chain.write_checkpoints(path, extend=True)
+
+    def test_chainwork_index_is_persisted_and_truncated(self):
+        hashes = {h: f"{h:064x}" for h in range(0, 20 * 2016, 2016)}
+        hashes.update({h - 1: f"{h:064x}" for h in range(2016, 20 * 2016, 2016)})
+        get_hash = lambda self, height: hashes[height]
+        work_per_header = lambda self, height: 1
+
+        def new_chain():
+            return Blockchain(config=self.config, forkpoint=0, parent=None,
+                              forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+
+        with mock.patch.object(constants.net, 'TESTNET', False), \
+                mock.patch.object(Blockchain, 'get_hash', get_hash), \
+                mock.patch.object(Blockchain, 'chainwork_of_header_at_height', work_per_header):
+            chain = new_chain()
+            open(chain.path(), 'w+').close()
+            self.assertEqual(10 * 2016 + 6, chain.get_chainwork(10 * 2016 + 5))
+            self.assertEqual(10 * 64, os.path.getsize(chain.chainwork_index_path()))
+            # a fresh instance does not walk back from genesis
+            chain = new_chain()
+            with mock.patch.object(Blockchain, 'chainwork_of_header_at_height', autospec=True, return_value=1) as work:
+                self.assertEqual(10 * 2016 + 6, chain.get_chainwork(10 * 2016 + 5))
+                self.assertEqual(1, work.call_count)
+            # headers being replaced drop the records of the periods they are in
+            chain.truncate_chainwork_index(4 * 2016 + 3)
+            self.assertEqual(4 * 64, os.path.getsize(chain.chainwork_index_path()))
+            # stale records are detected by their hash and recomputed
+            hashes.update({h - 1: 'ff' * 32 for h in range(3 * 2016, 20 * 2016, 2016)})
+            self.assertEqual(10 * 2016 + 6, chain.get_chainwork(10 * 2016 + 5))
+            self.assertEqual(10 * 64, os.path.getsize(chain.chainwork_index_path()))
+            self.assertEqual(bfh('ff' * 32), new_chain()._chainwork_index[2 * 64:2 * 64 + 32])
+            # overwriting headers on disk truncates the index too
+            chain.write(b'\x00' * 2 * constants.net.HEADER_SIZE, 0)
+            chain.write(b'\x00' * constants.net.HEADER_SIZE, 0)
+            self.assertEqual(0, os.path.getsize(chain.chainwork_index_path()))
+
+    def test_chainwork_uses_target_at_height(self):
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        target = 2 ** 224 - 1
+        with mock.patch.object(Blockchain, 'get_target', autospec=True, return_value=target) as get_target:
+            self.assertEqual(2 ** 32, chain.chainwork_of_header_at_height(5 * 2016 - 1))
+            get_target.assert_called_once_with(chain, 5 * 2016 - 1)
+
+    def test_chainwork_index_of_previous_version_is_discarded(self):
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        old_path = blockchain.get_chainwork_index_path(self.config, chain.path(), version=None)
+        make_dir(os.path.dirname(old_path))
+        with open(old_path, 'wb') as f:
+            f.write(bytes(3 * 64))
+        chain = Blockchain(config=self.config, forkpoint=0, parent=None,
+                           forkpoint_hash=constants.net.GENESIS, prev_hash=None)
+        self.assertEqual(b'', chain._chainwork_index)
+        self.assertFalse(os.path.exists(old_path))
+
 
 class TestVerifyHeader(ElectrumTestCase):
 
@@ -1,11 +1,20 @@
 import asyncio
+import json
+import os
 import tempfile
+import threading
+import time
 import unittest
+from unittest import mock
 
 from electrum import constants
 from electrum.simple_config import SimpleConfig
 from electrum import blockchain
-from electrum.interface import Interface, ServerAddr
+from aiorpcx.jsonrpc import JSONRPCv2, Request
+
+from electrum import interface
+from electrum.interface import Interface, ServerAddr, RequestMetrics, NotificationSession, _MeteredConnection
+from electrum.network import Network, ServerScore, FeeEstimator, FEE_POLL_INTERVAL, SERVER_SWITCH_MIN_DWELL
 from electrum.crypto import sha256
 from electrum.util import bh2u
 
@@ -117,6 +126,297 @@ class TestNetwork(ElectrumTestCase):
         self.assertEqual(self.interface.q.qsize(), 0)
 
 
+class MockSession:
+    def is_closing(self): return False
+
+class ChunkServingMockInterface(MockInterface):
+    def __init__(self, config, network, name, tip):
+        super().__init__(config)
+        self.network = network
+        self.server = ServerAddr.from_str(f'{name}:50000:t')
+        self.session = MockSession()
+        self.ready.set_result(1)
+        self.tip = tip
+        self.served = []
+        self.bad_chunks = set()
+        self.cancelled_chunks = set()
+    async def _fetch_chunk(self, index, tip=None):
+        if index in self.cancelled_chunks:
+            raise asyncio.CancelledError()
+        self.served.append(index)
+        count = min(2016, tip - index * 2016 + 1)
+        return {'hex': 'bad' if index in self.bad_chunks else f'{self.server.host}-{index}', 'count': count}
+
+class TestPipelinedHeaderSync(ElectrumTestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        constants.select_network('Bitcoin-Regtest')
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        constants.select_network('Bitcoin-Mainnet')
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        network = MockNetwork()
+        network.config = self.config
+        network.interfaces_lock = threading.Lock()
+        self.tip = 5 * 2016 + 100
+        self.main = ChunkServingMockInterface(self.config, network, 'main', self.tip)
+        self.helper = ChunkServingMockInterface(self.config, network, 'helper', self.tip)
+        network.interfaces = {self.main.server: self.main, self.helper.server: self.helper}
+        self.connected = []
+        def connect_chunk(idx, hexdata):
+            if hexdata == 'bad':
+                return False
+            self.connected.append(idx)
+            return True
+        self.main.blockchain.connect_chunk = connect_chunk
+
+    def test_chunks_spread_over_interfaces_and_connected_in_order(self):
+        res = asyncio.get_event_loop().run_until_complete(self.main.sync_until(0, next_height=self.tip))
+        self.assertEqual(('catchup', self.tip + 1), res)
+        self.assertEqual([0, 1, 2, 3, 4, 5], self.connected)
+        self.assertTrue(self.helper.served)
+        # the last, partial, chunk is always requested from the interface that is syncing
+        self.assertIn(5, self.main.served)
+        self.assertNotIn(5, self.helper.served)
+
+    def test_bad_chunk_from_other_server_is_refetched(self):
+        self.helper.bad_chunks = {1, 3}
+        res = asyncio.get_event_loop().run_until_complete(self.main.sync_until(0, next_height=self.tip))
+        self.assertEqual(('catchup', self.tip + 1), res)
+        self.assertEqual([0, 1, 2, 3, 4, 5], self.connected)
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(self.main.served))
+
+    def test_cancelled_chunk_from_other_server_is_refetched(self):
+        # as when the session of the other server closes
+        self.helper.cancelled_chunks = {1, 3}
+        res = asyncio.get_event_loop().run_until_complete(self.main.sync_until(0, next_height=self.tip))
+        self.assertEqual(('catchup', self.tip + 1), res)
+        self.assertEqual([0, 1, 2, 3, 4, 5], self.connected)
+        self.assertEqual([0, 1, 2, 3, 4, 5], sorted(self.main.served))
+
+
+class TestServerScores(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.network = Network.__new__(Network)
+        self.network.config = self.config
+        self.network.recent_servers_lock = threading.RLock()
+        self.network._recent_servers, self.network._server_scores = [], {}
+        self.network._server_scores_modified = False
+
+    def test_score(self):
+        score = ServerScore()
+        self.assertIsNone(score.score())
+        score.add_latency(0.1)
+        self.assertAlmostEqual(0.1, score.score())
+        score.add_latency(0.6)
+        self.assertAlmostEqual(0.2, score.latency)
+        score.add_failure()
+        self.assertAlmostEqual(0.2, score.failure_rate)
+        self.assertAlmostEqual(0.2 * (1 + 10 * 0.2), score.score())
+        # successes make failures fade out
+        score.add_latency(0.2)
+        self.assertAlmostEqual(0.16, score.failure_rate)
+
+    def test_servers_sorted_by_score_and_persisted(self):
+        fast, slow, flaky, unknown = (ServerAddr(f'{name}.example.com', 50002)
+                                      for name in ('fast', 'slow', 'flaky', 'unknown'))
+        network = self.network
+        network.record_server_latency(fast, 0.05)
+        network.record_server_latency(slow, 0.5)
+        network.record_server_latency(flaky, 0.05)
+        for i in range(3):
+            network.record_server_failure(flaky)
+        self.assertEqual([fast, flaky, slow, unknown],
+                         network._sort_servers_by_score([unknown, slow, flaky, fast]))
+
+        network._recent_servers = [unknown, slow, fast]
+        network._save_recent_servers()
+        servers, scores = network._read_recent_servers()
+        self.assertEqual([unknown, slow, fast], servers)
+        self.assertEqual({slow, fast}, set(scores))
+        self.assertAlmostEqual(0.05, scores[fast].score())
+
+    def test_only_comparable_requests_are_scored(self):
+        server = ServerAddr('a.example.com', 50002)
+        self.network.request_metrics = RequestMetrics()
+        session = NotificationSession.__new__(NotificationSession)
+        session.interface = mock.Mock(network=self.network, server=server)
+        future = asyncio.get_event_loop().create_future()
+        # wallet requests, only sent to the main interface
+        session._record('blockchain.transaction.get', 2.0, b'', future)
+        session._record('blockchain.scripthash.get_history', None, b'', future)
+        self.assertIsNone(self.network.get_server_score(server))
+        session._record('server.ping', 0.1, b'', future)
+        session._record('server.ping', None, b'', future)
+        self.assertAlmostEqual(0.1 * (1 + 10 * 0.2), self.network.get_server_score(server))
+        self.assertEqual(4, sum(stats['count'] for stats in self.network.request_metrics.to_json()[str(server)].values()))
+
+    def test_switch_slow_interface(self):
+        network = self.network
+        network.auto_connect = True
+        network.logger = mock.Mock()
+        network.interfaces_lock = threading.Lock()
+        main, fast = (mock.Mock(server=ServerAddr(f'{name}.example.com', 50002), tip_header={'block_height': 1})
+                      for name in ('main', 'fast'))
+        network.interface = main
+        network.interfaces = {main.server: main, fast.server: fast}
+        network.switch_to_interface = mock.Mock(side_effect=lambda server: asyncio.sleep(0))
+        network.record_server_latency(main.server, 0.5)
+        network.record_server_latency(fast.server, 0.1)
+        run = asyncio.get_event_loop().run_until_complete
+        # not right after the main interface was set
+        network._interface_since = time.monotonic()
+        run(network.switch_slow_interface())
+        network.switch_to_interface.assert_not_called()
+        network._interface_since = time.monotonic() - SERVER_SWITCH_MIN_DWELL
+        run(network.switch_slow_interface())
+        network.switch_to_interface.assert_called_once_with(fast.server)
+
+    def test_scores_saved_only_when_modified(self):
+        network = self.network
+        server = ServerAddr('a.example.com', 50002)
+        network._recent_servers = [server]
+        with mock.patch.object(network, '_save_recent_servers', wraps=network._save_recent_servers) as save:
+            network.save_server_scores()
+            save.assert_not_called()
+            network.record_server_latency(server, 0.1)
+            network.record_server_latency(server, 0.2)
+            network.save_server_scores()
+            network.save_server_scores()
+            save.assert_called_once_with()
+        self.assertIn(server, network._read_recent_servers()[1])
+
+    def test_read_recent_servers_without_scores(self):
+        with open(os.path.join(self.config.path, 'recent_servers'), 'w') as f:
+            json.dump(['a.example.com:50002:s'], f)
+        self.assertEqual(([ServerAddr('a.example.com', 50002)], {}), self.network._read_recent_servers())
+
+
+class TestRequestMetrics(ElectrumTestCase):
+
+    def test_record(self):
+        server = ServerAddr('a.example.com', 50002)
+        metrics = RequestMetrics()
+        metrics.record(server, 'server.ping', 0.02, 50, 40)
+        metrics.record(server, 'server.ping', 3, 50, 60, errors=1)
+        metrics.record(server, 'server.ping', None, 50, 0)
+        metrics.record(server, 'blockchain.scripthash.subscribe', 0.2, 900, 800, count=10)
+        stats = metrics.to_json()
+        ping = stats[str(server)]['server.ping']
+        self.assertEqual((3, 1, 1, 150, 100), tuple(ping[k] for k in ('count', 'errors', 'timeouts', 'bytes_out', 'bytes_in')))
+        self.assertAlmostEqual(1.51, ping['latency_avg'])
+        self.assertEqual(1, ping['latency_histogram']['<=0.025s'])
+        self.assertEqual(1, ping['latency_histogram']['<=5s'])
+        self.assertEqual(2, sum(ping['latency_histogram'].values()))
+        self.assertEqual(10, stats[str(server)]['blockchain.scripthash.subscribe']['latency_histogram']['<=0.25s'])
+        metrics.reset()
+        self.assertEqual({}, metrics.to_json())
+
+    def test_response_size(self):
+        async def run():
+            connection = _MeteredConnection(JSONRPCv2)
+            message, future = connection.send_request(Request('server.ping', []))
+            response = b'{"jsonrpc": "2.0", "result": null, "id": 0}'
+            connection.receive_message(response)
+            self.assertIsNone(await future)
+            return len(response), future.response_size
+        size, response_size = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual(size, response_size)
+
+    def test_private_aiorpcx_api_is_checked(self):
+        interface._check_aiorpcx_private_api()
+        with mock.patch.object(interface.RPCSession, '_send_concurrent', None):
+            with self.assertRaises(ImportError):
+                interface._check_aiorpcx_private_api()
+
+
+class FeeEstimateSession:
+    def __init__(self, fees):
+        self.fees = fees
+        self.batches = []
+
+    async def send_request_batch(self, requests, *, timeout=None):
+        self.batches.append(requests)
+        return [self.fees.get(params[0]) for method, params in requests]
+
+
+class FeeEstimateInterface:
+    def __init__(self, name, fees):
+        self.server = ServerAddr(f'{name}.example.com', 50002)
+        self.session = FeeEstimateSession(fees)
+        self.fee_estimates_eta = {}
+
+
+class TestFeeEstimator(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.network = Network.__new__(Network)
+        self.network.config = SimpleConfig({'electrum_path': self.electrum_path})
+        self.network.interfaces_lock = threading.Lock()
+        self.network.auto_connect = False
+        self.network.update_fee_estimates = lambda: None
+        self.estimator = self.network.fee_estimator = FeeEstimator(self.network)
+
+    def set_interfaces(self, main, *others):
+        self.network.interface = main
+        self.network.interfaces = {i.server: i for i in (main,) + others}
+
+    def test_main_interface_only_one_batch(self):
+        main = FeeEstimateInterface('main', {25: 0.0001, 10: 0.0002, 5: 0.0004, 2: 0.0008})
+        other = FeeEstimateInterface('other', {})
+        self.set_interfaces(main, other)
+        asyncio.get_event_loop().run_until_complete(self.estimator.refresh())
+        self.assertEqual([[('blockchain.estimatefee', [n]) for n in (25, 10, 5, 2)]], main.session.batches)
+        self.assertEqual([], other.session.batches)
+        self.assertEqual({25: 10000, 10: 20000, 5: 40000, 2: 80000}, self.network.get_fee_estimates())
+
+    def test_median_of_sample(self):
+        self.network.auto_connect = True
+        interfaces = [FeeEstimateInterface(name, {25: fee, 10: -1})
+                      for name, fee in (('a', 0.0001), ('b', 0.0005), ('c', 0.0002), ('d', 0.0003))]
+        self.set_interfaces(*interfaces)
+        asyncio.get_event_loop().run_until_complete(self.estimator.refresh())
+        asked = [i for i in interfaces if i.session.batches]
+        self.assertEqual(3, len(asked))
+        self.assertIn(interfaces[0], asked)
+        fees = sorted(i.fee_estimates_eta[25] for i in asked)
+        # a negative estimate is no estimate
+        self.assertEqual({25: fees[1]}, self.network.get_fee_estimates())
+
+    def test_interval_stretched_while_stable(self):
+        fees = {25: 0.0001}
+        self.set_interfaces(FeeEstimateInterface('main', fees))
+
+        async def run():
+            for fee in (0.0001, 0.0001, 0.000102, 0.0001, 0.0002):
+                fees[25] = fee
+                await self.estimator.refresh()
+                intervals.append(self.estimator.interval)
+        intervals = []
+        asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual([FEE_POLL_INTERVAL, 2 * FEE_POLL_INTERVAL, 4 * FEE_POLL_INTERVAL,
+                          8 * FEE_POLL_INTERVAL, FEE_POLL_INTERVAL], intervals)
+
+    def test_refresh_on_new_block(self):
+        self.estimator.on_new_block(100)
+        self.assertFalse(self.estimator._refresh_event.is_set())
+        self.estimator.on_new_block(100)
+        self.assertFalse(self.estimator._refresh_event.is_set())
+        self.estimator.on_new_block(101)
+        self.assertTrue(self.estimator._refresh_event.is_set())
+
+
 if __name__=="__main__":
     constants.set_regtest()
     unittest.main()
@@ -0,0 +1,112 @@
+import asyncio
+from unittest import mock
+
+from aiorpcx import TaskGroup
+
+from electrum import bitcoin
+from electrum.interface import ScripthashSubscriptions
+from electrum.logging import Logger
+from electrum.synchronizer import SynchronizerBase
+
+from . import ElectrumTestCase
+
+
+class FakeSession:
+
+    def __init__(self):
+        self.batches = []
+        self.statuses = {}
+        self.subscriptions = {}
+
+    async def subscribe_batch(self, method, params_list, queue):
+        self.batches.append([params[0] for params in params_list])
+        await asyncio.sleep(0)
+        for params in params_list:
+            self.subscriptions[params[0]] = queue
+            await queue.put(params + [self.statuses.get(params[0])])
+        return [None] * len(params_list)
+
+    async def notify(self, h, status):
+        self.statuses[h] = status
+        await self.subscriptions[h].put([h, status])
+
+
+class FakeInterface:
+
+    def __init__(self):
+        self.session = FakeSession()
+        self.taskgroup = TaskGroup()
+
+
+def drain(queue):
+    items = []
+    while not queue.empty():
+        items.append(queue.get_nowait())
+    return sorted(items, key=lambda item: item[0])
+
+
+class TestScripthashSubscriptions(ElectrumTestCase):
+
+    def test_shared_subscriptions(self):
+        async def run():
+            subscriptions = ScripthashSubscriptions()
+            interface = FakeInterface()
+            await subscriptions.switch_interface(interface)
+            wallet1, wallet2 = asyncio.Queue(), asyncio.Queue()
+            self.assertEqual([None, None], await subscriptions.subscribe(['a', 'b'], wallet1))
+            self.assertEqual([None, None], await subscriptions.subscribe(['b', 'c'], wallet2))
+            # 'b' was only sent once
+            self.assertEqual([['a', 'b'], ['c']], interface.session.batches)
+            self.assertEqual([['a', None], ['b', None]], drain(wallet1))
+            self.assertEqual([['b', None], ['c', None]], drain(wallet2))
+            # notifications go to every consumer
+            await interface.session.notify('b', 'status_b')
+            self.assertEqual([['b', 'status_b']], drain(wallet1))
+            self.assertEqual([['b', 'status_b']], drain(wallet2))
+            subscriptions.unsubscribe(wallet1)
+            await interface.session.notify('b', 'status_b2')
+            self.assertEqual([], drain(wallet1))
+            self.assertEqual([['b', 'status_b2']], drain(wallet2))
+            # on a new main interface, everything is resubscribed at once
+            new_interface = FakeInterface()
+            new_interface.session.statuses['c'] = 'status_c'
+            async with new_interface.taskgroup:
+                await subscriptions.switch_interface(new_interface)
+                self.assertEqual([None, None], await subscriptions.subscribe(['b', 'c'], wallet1))
+            self.assertEqual([['b', 'c']], new_interface.session.batches)
+            self.assertEqual([['b', None], ['c', 'status_c']], drain(wallet1))
+            # the old session does not reach the consumers anymore
+            await interface.session.notify('c', 'stale')
+            self.assertEqual([], drain(wallet1))
+
+        asyncio.get_event_loop().run_until_complete(run())
+
+
+class TestSynchronizerBase(ElectrumTestCase):
+
+    def test_subscriptions_are_batched(self):
+        addrs = [bitcoin.hash160_to_p2pkh(i.to_bytes(20, 'big')) for i in range(250)]
+        interface = FakeInterface()
+
+        async def run():
+            sync = SynchronizerBase.__new__(SynchronizerBase)
+            sync.network = mock.Mock()
+            sync.network.config.get.return_value = 100
+            sync.network.scripthash_subscriptions = ScripthashSubscriptions()
+            await sync.network.scripthash_subscriptions.switch_interface(interface)
+            Logger.__init__(sync)
+            sync._reset()
+            for addr in addrs:
+                await sync._add_address(addr)
+            task = asyncio.ensure_future(sync.send_subscriptions())
+            while sync.requested_addrs:
+                await asyncio.sleep(0.01)
+            task.cancel()
+            await sync.taskgroup.cancel_remaining()
+            return sync
+
+        sync = asyncio.get_event_loop().run_until_complete(run())
+        self.assertEqual([100, 100, 50], [len(batch) for batch in interface.session.batches])
+        self.assertEqual((250, 250), sync.num_requests_sent_and_answered())
+        self.assertEqual(set(addrs), set(sync.scripthash_to_address.values()))
+        self.assertEqual(250, sync.status_queue.qsize())
@@ -0,0 +1,91 @@
+import asyncio
+from unittest import mock
+
+from electrum.network import Network
+from electrum.simple_config import SimpleConfig
+from electrum.transaction import Transaction
+from electrum.tx_cache import TxCache
+
+from . import ElectrumTestCase
+from .test_transaction import signed_blob
+
+
+class TestTxCache(ElectrumTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = SimpleConfig({'electrum_path': self.electrum_path})
+
+    def run_with_cache(self, coro_func, **config):
+        async def run():
+            for k, v in config.items():
+                self.config.set_key(k, v)
+            network = mock.Mock(asyncio_loop=asyncio.get_event_loop(), config=self.config)
+            self.cache = TxCache(network)
+            # nothing else wakes up the loop here
+            return await asyncio.wait_for(coro_func(self.cache), 5)
+        try:
+            return asyncio.get_event_loop().run_until_complete(run())
+        finally:
+            # the sql thread stops with the loop
+            self.cache.sql_thread.join()
+
+    def test_add_get_and_persist(self):
+        txid = Transaction(signed_blob).txid()
+
+        async def fill(cache):
+            self.assertIsNone(await cache.get_tx(txid))
+            await cache.add_tx(txid, signed_blob)
+            self.assertEqual(signed_blob, await cache.get_tx(txid))
+            return cache.get_stats()
+
+        stats = self.run_with_cache(fill)
+        self.assertEqual((1, 1, 0.5, 1), (stats['hits'], stats['misses'], stats['hit_rate'], stats['num_txs']))
+
+        async def reopen(cache):
+            return await cache.get_tx(txid), cache.get_stats()
+        raw, stats = self.run_with_cache(reopen)
+        self.assertEqual(signed_blob, raw)
+        self.assertEqual(len(signed_blob) // 2, stats['size'])
+
+    def test_eviction(self):
+        # room for two copies of the tx, not three
+        budget_mb = 2.5 * (len(signed_blob) // 2) / (1024 * 1024)
+
+        async def fill(cache):
+            # stored under other txids, as only the budget matters here
+            for i in range(3):
+                await cache.add_tx(f"{i:064x}", signed_blob)
+                if i == 1:
+                    # the first one is used again, so the second one is evicted first
+                    await cache.get_tx(f"{0:064x}")
+            # the least recently used one is gone
+            return ([await cache.get_tx(f"{i:064x}") is not None for i in range(3)],
+                    cache.get_stats()['num_txs'])
+
+        self.assertEqual(([True, False, True], 2), self.run_with_cache(fill, tx_cache_size_mb=budget_mb))
+
+    def test_failed_write_from_network_is_logged(self):
+        txid = Transaction(signed_blob).txid()
+        network = Network.__new__(Network)
+        network.logger = mock.Mock()
+        network.tx_cache = mock.Mock()
+
+        async def get_tx(txid):
+            return None
+        network.tx_cache.get_tx = get_tx
+
+        async def get_transaction_from_server(txid, *, timeout=None):
+            return signed_blob
+        network._get_transaction_from_server = get_transaction_from_server
+
+        async def run():
+            write = asyncio.get_event_loop().create_future()
+            network.tx_cache.add_tx.return_value = write
+            self.assertEqual(signed_blob, await network.get_transaction(txid))
+            network.tx_cache.add_tx.assert_called_once_with(txid, signed_blob)
+            write.set_exception(Exception('disk full'))
+            await asyncio.sleep(0)
+
+        asyncio.get_event_loop().run_until_complete(run())
+        network.logger.warning.assert_called_once()
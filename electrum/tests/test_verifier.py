@@ -1,11 +1,18 @@
 # -*- coding: utf-8 -*-
+import asyncio
+from unittest import mock
 
-from electrum.bitcoin import hash_encode
+import aiorpcx
+
+from electrum.bitcoin import hash_encode, hash_decode
+from electrum.crypto import sha256d
+from electrum.logging import Logger
+from electrum.network import UntrustedServerReturnedError
 from electrum.transaction import Transaction
 from electrum.util import bfh
 from electrum.verifier import SPV, InnerNodeOfSpvProofIsValidTx
 
-from . import TestCaseForTestnet
+from . import ElectrumTestCase, TestCaseForTestnet
 
 
 MERKLE_BRANCH = [
@@ -48,3 +55,47 @@ class VerifierTestCase(TestCaseForTestnet):
         f_tx_hash = hash_encode(bfh(VALID_64_BYTE_TX[:64]))
         with self.assertRaises(InnerNodeOfSpvProofIsValidTx):
             SPV.hash_merkle_root(fake_mbranch, f_tx_hash, 6)
+
+
+class BatchedVerificationTestCase(ElectrumTestCase):
+
+    def test_block_header_read_once_per_batch(self):
+        tx_a, tx_b, tx_c = 'aa' * 32, 'bb' * 32, 'cc' * 32
+        merkle_root = hash_encode(sha256d(hash_decode(tx_a) + hash_decode(tx_b)))
+        header = {'merkle_root': merkle_root, 'timestamp': 1234, 'version': 1,
+                  'prev_block_hash': '00' * 32, 'bits': 0, 'nonce': 0, 'block_height': 7}
+        results = [
+            {'block_height': 7, 'pos': 0, 'merkle': [tx_b]},
+            {'block_height': 7, 'pos': 1, 'merkle': [tx_a]},
+            UntrustedServerReturnedError(original_exception=aiorpcx.jsonrpc.RPCError(1, 'not at height')),
+        ]
+        wallet = mock.Mock()
+        wallet.diagnostic_name.return_value = 'wallet'
+        network = mock.Mock()
+        network.config.get.return_value = None
+        chain = network.blockchain.return_value
+        chain.read_header.return_value = header
+
+        async def get_merkle_for_transactions(txs):
+            self.assertEqual([(tx_a, 7), (tx_b, 7), (tx_c, 7)], txs)
+            return results
+        network.get_merkle_for_transactions = get_merkle_for_transactions
+
+        async def run():
+            network.bhi_lock = asyncio.Lock()
+            spv = SPV.__new__(SPV)
+            spv.wallet = wallet
+            spv.network = network
+            Logger.__init__(spv)
+            spv._reset()
+            spv.requested_merkle.update((tx_a, tx_b, tx_c))
+            await spv._request_and_verify_proofs([(tx_a, 7), (tx_b, 7), (tx_c, 7)])
+            return spv
+
+        spv = asyncio.get_event_loop().run_until_complete(run())
+        chain.read_header.assert_called_once_with(7)
+        self.assertEqual({tx_a: merkle_root, tx_b: merkle_root}, spv.merkle_roots)
+        self.assertTrue(spv.is_up_to_date())
+        self.assertEqual([tx_a, tx_b], [c[0][0] for c in wallet.add_verified_tx.call_args_list])
+        self.assertEqual(1, wallet.add_verified_tx.call_args_list[1][0][1].txpos)
+        wallet.remove_unverified_tx.assert_called_once_with(tx_c, 7)
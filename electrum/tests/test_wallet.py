@@ -1,3 +1,4 @@
+import asyncio
 import shutil
 import tempfile
 import sys
@@ -7,12 +8,14 @@ from decimal import Decimal
 import time
 
 from io import StringIO
-from electrum.storage import WalletStorage
+from unittest import mock
+from electrum.storage import WalletStorage, StorageEncryptionVersion
+from electrum.json_db import apply_journal_entries
 from electrum.wallet_db import FINAL_SEED_VERSION
-from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet,
+from electrum.wallet import (Abstract_Wallet, Standard_Wallet, create_new_wallet, Wallet,
                              restore_wallet_from_text, Imported_Wallet)
 from electrum.exchange_rate import ExchangeBase, FxThread
-from electrum.util import TxMinedInfo
+from electrum.util import TxMinedInfo, create_and_start_event_loop, InvalidPassword, WalletFileException
 from electrum import constants
 from electrum.wallet_db import WalletDB
 from electrum.simple_config import SimpleConfig
@@ -83,6 +86,54 @@ class TestWalletStorage(WalletTestCase):
         for key, value in some_dict.items():
             self.assertEqual(d[key], value)
 
+    def write_encrypted(self, plaintext, password):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password(password, StorageEncryptionVersion.USER_PASSWORD)
+        storage.write(plaintext)
+        return storage
+
+    def test_chunked_encryption(self):
+        plaintext = json.dumps({str(i): os.urandom(20).hex() for i in range(3000)})
+        with mock.patch('electrum.storage.CHUNK_SIZE', 10000):
+            self.write_encrypted(plaintext, 'secret')
+        with open(self.wallet_path) as f:
+            lines = f.read().split()
+        self.assertEqual(1 + (len(plaintext) + 9999) // 10000, len(lines))
+        storage = WalletStorage(self.wallet_path)
+        self.assertTrue(storage.is_encrypted_with_user_pw())
+        with self.assertRaises(InvalidPassword):
+            storage.decrypt('wrong')
+        storage.decrypt('secret')
+        self.assertEqual(plaintext, storage.read())
+
+        # chunks are authenticated, in their position
+        for bad_lines in (lines[:1] + lines[2:3] + lines[1:2] + lines[3:],
+                          lines[:2] + [lines[3][:-8] + lines[2][-8:]] + lines[3:]):
+            with open(self.wallet_path, 'w') as f:
+                f.write('\n'.join(bad_lines))
+            with self.assertRaises(InvalidPassword):
+                WalletStorage(self.wallet_path).decrypt('secret')
+        with open(self.wallet_path, 'w') as f:
+            f.write('\n'.join(lines[:-1]))
+        with self.assertRaises(WalletFileException):
+            WalletStorage(self.wallet_path).decrypt('secret')
+
+    def test_single_message_encryption_is_read(self):
+        storage = WalletStorage(self.wallet_path)
+        storage.set_password('secret', StorageEncryptionVersion.USER_PASSWORD)
+        with open(self.wallet_path, 'w') as f:
+            f.write(storage.encrypt_before_writing('{"a": 1}'))
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt('secret')
+        self.assertEqual('{"a": 1}', storage.read())
+        # rewritten in chunks
+        storage.write(storage.read())
+        storage = WalletStorage(self.wallet_path)
+        storage.decrypt('secret')
+        self.assertEqual('{"a": 1}', storage.read())
+        with open(self.wallet_path) as f:
+            self.assertEqual(2, len(f.read().split()))
+
 class FakeExchange(ExchangeBase):
     def __init__(self, rate):
         super().__init__(lambda self: None, lambda self: None)
@@ -229,3 +280,306 @@ class TestCreateRestoreWallet(WalletTestCase):
         # also test addr deletion
         wallet.delete_address('bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c')
         self.assertEqual(1, len(wallet.get_receiving_addresses()))
+
+
+class WalletWithTxsTestCase(WalletTestCase):
+
+    addr_a = 'bc1q2ccr34wzep58d4239tl3x3734ttle92a8srmuw'
+    addr_b = 'bc1qnp78h78vp92pwdwq5xvh8eprlga5q8gu66960c'
+    addr_other = '1BvBMSEYstWetqTFn5Au4m4GFg7xJaNVN2'
+
+    def setUp(self):
+        super().setUp()
+        text = f'{self.addr_a} {self.addr_b}'
+        self.wallet = restore_wallet_from_text(text, path=self.wallet_path, config=self.config)['wallet']
+        self.set_local_height(200)
+        # for the 'verified' callback; earlier tests might have closed the default loop
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        self.asyncio_loop, self._stop_loop, self._loop_thread = create_and_start_event_loop()
+
+    def tearDown(self):
+        self.asyncio_loop.call_soon_threadsafe(self._stop_loop.set_result, 1)
+        self._loop_thread.join(timeout=1)
+        super().tearDown()
+
+    def set_local_height(self, height):
+        self.wallet.db.put('stored_height', height)
+
+    @classmethod
+    def make_tx(cls, prevouts, outputs):
+        from electrum.bitcoin import address_to_script
+        raw = (2).to_bytes(4, 'little') + bytes([len(prevouts)])
+        for txid, n in prevouts:
+            raw += bytes.fromhex(txid)[::-1] + n.to_bytes(4, 'little') + b'\x01\x51' + b'\xff' * 4
+        raw += bytes([len(outputs)])
+        for addr, value in outputs:
+            script = bytes.fromhex(address_to_script(addr))
+            raw += value.to_bytes(8, 'little') + bytes([len(script)]) + script
+        raw += bytes(4)
+        from electrum.transaction import Transaction
+        return Transaction(raw.hex())
+
+    def add_tx(self, tx, height):
+        if height > 0:
+            self.verify_tx(tx, height)
+        else:
+            self.wallet.add_unverified_tx(tx.txid(), height)
+        self.assertTrue(self.wallet.add_transaction(tx))
+
+    def verify_tx(self, tx, height):
+        # one block every 10 minutes
+        info = TxMinedInfo(height=height, timestamp=height * 600, txpos=1, header_hash='00' * 32)
+        self.wallet.add_verified_tx(tx.txid(), info)
+
+
+class TestCoinIndex(WalletWithTxsTestCase):
+
+    def get_addr_balance_from_history(self, address, excluded_coins=frozenset()):
+        # what get_addr_balance used to compute, from the history of the address
+        received, sent = self.wallet.get_addr_io(address)
+        c = u = x = 0
+        mempool_height = self.wallet.get_local_height() + 1
+        for txo, (tx_height, v, is_cb) in received.items():
+            if txo in excluded_coins:
+                continue
+            if is_cb and tx_height + constants.net.COINBASE_MATURITY > mempool_height:
+                x += v
+            elif tx_height > 0:
+                c += v
+            else:
+                u += v
+            if txo in sent:
+                if sent[txo] > 0:
+                    c -= v
+                else:
+                    u -= v
+        return c, u, x
+
+    def assertIndexMatchesHistory(self, **kwargs):
+        for addr in (self.addr_a, self.addr_b):
+            self.assertEqual(self.get_addr_balance_from_history(addr, **kwargs),
+                             self.wallet.get_addr_balance(addr, **kwargs))
+            received, sent = self.wallet.get_addr_io(addr)
+            utxos = {prevout.to_str(): utxo.block_height for prevout, utxo in self.wallet.get_addr_utxo(addr).items()}
+            self.assertEqual({txo: v[0] for txo, v in received.items() if txo not in sent}, utxos)
+
+    def test_balances_and_utxos(self):
+        wallet = self.wallet
+        fund = self.make_tx([('11' * 32, 0)], [(self.addr_a, 50000), (self.addr_b, 30000)])
+        self.add_tx(fund, 0)
+        self.assertEqual((0, 80000, 0), wallet.get_balance())
+        self.assertIndexMatchesHistory()
+        self.verify_tx(fund, 100)
+        self.assertEqual((50000, 0, 0), wallet.get_addr_balance(self.addr_a))
+        self.assertIndexMatchesHistory()
+
+        spend = self.make_tx([(fund.txid(), 0)], [(self.addr_b, 20000), (self.addr_other, 25000)])
+        self.add_tx(spend, 0)
+        self.assertEqual((50000, -50000, 0), wallet.get_addr_balance(self.addr_a))
+        self.assertEqual({}, wallet.get_addr_utxo(self.addr_a))
+        self.assertEqual((80000, -30000, 0), wallet.get_balance())
+        self.assertIndexMatchesHistory()
+        self.assertIndexMatchesHistory(excluded_coins={fund.txid() + ':1'})
+
+        coinbase = self.make_tx([('00' * 32, 0xffffffff)], [(self.addr_a, 100000)])
+        self.add_tx(coinbase, 150)
+        self.assertEqual((80000, -30000, 100000), wallet.get_balance())
+        self.assertEqual(2, len(wallet.get_utxos(mature_only=True)))
+        self.assertIndexMatchesHistory()
+        self.set_local_height(248)
+        self.assertEqual((50000, -50000, 100000), wallet.get_addr_balance(self.addr_a))
+        self.set_local_height(249)
+        self.assertEqual((150000, -50000, 0), wallet.get_addr_balance(self.addr_a))
+        self.assertEqual(3, len(wallet.get_utxos(mature_only=True)))
+        self.assertIndexMatchesHistory()
+        # a shorter chain
+        self.set_local_height(220)
+        self.assertEqual((50000, -50000, 100000), wallet.get_addr_balance(self.addr_a))
+        self.assertIndexMatchesHistory()
+
+        wallet.remove_transaction(spend.txid())
+        self.assertEqual((50000, 0, 100000), wallet.get_addr_balance(self.addr_a))
+        self.assertEqual((30000, 0, 0), wallet.get_addr_balance(self.addr_b))
+        self.assertIndexMatchesHistory()
+        # a reorg
+        wallet.undo_verifications(FakeBlockchain(), 120)
+        self.assertEqual((50000, 0, 100000), wallet.get_addr_balance(self.addr_a))
+        self.assertIndexMatchesHistory()
+
+        balances = {addr: wallet.get_addr_balance(addr) for addr in (self.addr_a, self.addr_b)}
+        wallet._rebuild_coin_index()
+        self.assertEqual(balances, {addr: wallet.get_addr_balance(addr) for addr in (self.addr_a, self.addr_b)})
+
+
+class FakeBlockchain:
+    def read_header(self, height):
+        return None
+
+
+class TestHistoryIndex(WalletWithTxsTestCase):
+
+    def assertIndexMatchesHistory(self):
+        # with a domain, the history is computed from the address histories
+        history = self.wallet.get_history(domain=self.wallet.get_addresses())
+        self.assertEqual(history, self.wallet.get_history())
+        return history
+
+    def test_history(self):
+        wallet = self.wallet
+        fund = self.make_tx([('11' * 32, 0)], [(self.addr_a, 50000), (self.addr_b, 30000)])
+        self.add_tx(fund, 100)
+        spend = self.make_tx([(fund.txid(), 0)], [(self.addr_b, 20000), (self.addr_other, 25000)])
+        self.add_tx(spend, 0)
+        coinbase = self.make_tx([('00' * 32, 0xffffffff)], [(self.addr_a, 100000)])
+        self.add_tx(coinbase, 150)
+        history = self.assertIndexMatchesHistory()
+        self.assertEqual([fund.txid(), coinbase.txid(), spend.txid()], [item.txid for item in history])
+        self.assertEqual([80000, 180000, 150000], [item.balance for item in history])
+
+        # inserted in the middle
+        fund2 = self.make_tx([('22' * 32, 0)], [(self.addr_b, 7000)])
+        self.add_tx(fund2, 120)
+        history = self.assertIndexMatchesHistory()
+        self.assertEqual([80000, 87000, 187000, 157000], [item.balance for item in history])
+        self.assertEqual(history[1:3], wallet.get_history(start=1, stop=3))
+        self.assertEqual(4, wallet.get_history_len())
+
+        # spend gets mined, in between
+        self.verify_tx(spend, 140)
+        history = self.assertIndexMatchesHistory()
+        self.assertEqual([fund.txid(), fund2.txid(), spend.txid(), coinbase.txid()], [item.txid for item in history])
+
+        self.assertEqual(0, wallet.get_history_position_at_timestamp(100 * 600))
+        self.assertEqual(1, wallet.get_history_position_at_timestamp(100 * 600, inclusive=False))
+        self.assertEqual(3, wallet.get_history_position_at_timestamp(141 * 600))
+        self.assertEqual(80000, wallet.balance_at_timestamp(None, 110 * 600))
+        self.assertEqual(wallet.balance_at_timestamp(wallet.get_addresses(), 140 * 600),
+                         wallet.balance_at_timestamp(None, 140 * 600))
+
+        # a reorg
+        wallet.undo_verifications(FakeBlockchain(), 130)
+        self.assertIndexMatchesHistory()
+        wallet.remove_transaction(fund2.txid())
+        history = self.assertIndexMatchesHistory()
+        self.assertEqual(3, len(history))
+
+        wallet._rebuild_history_index()
+        self.assertEqual(history, wallet.get_history())
+
+
+class TestWalletJournal(WalletWithTxsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.fund = self.make_tx([('11' * 32, 0)], [(self.addr_a, 50000), (self.addr_b, 30000)])
+        self.add_tx(self.fund, 100)
+        self.wallet.save_db()
+        self.journal_path = self.wallet.storage.journal_path
+
+    def load_wallet(self, password=None):
+        storage = WalletStorage(self.wallet_path)
+        if password:
+            storage.decrypt(password)
+        db = WalletDB(storage.read(), manual_upgrades=False)
+        return Wallet(db, storage, config=self.config)
+
+    def assertSameData(self, db1, db2):
+        def load(db):
+            data = json.loads(db.dump())
+            # sets, dumped in no particular order
+            data['prevouts_by_scripthash'] = {k: sorted(v) for k, v in data['prevouts_by_scripthash'].items()}
+            return data
+        self.assertEqual(load(db1), load(db2))
+
+    def test_apply_journal_entries(self):
+        data = {'a': {'b': 1}, 'l': [1]}
+        apply_journal_entries(data, [
+            {'op': 'add', 'path': ['a', 'c'], 'value': {'d': 2}},
+            {'op': 'remove', 'path': ['a', 'b']},
+            {'op': 'add', 'path': ['l', '-'], 'value': 2},
+            {'op': 'add', 'path': ['x', 'y'], 'value': 3},
+            {'op': 'remove', 'path': ['x', 'y']},
+        ])
+        self.assertEqual({'a': {'c': {'d': 2}}, 'l': [1, 2]}, data)
+
+    def test_journal(self):
+        wallet = self.load_wallet()
+        with open(self.wallet_path) as f:
+            base = f.read()
+        journal_size = os.path.getsize(self.journal_path)
+        tx = self.make_tx([(self.fund.txid(), 1)], [(self.addr_other, 29000)])
+        wallet.add_unverified_tx(tx.txid(), 0)
+        self.assertTrue(wallet.add_transaction(tx))
+        wallet.save_db()
+        with open(self.wallet_path) as f:
+            self.assertEqual(base, f.read())
+        self.assertLess(os.path.getsize(self.journal_path) - journal_size, 1500)
+        wallet.db.put('label_test', {'a': 1})
+        wallet.remove_transaction(tx.txid())
+        wallet.save_db()
+        wallet2 = self.load_wallet()
+        self.assertSameData(wallet.db, wallet2.db)
+        self.assertIsNone(wallet2.db.get_transaction(tx.txid()))
+        self.assertEqual({'a': 1}, wallet2.db.get('label_test'))
+
+        # changes are appended to the journal that was replayed
+        wallet2.db.put('label_test', None)
+        wallet2.save_db()
+        self.assertSameData(wallet2.db, self.load_wallet().db)
+
+        wallet2.save_db(compact=True)
+        self.assertFalse(os.path.exists(self.journal_path))
+        with open(self.wallet_path) as f:
+            self.assertIsNone(json.loads(f.read()).get('label_test'))
+        self.assertSameData(wallet2.db, self.load_wallet().db)
+
+        wallet2.clear_history()
+        self.assertTrue(os.path.exists(self.journal_path))
+        self.assertEqual([], self.load_wallet().db.list_transactions())
+
+    def test_stale_journal_is_ignored(self):
+        wallet = self.load_wallet()
+        wallet.db.put('label_test', 1)
+        wallet.save_db()
+        with open(self.journal_path) as f:
+            journal = f.read()
+        wallet.db.put('label_test', 2)
+        wallet.save_db(compact=True)
+        # as if the journal was not removed after writing the wallet file
+        with open(self.journal_path, 'w') as f:
+            f.write(journal)
+        wallet2 = self.load_wallet()
+        self.assertEqual(2, wallet2.db.get('label_test'))
+        wallet2.db.put('label_test', 3)
+        wallet2.save_db()
+        self.assertEqual(3, self.load_wallet().db.get('label_test'))
+
+    def test_interrupted_write(self):
+        wallet = self.load_wallet()
+        wallet.db.put('label_test', 1)
+        wallet.save_db()
+        wallet.db.put('label_test', 2)
+        wallet.save_db()
+        with open(self.journal_path, 'r+') as f:
+            f.truncate(os.path.getsize(self.journal_path) - 5)
+        wallet2 = self.load_wallet()
+        self.assertEqual(1, wallet2.db.get('label_test'))
+        # the wallet file is rewritten on the next save
+        wallet2.db.put('label_test', 3)
+        wallet2.save_db()
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertEqual(3, self.load_wallet().db.get('label_test'))
+
+    def test_encrypted_journal(self):
+        self.wallet.update_password(None, 'secret', encrypt_storage=True)
+        wallet = self.load_wallet('secret')
+        wallet.db.put('label_test', 'some label')
+        wallet.save_db()
+        with open(self.journal_path) as f:
+            self.assertNotIn('some label', f.read())
+        wallet2 = self.load_wallet('secret')
+        self.assertEqual('some label', wallet2.db.get('label_test'))
+        # a new password rewrites the wallet file
+        wallet2.update_password('secret', 'secret2', encrypt_storage=True)
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertEqual('some label', self.load_wallet('secret2').db.get('label_test'))
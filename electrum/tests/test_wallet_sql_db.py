@@ -0,0 +1,122 @@
+import json
+import os
+from unittest import mock
+
+from electrum.commands import Commands
+from electrum.storage import WalletStorage
+from electrum.wallet import Wallet
+from electrum.wallet_db import WalletDB
+from electrum.wallet_sql_db import (SqlWalletStorage, SqlWalletDB, convert_json_to_sql,
+                                    convert_sql_to_json, is_sql_wallet_file, SQL_TABLES,
+                                    REST_TABLE, _dumps)
+
+from .test_wallet import WalletWithTxsTestCase
+
+
+class TestSqlWalletDB(WalletWithTxsTestCase):
+
+    def setUp(self):
+        super().setUp()
+        fund = self.make_tx([('11' * 32, 0)], [(self.addr_a, 50000), (self.addr_b, 30000)])
+        self.add_tx(fund, 100)
+        spend = self.make_tx([(fund.txid(), 0)], [(self.addr_b, 20000), (self.addr_other, 25000)])
+        self.add_tx(spend, 0)
+        self.fund = fund
+        self.wallet.save_db()
+        self.sql_path = os.path.join(self.user_dir, "somewallet.sqlite")
+
+    def load_sql_wallet(self):
+        storage = SqlWalletStorage(self.sql_path)
+        db = SqlWalletDB(storage.read(), manual_upgrades=False)
+        return Wallet(db, storage, config=self.config)
+
+    def assertSameData(self, db1, db2):
+        def load(db):
+            data = json.loads(db.dump())
+            # sets, dumped in no particular order
+            data['prevouts_by_scripthash'] = {k: sorted(v) for k, v in data['prevouts_by_scripthash'].items()}
+            return data
+        self.assertEqual(load(db1), load(db2))
+
+    def test_convert(self):
+        convert_json_to_sql(self.wallet_path, self.sql_path)
+        self.assertTrue(is_sql_wallet_file(self.sql_path))
+        self.assertFalse(is_sql_wallet_file(self.wallet_path))
+        wallet = self.load_sql_wallet()
+        self.assertSameData(self.wallet.db, wallet.db)
+        self.assertEqual(self.wallet.get_balance(), wallet.get_balance())
+
+        json_path = os.path.join(self.user_dir, "somewallet.json")
+        convert_sql_to_json(self.sql_path, json_path)
+        db = WalletDB(WalletStorage(json_path).read(), manual_upgrades=False)
+        self.assertSameData(self.wallet.db, db)
+
+    def test_write_only_modified_records(self):
+        convert_json_to_sql(self.wallet_path, self.sql_path)
+        wallet = self.load_sql_wallet()
+        # nothing to write after loading
+        self.assertEqual([], wallet.db._get_changes()[0])
+        tx = self.make_tx([(self.fund.txid(), 1)], [(self.addr_other, 29000)])
+        wallet.add_unverified_tx(tx.txid(), 0)
+        self.assertTrue(wallet.add_transaction(tx))
+        changes, replace_tables = wallet.db._get_changes()
+        self.assertEqual([], replace_tables)
+        keys = {(table, key) for table, key, value in changes}
+        self.assertIn(('transactions', tx.txid()), keys)
+        self.assertIn(('txi', tx.txid()), keys)
+        self.assertIn(('spent_outpoints', self.fund.txid()), keys)
+        self.assertNotIn(('transactions', self.fund.txid()), keys)
+        self.assertNotIn(('txo', self.fund.txid()), keys)
+        # other top level keys are not serialized unless they were modified
+        with mock.patch('electrum.wallet_sql_db._dumps', side_effect=_dumps) as dumps:
+            changes, replace_tables = wallet.db._get_changes()
+        self.assertEqual(len(changes), dumps.call_count)
+        self.assertNotIn('keystore', {key for table, key, value in changes})
+        self.assertNotIn(REST_TABLE, {table for table, key, value in changes})
+        wallet.save_db()
+        self.assertFalse(wallet.db.modified())
+        self.assertSameData(wallet.db, self.load_sql_wallet().db)
+
+        wallet.remove_transaction(tx.txid())
+        wallet.db.put('label_test', {'a': 1})
+        wallet.save_db()
+        wallet2 = self.load_sql_wallet()
+        self.assertSameData(wallet.db, wallet2.db)
+        self.assertIsNone(wallet2.db.get_transaction(tx.txid()))
+        self.assertEqual({'a': 1}, wallet2.db.get('label_test'))
+
+        wallet.db.put('label_test', None)
+        wallet.clear_history()
+        wallet.save_db()
+        wallet2 = self.load_sql_wallet()
+        self.assertSameData(wallet.db, wallet2.db)
+        self.assertEqual([], wallet2.db.list_transactions())
+        self.assertIsNone(wallet2.db.get('label_test'))
+
+    def test_compact_writes_all_other_keys(self):
+        convert_json_to_sql(self.wallet_path, self.sql_path)
+        wallet = self.load_sql_wallet()
+        changes, replace_tables = wallet.db._get_changes(compact=True)
+        self.assertEqual([REST_TABLE], replace_tables)
+        self.assertEqual({key for key in wallet.db.data.keys() if key not in SQL_TABLES},
+                         {key for table, key, value in changes})
+        # as when stopping the wallet
+        wallet.save_db(compact=True)
+        self.assertSameData(wallet.db, self.load_sql_wallet().db)
+
+    def test_convert_wallet_command(self):
+        cmds = Commands(config=self.config)
+        cmds._run('convert_wallet', (self.sql_path,), wallet_path=self.wallet_path)
+        self.assertTrue(is_sql_wallet_file(self.sql_path))
+        json_path = os.path.join(self.user_dir, "somewallet.json")
+        cmds._run('convert_wallet', (json_path,), wallet_path=self.sql_path)
+        db = WalletDB(WalletStorage(json_path).read(), manual_upgrades=False)
+        self.assertSameData(self.wallet.db, db)
+
+    def test_storage_encryption_is_not_offered(self):
+        self.assertTrue(self.wallet.can_have_storage_encryption())
+        convert_json_to_sql(self.wallet_path, self.sql_path)
+        wallet = self.load_sql_wallet()
+        self.assertFalse(wallet.can_have_storage_encryption())
+        wallet.update_password(None, 'secret', encrypt_storage=True)
+        self.assertFalse(wallet.has_storage_encryption())
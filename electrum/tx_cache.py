@@ -0,0 +1,116 @@
+import os
+import threading
+from typing import Optional, TYPE_CHECKING
+
+from .sql_db import SqlDB, sql
+from .util import bfh, bh2u, get_headers_dir
+
+if TYPE_CHECKING:
+    from .network import Network
+
+
+create_txs = """
+CREATE TABLE IF NOT EXISTS txs (
+txid BLOB(32) NOT NULL,
+tx BLOB NOT NULL,
+last_used INTEGER NOT NULL,
+PRIMARY KEY(txid)
+)"""
+
+create_txs_last_used = """
+CREATE INDEX IF NOT EXISTS txs_last_used ON txs (last_used)
+"""
+
+DEFAULT_SIZE_BUDGET_MB = 100
+
+
+class TxCache(SqlDB):
+    """Raw transactions by txid, shared by all the wallets of a network,
+    so that they are not downloaded again after a restart or when another
+    wallet needs them. Callers must have checked transactions against
+    their txid. The least recently used ones are evicted once the total
+    size goes over the budget.
+    """
+
+    def __init__(self, network: 'Network'):
+        budget = network.config.get('tx_cache_size_mb', DEFAULT_SIZE_BUDGET_MB)
+        self.size_budget = int(budget * 1024 * 1024)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        # set in the sql thread, which starts in SqlDB.__init__
+        self.total_size = 0
+        self.num_txs = 0
+        self._counter = 0
+        path = os.path.join(get_headers_dir(network.config), 'tx_cache_db')
+        super().__init__(network.asyncio_loop, path, commit_interval=100)
+
+    def create_database(self):
+        c = self.conn.cursor()
+        c.execute(create_txs)
+        c.execute(create_txs_last_used)
+        self.conn.commit()
+        c.execute("SELECT count(*), coalesce(sum(length(tx)), 0), coalesce(max(last_used), 0) FROM txs")
+        self.num_txs, self.total_size, self._counter = c.fetchone()
+
+    def get_stats(self) -> dict:
+        with self.lock:
+            hits, misses = self.hits, self.misses
+        lookups = hits + misses
+        return {
+            'hits': hits,
+            'misses': misses,
+            'hit_rate': hits / lookups if lookups else None,
+            'num_txs': self.num_txs,
+            'size': self.total_size,
+            'size_budget': self.size_budget,
+        }
+
+    @sql
+    def get_tx(self, txid: str) -> Optional[str]:
+        c = self.conn.cursor()
+        c.execute("SELECT tx FROM txs WHERE txid=?", (bfh(txid),))
+        r = c.fetchone()
+        with self.lock:
+            if r is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        if r is None:
+            return None
+        self._counter += 1
+        c.execute("UPDATE txs SET last_used=? WHERE txid=?", (self._counter, bfh(txid)))
+        return bh2u(r[0])
+
+    @sql
+    def add_tx(self, txid: str, raw_tx: str) -> None:
+        raw = bfh(raw_tx)
+        if len(raw) > self.size_budget:
+            return
+        c = self.conn.cursor()
+        c.execute("SELECT length(tx) FROM txs WHERE txid=?", (bfh(txid),))
+        r = c.fetchone()
+        if r is not None:
+            self.total_size -= r[0]
+            self.num_txs -= 1
+        self._counter += 1
+        c.execute("REPLACE INTO txs (txid, tx, last_used) VALUES (?,?,?)", (bfh(txid), raw, self._counter))
+        self.total_size += len(raw)
+        self.num_txs += 1
+        if self.total_size > self.size_budget:
+            self._evict()
+
+    def _evict(self):
+        # down to 90% of the budget, so that this does not run on every insert
+        c = self.conn.cursor()
+        target = self.size_budget * 9 // 10
+        c.execute("SELECT txid, length(tx) FROM txs ORDER BY last_used")
+        evicted = []
+        for txid, size in c:
+            if self.total_size <= target:
+                break
+            evicted.append((txid,))
+            self.total_size -= size
+            self.num_txs -= 1
+        self.conn.cursor().executemany("DELETE FROM txs WHERE txid=?", evicted)
+        self.logger.info(f"evicted {len(evicted)} txs")
@@ -22,7 +22,9 @@
 # SOFTWARE.
 
 import asyncio
-from typing import Sequence, Optional, TYPE_CHECKING
+import time
+from collections import defaultdict
+from typing import Sequence, Optional, Tuple, TYPE_CHECKING
 
 import aiorpcx
 
@@ -40,6 +42,12 @@ if TYPE_CHECKING:
     from .address_synchronizer import AddressSynchronizer
 
 
+# merkle proofs are requested in JSON-RPC batches of this many txs,
+# with at most this many batches awaiting a response at a time
+MERKLE_BATCH_SIZE = 100
+MAX_CONCURRENT_MERKLE_BATCHES = 4
+
+
 class MerkleVerificationFailure(Exception): pass
 class MissingBlockHeader(MerkleVerificationFailure): pass
 class MerkleRootMismatch(MerkleVerificationFailure): pass
@@ -57,6 +65,10 @@ class SPV(NetworkJobOnDefaultServer):
         super()._reset()
         self.merkle_roots = {}  # txid -> merkle root (once it has been verified)
         self.requested_merkle = set()  # txid set of pending requests
+        self._batch_semaphore = asyncio.Semaphore(MAX_CONCURRENT_MERKLE_BATCHES)
+        # throughput of the current round of verifications, for the log
+        self._sync_started = None  # type: Optional[float]
+        self._sync_verified = 0
 
     async def _start_tasks(self):
         async with self.taskgroup as group:
@@ -76,6 +88,7 @@ class SPV(NetworkJobOnDefaultServer):
         local_height = self.blockchain.height()
         unverified = self.wallet.get_unverified_txs()
 
+        txs_by_height = defaultdict(list)
         for tx_hash, tx_height in unverified.items():
             # do not request merkle branch if we already requested it
             if tx_hash in self.requested_merkle or tx_hash in self.merkle_roots:
@@ -83,6 +96,10 @@ class SPV(NetworkJobOnDefaultServer):
             # or before headers are available
             if tx_height <= 0 or tx_height > local_height:
                 continue
+            txs_by_height[tx_height].append(tx_hash)
+
+        batch = []
+        for tx_height in sorted(txs_by_height):
             # if it's in the checkpoint region, we still might not have the header
             header = self.blockchain.read_header(tx_height)
             if header is None:
@@ -90,49 +107,78 @@ class SPV(NetworkJobOnDefaultServer):
                     await self.taskgroup.spawn(self.network.request_chunk(tx_height, None, can_return_early=True))
                 continue
             # request now
-            self.logger.info(f'requested merkle {tx_hash}')
-            self.requested_merkle.add(tx_hash)
-            await self.taskgroup.spawn(self._request_and_verify_single_proof, tx_hash, tx_height)
-
-    async def _request_and_verify_single_proof(self, tx_hash, tx_height):
-        try:
-            merkle = await self.network.get_merkle_for_transaction(tx_hash, tx_height)
-        except UntrustedServerReturnedError as e:
-            if not isinstance(e.original_exception, aiorpcx.jsonrpc.RPCError):
-                raise
-            self.logger.info(f'tx {tx_hash} not at height {tx_height}')
-            self.wallet.remove_unverified_tx(tx_hash, tx_height)
-            self.requested_merkle.discard(tx_hash)
-            return
-        # Verify the hash of the server-provided merkle branch to a
-        # transaction matches the merkle root of its block
-        if tx_height != merkle.get('block_height'):
-            self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
-                             .format(tx_height, merkle.get('block_height'), tx_hash))
-        tx_height = merkle.get('block_height')
-        pos = merkle.get('pos')
-        merkle_branch = merkle.get('merkle')
+            for tx_hash in txs_by_height[tx_height]:
+                self.requested_merkle.add(tx_hash)
+                batch.append((tx_hash, tx_height))
+                if len(batch) == MERKLE_BATCH_SIZE:
+                    await self.taskgroup.spawn(self._request_and_verify_proofs, batch)
+                    batch = []
+        if batch:
+            await self.taskgroup.spawn(self._request_and_verify_proofs, batch)
+
+    async def _request_and_verify_proofs(self, batch: Sequence[Tuple[str, int]]):
+        async with self._batch_semaphore:
+            if self._sync_started is None:
+                self._sync_started = time.monotonic()
+            self.logger.info(f'requested {len(batch)} merkle proofs, from height {batch[0][1]}')
+            results = await self.network.get_merkle_for_transactions(batch)
+        proofs = []
+        for (tx_hash, tx_height), merkle in zip(batch, results):
+            if isinstance(merkle, UntrustedServerReturnedError):
+                if not isinstance(merkle.original_exception, aiorpcx.jsonrpc.RPCError):
+                    raise merkle
+                self.logger.info(f'tx {tx_hash} not at height {tx_height}')
+                self.wallet.remove_unverified_tx(tx_hash, tx_height)
+                self.requested_merkle.discard(tx_hash)
+                continue
+            if tx_height != merkle.get('block_height'):
+                self.logger.info('requested tx_height {} differs from received tx_height {} for txid {}'
+                                 .format(tx_height, merkle.get('block_height'), tx_hash))
+            proofs.append((tx_hash, merkle))
+        # one header read per block, however many of our txs it has.
         # we need to wait if header sync/reorg is still ongoing, hence lock:
+        heights = {merkle.get('block_height') for tx_hash, merkle in proofs}
         async with self.network.bhi_lock:
-            header = self.network.blockchain().read_header(tx_height)
-        try:
-            verify_tx_is_in_block(tx_hash, merkle_branch, pos, header, tx_height)
-        except MerkleVerificationFailure as e:
-            if self.network.config.get("skipmerklecheck"):
-                self.logger.info(f"skipping merkle proof check {tx_hash}")
-            else:
-                self.logger.info(repr(e))
-                raise GracefulDisconnect(e) from e
-        # we passed all the tests
-        self.merkle_roots[tx_hash] = header.get('merkle_root')
-        self.requested_merkle.discard(tx_hash)
-        self.logger.info(f"verified {tx_hash}")
-        header_hash = hash_header(header)
-        tx_info = TxMinedInfo(height=tx_height,
-                              timestamp=header.get('timestamp'),
-                              txpos=pos,
-                              header_hash=header_hash)
-        self.wallet.add_verified_tx(tx_hash, tx_info)
+            chain = self.network.blockchain()
+            headers = {height: chain.read_header(height) for height in heights}
+        header_hashes = {}
+        for tx_hash, merkle in proofs:
+            # Verify the hash of the server-provided merkle branch to a
+            # transaction matches the merkle root of its block
+            tx_height = merkle.get('block_height')
+            pos = merkle.get('pos')
+            header = headers[tx_height]
+            try:
+                verify_tx_is_in_block(tx_hash, merkle.get('merkle'), pos, header, tx_height)
+            except MerkleVerificationFailure as e:
+                if self.network.config.get("skipmerklecheck"):
+                    self.logger.info(f"skipping merkle proof check {tx_hash}")
+                else:
+                    self.logger.info(repr(e))
+                    raise GracefulDisconnect(e) from e
+            # we passed all the tests
+            self.merkle_roots[tx_hash] = header.get('merkle_root')
+            self.requested_merkle.discard(tx_hash)
+            if tx_height not in header_hashes:
+                header_hashes[tx_height] = hash_header(header)
+            tx_info = TxMinedInfo(height=tx_height,
+                                  timestamp=header.get('timestamp'),
+                                  txpos=pos,
+                                  header_hash=header_hashes[tx_height])
+            self.wallet.add_verified_tx(tx_hash, tx_info)
+        self._sync_verified += len(proofs)
+        self.logger.info(f"verified {len(proofs)} txs in {len(headers)} blocks")
+        if not self.requested_merkle:
+            self._log_throughput()
+
+    def _log_throughput(self):
+        if self._sync_started is None:
+            return
+        elapsed = time.monotonic() - self._sync_started
+        rate = self._sync_verified / elapsed if elapsed > 0 else 0
+        self.logger.info(f"verified {self._sync_verified} txs in {elapsed:.2f}s ({rate:.0f} tx/s)")
+        self._sync_started = None
+        self._sync_verified = 0
 
     @classmethod
     def hash_merkle_root(cls, merkle_branch: Sequence[str], tx_hash: str, leaf_pos_in_tree: int):
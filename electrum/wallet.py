@@ -64,6 +64,7 @@ from .keystore import load_keystore, Hardware_KeyStore, KeyStore, KeyStoreWithMP
 from .util import multisig_type
 from .storage import StorageEncryptionVersion, WalletStorage
 from .wallet_db import WalletDB
+from .wallet_sql_db import SqlWalletStorage
 from . import transaction, bitcoin, coinchooser, paymentrequest, ecc, bip32, constants
 from .transaction import (Transaction, TxInput, UnknownTxinType, TxOutput,
                           PartialTransaction, PartialTxInput, PartialTxOutput, TxOutpoint)
@@ -255,6 +256,8 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         assert self.config is not None, "config must not be None"
         self.db = db
         self.storage = storage
+        if storage:
+            db.set_journal_storage(storage)
         # load addresses needs to be called before constructor for sanity checks
         db.load_addresses(self.wallet_type)
         self.keystore = None  # type: Optional[KeyStore]  # will be set by load_keystore
@@ -283,9 +286,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         self.lnworker = LNWallet(self, ln_xprv) if ln_xprv else None
         self.lnbackups = LNBackups(self)
 
-    def save_db(self):
+    def save_db(self, *, compact: bool = False):
         if self.storage:
-            self.db.write(self.storage)
+            self.db.write(self.storage, compact=compact)
 
     def save_backup(self):
         backup_dir = get_backup_dir(self.config)
@@ -345,7 +348,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
                 self.lnworker = None
             self.lnbackups.stop()
             self.lnbackups = None
-        self.save_db()
+        self.save_db(compact=True)
 
     def set_up_to_date(self, b):
         super().set_up_to_date(b)
@@ -656,6 +659,10 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
     def balance_at_timestamp(self, domain, target_timestamp):
         # we assume that get_history returns items ordered by block height
         # we also assume that block timestamps are monotonic (which is false...!)
+        if domain is None:
+            pos = self.get_history_position_at_timestamp(target_timestamp, inclusive=False)
+            h = self.get_history(start=pos - 1, stop=pos) if pos else []
+            return h[0].balance if h else 0
         h = self.get_history(domain=domain)
         balance = 0
         for hist_item in h:
@@ -665,9 +672,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         # return last balance
         return balance
 
-    def get_onchain_history(self, *, domain=None):
+    def get_onchain_history(self, *, domain=None, start: int = None):
         monotonic_timestamp = 0
-        for hist_item in self.get_history(domain=domain):
+        for hist_item in self.get_history(domain=domain, start=start):
             monotonic_timestamp = max(monotonic_timestamp, (hist_item.tx_mined_status.timestamp or 999_999_999_999))
             yield {
                 'txid': hist_item.txid,
@@ -880,7 +887,9 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
         fiat_income = Decimal(0)
         fiat_expenditures = Decimal(0)
         now = time.time()
-        for item in self.get_onchain_history():
+        # txs before this position are all older than from_timestamp
+        start = self.get_history_position_at_timestamp(from_timestamp) if from_timestamp else None
+        for item in self.get_onchain_history(start=start):
             timestamp = item['timestamp']
             if from_timestamp and (timestamp or now) < from_timestamp:
                 continue
@@ -1843,6 +1852,10 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
     def can_have_keystore_encryption(self):
         return self.keystore and self.keystore.may_have_password()
 
+    def can_have_storage_encryption(self) -> bool:
+        """Returns whether the wallet file format supports storage encryption."""
+        return not isinstance(self.storage, SqlWalletStorage)
+
     def get_available_storage_encryption_version(self) -> StorageEncryptionVersion:
         """Returns the type of storage encryption offered to the user.
 
@@ -1882,7 +1895,7 @@ class Abstract_Wallet(AddressSynchronizer, ABC):
             raise InvalidPassword()
         self.check_password(old_pw)
         if self.storage:
-            if encrypt_storage:
+            if encrypt_storage and self.can_have_storage_encryption():
                 enc_version = self.get_available_storage_encryption_version()
             else:
                 enc_version = StorageEncryptionVersion.PLAINTEXT
@@ -2207,6 +2220,8 @@ class Imported_Wallet(Simple_Wallet):
         self.set_frozen_state_of_addresses([address], False)
         pubkey = self.get_public_key(address)
         self.db.remove_imported_address(address)
+        # txs that are left lost their part to the address
+        self._rebuild_history_index()
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -67,6 +67,7 @@ class WalletDB(JsonDB):
         JsonDB.__init__(self, {})
         self._manual_upgrades = manual_upgrades
         self._called_after_upgrade_tasks = False
+        self._journal_storage = None
         if raw:  # loading existing db
             self.load_data(raw)
             self.load_plugins()
@@ -76,7 +77,9 @@ class WalletDB(JsonDB):
 
     def load_data(self, s):
         try:
-            self.data = json.loads(s)
+            self.data = s if isinstance(s, dict) else json.loads(s)
+            # the file has this data, so changes can be journaled
+            self._journal_full = False
         except:
             try:
                 d = ast.literal_eval(s)
@@ -156,6 +159,8 @@ class WalletDB(JsonDB):
         if self._called_after_upgrade_tasks:
             # we need strict ordering between upgrade() and after_upgrade_tasks()
             raise Exception("'after_upgrade_tasks' must NOT be called before 'upgrade'")
+        # the upgrades are not journaled
+        self.set_path_modified(None)
         self._convert_imported()
         self._convert_wallet_type()
         self._convert_account()
@@ -837,6 +842,7 @@ class WalletDB(JsonDB):
         if scripthash not in self._prevouts_by_scripthash:
             self._prevouts_by_scripthash[scripthash] = set()
         self._prevouts_by_scripthash[scripthash].add((prevout.to_str(), value))
+        self.set_path_modified(['prevouts_by_scripthash', scripthash])
 
     @modifier
     def remove_prevout_by_scripthash(self, scripthash: str, *, prevout: TxOutpoint, value: int) -> None:
@@ -846,6 +852,8 @@ class WalletDB(JsonDB):
         self._prevouts_by_scripthash[scripthash].discard((prevout.to_str(), value))
         if not self._prevouts_by_scripthash[scripthash]:
             self._prevouts_by_scripthash.pop(scripthash)
+        else:
+            self.set_path_modified(['prevouts_by_scripthash', scripthash])
 
     @locked
     def get_prevouts_by_scripthash(self, scripthash: str) -> Set[Tuple[TxOutpoint, int]]:
@@ -1028,12 +1036,14 @@ class WalletDB(JsonDB):
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (1, len(self.change_addresses))
         self.change_addresses.append(addr)
+        self.set_path_appended(['addresses', 'change'], addr)
 
     @modifier
     def add_receiving_address(self, addr: str) -> None:
         assert isinstance(addr, str)
         self._addr_to_addr_index[addr] = (0, len(self.receiving_addresses))
         self.receiving_addresses.append(addr)
+        self.set_path_appended(['addresses', 'receiving'], addr)
 
     @locked
     def get_address_index(self, address: str) -> Optional[Sequence[int]]:
@@ -1156,17 +1166,29 @@ class WalletDB(JsonDB):
             v = Outpoint(**v)
         return v
 
-    def write(self, storage: 'WalletStorage'):
+    def set_journal_storage(self, storage: 'WalletStorage'):
+        """Sets the storage this db was read from, so that changes
+        can be appended to its journal."""
+        self._journal_storage = storage
+
+    def write(self, storage: 'WalletStorage', *, compact: bool = False):
         with self.lock:
-            self._write(storage)
+            self._write(storage, compact=compact)
 
-    def _write(self, storage: 'WalletStorage'):
+    def _write(self, storage: 'WalletStorage', *, compact: bool = False):
         if threading.currentThread().isDaemon():
             self.logger.warning('daemon thread cannot write db')
             return
-        if not self.modified():
+        compact = compact and storage.has_journal()
+        if not self.modified() and not compact:
             return
-        storage.write(self.dump())
+        entries = None
+        if not compact and storage is self._journal_storage:
+            entries = self.get_journal_entries()
+        if entries is None or not storage.append_journal(entries):
+            storage.write(self.dump())
+            self._journal_storage = storage
+        self.clear_journal()
         self.set_modified(False)
 
     def is_ready_to_be_used_by_wallet(self):
@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+#
+# Electrum - lightweight Bitcoin client
+# Copyright (C) 2020 The Electrum Developers
+#
+# Permission is hereby granted, free of charge, to any person
+# obtaining a copy of this software and associated documentation files
+# (the "Software"), to deal in the Software without restriction,
+# including without limitation the rights to use, copy, modify, merge,
+# publish, distribute, sublicense, and/or sell copies of the Software,
+# and to permit persons to whom the Software is furnished to do so,
+# subject to the following conditions:
+#
+# The above copyright notice and this permission notice shall be
+# included in all copies or substantial portions of the Software.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND,
+# EXPRESS OR IMPLIED, INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF
+# MERCHANTABILITY, FITNESS FOR A PARTICULAR PURPOSE AND
+# NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT HOLDERS
+# BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN
+# ACTION OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN
+# CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN THE
+# SOFTWARE.
+import os
+import json
+import sqlite3
+import threading
+from collections import defaultdict
+from typing import Optional, Iterable, Sequence, Tuple
+
+from .json_db import StoredDict, JsonDBJsonEncoder
+from .logging import Logger
+from .storage import StorageEncryptionVersion, WalletStorage
+from .util import profiler, standardize_path, WalletFileException
+from .wallet_db import WalletDB
+
+
+# top level keys of the wallet that are stored as keyed tables,
+# one row per item. Everything else goes to the 'wallet' table.
+SQL_TABLES = (
+    'txi',
+    'txo',
+    'transactions',
+    'addr_history',
+    'verified_tx3',
+    'spent_outpoints',
+    'tx_fees',
+    'prevouts_by_scripthash',
+)
+
+REST_TABLE = 'wallet'
+
+SQLITE_MAGIC = b'SQLite format 3\x00'
+
+
+def is_sql_wallet_file(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC
+    except OSError:
+        return False
+
+
+def _dumps(value) -> str:
+    return json.dumps(value, sort_keys=True, cls=JsonDBJsonEncoder)
+
+
+class SqlWalletStorage(Logger):
+    """Wallet file in sqlite format, read and written by SqlWalletDB.
+
+    Each table maps a key to a json value. Changes are applied in a
+    single sqlite transaction, so that the file is always consistent.
+    Storage encryption is not available for this format; keystore
+    encryption still applies.
+    """
+
+    def __init__(self, path):
+        Logger.__init__(self)
+        self.path = standardize_path(path)
+        self._file_exists = bool(self.path and os.path.exists(self.path))
+        if self._file_exists and not is_sql_wallet_file(self.path):
+            raise WalletFileException(f"not a sqlite wallet file: {self.path}")
+        self.logger.info(f"wallet path {self.path}")
+        # same interface as WalletStorage
+        self.pubkey = None
+        self._encryption_version = StorageEncryptionVersion.PLAINTEXT
+        self.lock = threading.Lock()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path)
+        c = conn.cursor()
+        for table in SQL_TABLES + (REST_TABLE,):
+            c.execute(f"CREATE TABLE IF NOT EXISTS {table} (key TEXT NOT NULL PRIMARY KEY, value TEXT NOT NULL)")
+        conn.commit()
+        return conn
+
+    @profiler
+    def read(self) -> dict:
+        """Returns the wallet data as a dict, in the json layout."""
+        if not self.file_exists():
+            return {}
+        data = {}
+        with self.lock:
+            conn = self._connect()
+            try:
+                c = conn.cursor()
+                c.execute(f"SELECT key, value FROM {REST_TABLE}")
+                for key, value in c:
+                    data[key] = json.loads(value)
+                for table in SQL_TABLES:
+                    c.execute(f"SELECT key, value FROM {table}")
+                    data[table] = {key: json.loads(value) for key, value in c}
+            finally:
+                conn.close()
+        return data
+
+    @profiler
+    def write(self, changes: Iterable[Tuple[str, str, Optional[str]]], *,
+              replace_tables: Sequence[str] = ()) -> None:
+        """Applies changes, as (table, key, json value), in one transaction.
+        A value of None deletes the row. Tables in replace_tables are
+        emptied first.
+        """
+        with self.lock:
+            conn = self._connect()
+            try:
+                c = conn.cursor()
+                for table in replace_tables:
+                    c.execute(f"DELETE FROM {table}")
+                n = 0
+                for table, key, value in changes:
+                    if value is None:
+                        c.execute(f"DELETE FROM {table} WHERE key=?", (key,))
+                    else:
+                        c.execute(f"REPLACE INTO {table} (key, value) VALUES (?,?)", (key, value))
+                    n += 1
+                conn.commit()
+            finally:
+                conn.close()
+        self._file_exists = True
+        self.logger.info(f"saved {self.path} ({n} records)")
+
+    def file_exists(self) -> bool:
+        return self._file_exists
+
+    def is_past_initial_decryption(self):
+        return True
+
+    def is_encrypted(self):
+        return False
+
+    def is_encrypted_with_user_pw(self):
+        return False
+
+    def is_encrypted_with_hw_device(self):
+        return False
+
+    def get_encryption_version(self):
+        return StorageEncryptionVersion.PLAINTEXT
+
+    def check_password(self, password) -> None:
+        pass
+
+    def set_password(self, password, enc_version=None):
+        if password and enc_version not in (None, StorageEncryptionVersion.PLAINTEXT):
+            raise WalletFileException("sqlite wallet files do not support storage encryption")
+
+    def basename(self) -> str:
+        return os.path.basename(self.path)
+
+
+class SqlWalletDB(WalletDB):
+    """WalletDB saved to a SqlWalletStorage.
+
+    Callers see the same StoredDicts as with WalletDB. Changes are
+    tracked by the paths passed to set_path_modified, as for the journal
+    of WalletDB: items of the SQL_TABLES, and other top level keys, are
+    only written if they were modified. When compacting, all the top
+    level keys that are not in SQL_TABLES are written again.
+    """
+
+    def __init__(self, data: dict, *, manual_upgrades: bool):
+        # set before WalletDB.__init__, which loads the data
+        self._dirty_records = defaultdict(set)  # table -> keys
+        self._dirty_tables = set()
+        self._dirty_keys = set()  # top level keys not in SQL_TABLES
+        self._needs_full_write = not data
+        WalletDB.__init__(self, data, manual_upgrades=manual_upgrades)
+
+    def upgrade(self):
+        # upgrades modify self.data before it is tracked
+        self._needs_full_write = True
+        WalletDB.upgrade(self)
+
+    def set_path_modified(self, path):
+        self.set_modified(True)
+        # not tracked while self.data is being converted to StoredDict
+        if not isinstance(self.data, StoredDict):
+            return
+        if not path:
+            self._needs_full_write = True
+        elif path[0] not in SQL_TABLES:
+            self._dirty_keys.add(path[0])
+        elif len(path) == 1:
+            self._dirty_tables.add(path[0])
+        else:
+            self._dirty_records[path[0]].add(path[1])
+
+    def set_path_appended(self, path, value):
+        self.set_path_modified(path)
+
+    def _get_changes(self, *, compact: bool = False):
+        full = self._needs_full_write
+        replace_tables = list(SQL_TABLES) + [REST_TABLE] if full else sorted(self._dirty_tables)
+        if compact and not full:
+            replace_tables.append(REST_TABLE)
+        changes = []
+        for table in SQL_TABLES:
+            d = self.data.get(table) or {}
+            if full or table in self._dirty_tables:
+                keys = d.keys()
+            else:
+                keys = self._dirty_records.get(table, ())
+            for key in keys:
+                value = d.get(key)
+                changes.append((table, key, _dumps(value) if value is not None else None))
+        if full or compact:
+            keys = [key for key in self.data.keys() if key not in SQL_TABLES]
+        else:
+            keys = sorted(self._dirty_keys)
+        for key in keys:
+            value = self.data.get(key)
+            changes.append((REST_TABLE, key, _dumps(value) if value is not None else None))
+        return changes, replace_tables
+
+    def _write(self, storage: 'SqlWalletStorage', *, compact: bool = False):
+        if threading.currentThread().isDaemon():
+            self.logger.warning('daemon thread cannot write db')
+            return
+        if not self.modified() and not compact:
+            return
+        changes, replace_tables = self._get_changes(compact=compact)
+        storage.write(changes, replace_tables=replace_tables)
+        self._dirty_records.clear()
+        self._dirty_tables.clear()
+        self._dirty_keys.clear()
+        self._needs_full_write = False
+        self.set_modified(False)
+
+
+def convert_json_to_sql(json_path: str, sql_path: str, *, password: str = None) -> None:
+    """Writes the wallet file at json_path to a new sqlite wallet file.
+    Storage encryption is removed; keystore encryption is kept.
+    """
+    storage = WalletStorage(json_path)
+    if storage.is_encrypted():
+        storage.decrypt(password)
+    db = WalletDB(storage.read(), manual_upgrades=False)
+    new_storage = SqlWalletStorage(sql_path)
+    if new_storage.file_exists():
+        raise WalletFileException(f"file already exists: {sql_path}")
+    new_db = SqlWalletDB(json.loads(db.dump()), manual_upgrades=False)
+    new_db._needs_full_write = True
+    new_db.set_modified(True)
+    new_db.write(new_storage)
+
+
+def convert_sql_to_json(sql_path: str, json_path: str) -> None:
+    """Writes the sqlite wallet file at sql_path to a new json wallet file."""
+    storage = SqlWalletStorage(sql_path)
+    db = SqlWalletDB(storage.read(), manual_upgrades=False)
+    new_storage = WalletStorage(json_path)
+    if new_storage.file_exists():
+        raise WalletFileException(f"file already exists: {json_path}")
+    new_storage.write(db.dump())